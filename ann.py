@@ -39,11 +39,21 @@ We executed:
 gzip -cd all_SRA_introns.tsv.gz | pypy rank.py \
     -s index_to_SRA_accession.tsv --annotation [GTF file]
     >[output file]
+
+Introns may instead be read from a store written by intron_store.py by
+specifying its path as the argument of --store.
+
+Junctions extracted from GTFs are cached by annotation_cache.py in the
+directory specified as the argument of --annotation-cache, so a GTF is parsed
+only the first time it is encountered. Stats are accumulated by
+annotation_report.AnnotationStatsReducer; annotation_report.py writes them in
+the same pass over introns as the outputs of sra_vs_ann.py and add_ann.py.
+Requires NumPy.
 """
 import sys
-from collections import defaultdict
 import os
-import subprocess
+import annotation_cache
+import annotation_report
 
 if __name__ == '__main__':
     import argparse
@@ -64,139 +74,29 @@ if __name__ == '__main__':
         help=('path to extract_splice_sites.py from HISAT v0.1.6-beta.'))
     parser.add_argument('--annotations', type=str, required=True, nargs='+',
         help='paths to GTF files encoding known junctions')
+    parser.add_argument('--annotation-cache', type=str, required=False,
+        default=annotation_cache.DEFAULT_CACHE,
+        help='directory in which junctions extracted from GTFs are cached')
     parser.add_argument('--sharq', type=str, required=False,
         default=None,
         help='path to SHARQ metadata if available; '
              'we used sra-all-fields-2015-9-17.txt')
+    parser.add_argument('--store', type=str, required=False,
+        default=None,
+        help='path to intron store written by intron_store.py; read instead '
+             'of stdin if specified')
     args = parser.parse_args()
 
-    index_to_project, index_to_sample, sample_to_metadata = {}, {}, {}
-    with open(args.sra) as sra_stream:
-        for line in sra_stream:
-            tokens = line.strip().split('\t')
-            index_to_project[tokens[0]] = tokens[1]
-            index_to_sample[tokens[0]] = tokens[4]
-
-    if args.sharq is not None:
-        with open(args.sharq) as sharq_stream:
-            header = sharq_stream.readline().partition(',')[2].replace(
-                        ',', '\t'
-                    ).strip()
-            for line in sharq_stream:
-                partitioned = line.partition(',')
-                sample_to_metadata[partitioned[0]] = partitioned[2].replace(
-                        ',', '\t'
-                    ).strip()
-
-    annotated_junctions = set()
-    refs = ['chr' + str(i) for i in xrange(1, 23)] + ['chrM', 'chrX', 'chrY']
-    for annotation in args.annotations:
-        extract_process = subprocess.Popen([sys.executable,
-                                                args.extract_splice_sites_path,
-                                                annotation],
-                                                stdout=subprocess.PIPE)
-        for line in extract_process.stdout:
-            tokens = line.strip().split('\t')
-            tokens[1] = int(tokens[1]) + 2
-            tokens[2] = int(tokens[2])
-            if not tokens[0].startswith('chr'):
-                tokens[0] = 'chr' + tokens[0]
-            if tokens[0] in refs:
-                annotated_junctions.add(tuple(tokens[:-1]))
-        extract_process.stdout.close()
-        exit_code = extract_process.wait()
-        if exit_code != 0:
-            raise RuntimeError(
-                'extract_splice_sites.py had nonzero exit code {}.'.format(
-                                                                    exit_code
-                                                                )
-            )
-
-    (project_junctions_ann, project_reads_ann, sample_junctions_ann,
-        sample_reads_ann, project_junctions, project_reads,
-        sample_junctions, sample_reads) = [defaultdict(int) for _ in xrange(8)]
-    for line in sys.stdin:
-        tokens = line.strip().split('\t')
-        junction = tuple([tokens[0], int(tokens[1]), int(tokens[2])])
-        if junction in annotated_junctions:
-            annotated = True
-        else:
-            annotated = False
-        samples = tokens[-2].strip().split(',')
-        sample_increments = [int(increment) for increment
-                                in tokens[-1].strip().split(',')]
-        project_increments = defaultdict(int)
-        for i, sample_index in enumerate(samples):
-            sample = index_to_sample[sample_index]
-            project_increments[index_to_project[sample_index]] \
-                += sample_increments[i]
-            sample_junctions[sample] += 1
-            sample_reads[sample] += sample_increments[i]
-            if annotated:
-                sample_junctions_ann[sample] += 1
-                sample_reads_ann[sample] += sample_increments[i]
-        for project in project_increments:
-            project_junctions[project] += 1
-            project_reads[project] += project_increments[project]
-            if annotated:
-                project_junctions_ann[project] += 1
-                project_reads_ann[project] += project_increments[project]
-
-    # Dump results
-    if args.sharq is None:
-        print '\t'.join(['type', 'accession', 'junctions',
-                            'annotated junctions', 'overlap instances',
-                            'annotated overlap instances',
-                            'proportion of junctions '
-                            'that are annotated',
-                            'proportion of overlap instances '
-                            'that are annotated'])
-        for sample in sample_junctions:
-            print '\t'.join(['sample', sample, str(sample_junctions[sample]),
-                                str(sample_junctions_ann[sample]),
-                                str(sample_reads[sample]),
-                                str(sample_reads_ann[sample]),
-                                '%.10f' % (float(sample_junctions_ann[sample])
-                                            / sample_junctions[sample]),
-                                '%.10f' % (float(sample_reads_ann[sample])
-                                            / sample_reads[sample])])
-        for project in project_junctions:
-            print '\t'.join(['project', project,
-                            str(project_junctions[project]),
-                            str(project_junctions_ann[project]),
-                            str(project_reads[project]),
-                            str(project_reads_ann[project]),
-                            '%.10f' % (float(project_junctions_ann[project])
-                                        / project_junctions[project]),
-                            '%.10f' % (float(project_reads_ann[project])
-                                        / project_reads[project])])
-    else:
-        print '\t'.join(['type', 'accession', 'junctions',
-                            'annotated junctions', 'overlap instances',
-                            'annotated overlap instances',
-                            'proportion of junctions '
-                            'that are annotated',
-                            'proportion of overlap instances '
-                            'that are annotated', header])
-        na_line = '\t'.join(['NA']*(header.count('\t')+1))
-        for sample in sample_junctions:
-            print '\t'.join(['sample', sample, str(sample_junctions[sample]),
-                                str(sample_junctions_ann[sample]),
-                                str(sample_reads[sample]),
-                                str(sample_reads_ann[sample]),
-                                '%.10f' % (float(sample_junctions_ann[sample])
-                                            / sample_junctions[sample]),
-                                '%.10f' % (float(sample_reads_ann[sample])
-                                            / sample_reads[sample]),
-                                na_line if sample not in sample_to_metadata
-                                else sample_to_metadata[sample]])
-        for project in project_junctions:
-            print '\t'.join(['project', project,
-                            str(project_junctions[project]),
-                            str(project_junctions_ann[project]),
-                            str(project_reads[project]),
-                            str(project_reads_ann[project]),
-                            '%.10f' % (float(project_junctions_ann[project])
-                                        / project_junctions[project]),
-                            '%.10f' % (float(project_reads_ann[project])
-                                        / project_reads[project]), na_line])
+    annotated_junctions, _ = annotation_report.load_annotation(
+            args.annotations, args.extract_splice_sites_path,
+            args.annotation_cache
+        )
+    classifier = annotation_report.JunctionClassifier(annotated_junctions)
+    reducer = annotation_report.AnnotationStatsReducer(
+            sys.stdout, *annotation_report.load_sra_index(args.sra),
+            sharq=(annotation_report.load_sharq(args.sharq)
+                    if args.sharq is not None else None)
+        )
+    for chunk, _ in annotation_report.intron_batches(args.store, sys.stdin):
+        reducer.add(chunk, classifier.classify(chunk))
+    reducer.finish()
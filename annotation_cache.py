@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+"""
+annotation_cache.py
+Part of SRA project
+
+Loads annotated junctions and annotated 5' and 3' splice sites from GTF files
+for ann.py, sra_vs_ann.py, and add_ann.py. Junctions are extracted from each
+GTF with extract_splice_sites.py only the first time the GTF is encountered,
+in-process unless extract_splice_sites.py is the unmodified script from HISAT
+v0.1.6-beta; they are then stored as sorted binary arrays in a cache
+directory under a name that includes the SHA-1 hash of the GTF's contents.
+Splice sites depend also on the reference, whose motifs determine which end of
+a junction is its 5' end, and are cached under a name that includes both the
+GTF's hash and a fingerprint of the reference, which may be a Bowtie index, a
+.2bit file, or a FASTA file (see reference_index.py).
+
+Junction coordinates follow the convention of all_SRA_introns.tsv.gz: start
+and end positions are 1-based and inclusive. Only junctions on chromosomes in
+REFS are kept, and chromosome names lacking the "chr" prefix are given it.
+Chromosomes are represented by their indexes in REFS.
+
+Hashes of GTFs and of .2bit and FASTA references are remembered in the cache
+directory alongside their sizes and modification times so unchanged files
+need not be read again.
+"""
+import sys
+import os
+import json
+import hashlib
+import imp
+import subprocess
+import numpy as np
+
+REFS = ['chr' + str(i) for i in xrange(1, 23)] + ['chrM', 'chrX', 'chrY']
+REF_CODES = dict((ref, code) for code, ref in enumerate(REFS))
+# Strands other than + and - are represented by .
+STRANDS = '+-.'
+_STRAND_CODES = {'+' : 0, '-' : 1}
+_FORMAT_VERSION = 1
+# Maps paths to extract_splice_sites.py to modules loaded from them
+_extraction_modules = {}
+DEFAULT_CACHE = os.path.join(os.path.expanduser('~'),
+                                '.sra_annotation_cache')
+# Dinucleotide motifs at 5' and 3' ends of junctions on either strand
+_PLUS_MOTIFS = set([('GT', 'AG'), ('GC', 'AG'), ('AT', 'AC')])
+_MINUS_MOTIFS = set([('CT', 'AC'), ('CT', 'GC'), ('GT', 'AT')])
+
+def _update_digest(digest, path, block_size=1 << 20):
+    """ Feeds contents of a file to a hashlib digest
+
+        digest: hashlib object such as hashlib.sha1()
+        path: path to file
+        block_size: number of bytes to read at a time
+
+        No return value.
+    """
+    with open(path, 'rb') as input_stream:
+        while True:
+            block = input_stream.read(block_size)
+            if not block: break
+            digest.update(block)
+
+def _save(path, **arrays):
+    """ Writes arrays to an .npz file atomically
+
+        path: path to .npz file
+        arrays: arrays to save, keyed by name
+
+        No return value.
+    """
+    temp_path = '{}.{}.tmp.npz'.format(path[:-4], os.getpid())
+    np.savez(temp_path, **arrays)
+    os.rename(temp_path, path)
+
+def file_fingerprint(path, cache_dir=DEFAULT_CACHE):
+    """ Gets SHA-1 hash of a file's contents, reusing a remembered hash
+
+        path: path to file; e.g., a GTF file
+        cache_dir: cache directory
+
+        Return value: hexadecimal digest
+    """
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    fingerprints_path = os.path.join(cache_dir, 'fingerprints.json')
+    try:
+        with open(fingerprints_path) as fingerprints_stream:
+            fingerprints = json.load(fingerprints_stream)
+    except (IOError, ValueError):
+        fingerprints = {}
+    try:
+        size, mtime, digest = fingerprints[path]
+        if size == stat.st_size and mtime == stat.st_mtime:
+            return str(digest)
+    except KeyError:
+        pass
+    digest = hashlib.sha1()
+    _update_digest(digest, path)
+    digest = digest.hexdigest()
+    fingerprints[path] = [stat.st_size, stat.st_mtime, digest]
+    temp_path = '{}.{}.tmp'.format(fingerprints_path, os.getpid())
+    with open(temp_path, 'w') as fingerprints_stream:
+        json.dump(fingerprints, fingerprints_stream)
+    os.rename(temp_path, fingerprints_path)
+    return digest
+
+def bowtie_index_fingerprint(idx_prefix):
+    """ Gets fingerprint of a Bowtie 1 index
+
+        The fingerprint is the SHA-1 hash of the .3.ebwt file, which holds the
+        extents of unambiguous stretches of the reference, together with the
+        sizes of the .1.ebwt and .4.ebwt files.
+
+        idx_prefix: basename of Bowtie 1 index
+
+        Return value: hexadecimal digest
+    """
+    digest = hashlib.sha1()
+    _update_digest(digest, idx_prefix + '.3.ebwt')
+    digest.update('\t'.join([str(os.path.getsize(idx_prefix + extension))
+                                for extension in ['.1.ebwt', '.4.ebwt']]
+                            ).encode('ascii'))
+    return digest.hexdigest()
+
+def reference_fingerprint(path, cache_dir=DEFAULT_CACHE):
+    """ Gets fingerprint of a reference opened by
+        reference_index.open_reference()
+
+        path: basename of Bowtie 1 index or path to .2bit or FASTA file
+        cache_dir: cache directory
+
+        Return value: hexadecimal digest
+    """
+    if os.path.exists(path + '.3.ebwt'):
+        return bowtie_index_fingerprint(path)
+    return file_fingerprint(path, cache_dir)
+
+def _extraction_module(extract_splice_sites_path):
+    """ Loads extract_splice_sites.py as a module if it can be imported
+
+        Each path is loaded once under its own module name so that different
+        versions of extract_splice_sites.py do not overwrite one another.
+
+        extract_splice_sites_path: path to extract_splice_sites.py
+
+        Return value: module with junction_arrays() function, or None if
+            extract_splice_sites.py is HISAT's original, which must be run as
+            a script
+    """
+    path = os.path.realpath(extract_splice_sites_path)
+    if path not in _extraction_modules:
+        try:
+            module = imp.load_source(
+                    '_extract_splice_sites_{}'.format(
+                            len(_extraction_modules)
+                        ), path
+                )
+        except Exception:
+            module = None
+        if not hasattr(module, 'junction_arrays'):
+            module = None
+        _extraction_modules[path] = module
+    return _extraction_modules[path]
+
+def extract_junctions(gtf, extract_splice_sites_path, processes=1):
+    """ Extracts junctions from a GTF with extract_splice_sites.py
+
+        Junctions are obtained in-process from the module's junction_arrays()
+        if available and otherwise by running extract_splice_sites.py as a
+        script.
+
+        gtf: path to GTF file
+        extract_splice_sites_path: path to extract_splice_sites.py
+        processes: number of processes with which to parse GTF
+
+        Return value: tuple (chrom, start, end, strand) of NumPy arrays;
+            chrom holds indexes into REFS and strand holds indexes into
+            STRANDS
+    """
+    chroms, starts, ends, strands = [], [], [], []
+    module = _extraction_module(extract_splice_sites_path)
+    if module is not None:
+        for chrom, lefts, rights, chrom_strands in module.junction_arrays(
+                gtf, processes
+            ):
+            if not chrom.startswith('chr'):
+                chrom = 'chr' + chrom
+            if chrom not in REF_CODES: continue
+            chroms.append(np.repeat(np.uint8(REF_CODES[chrom]), len(lefts)))
+            starts.append(lefts + 1)
+            ends.append(rights - 1)
+            strands.append(np.array([_STRAND_CODES.get(strand, 2)
+                                        for strand in chrom_strands],
+                                        dtype=np.uint8))
+        if not chroms:
+            return (np.zeros(0, dtype=np.uint8),
+                    np.zeros(0, dtype=np.int64),
+                    np.zeros(0, dtype=np.int64),
+                    np.zeros(0, dtype=np.uint8))
+        return (np.concatenate(chroms).astype(np.uint8),
+                np.concatenate(starts).astype(np.int64),
+                np.concatenate(ends).astype(np.int64),
+                np.concatenate(strands).astype(np.uint8))
+    extract_process = subprocess.Popen([sys.executable,
+                                            extract_splice_sites_path,
+                                            gtf],
+                                            stdout=subprocess.PIPE)
+    for line in extract_process.stdout:
+        tokens = line.strip().split('\t')
+        if not tokens[0].startswith('chr'):
+            tokens[0] = 'chr' + tokens[0]
+        if tokens[0] in REF_CODES:
+            chroms.append(REF_CODES[tokens[0]])
+            starts.append(int(tokens[1]) + 2)
+            ends.append(int(tokens[2]))
+            strands.append(_STRAND_CODES.get(tokens[3], 2))
+    extract_process.stdout.close()
+    exit_code = extract_process.wait()
+    if exit_code != 0:
+        raise RuntimeError(
+            'extract_splice_sites.py had nonzero exit code {}.'.format(
+                                                                exit_code
+                                                            )
+        )
+    return (np.array(chroms, dtype=np.uint8),
+            np.array(starts, dtype=np.int64),
+            np.array(ends, dtype=np.int64),
+            np.array(strands, dtype=np.uint8))
+
+def _unique_rows(*columns):
+    """ Sorts rows given as columns and removes duplicates
+
+        columns: NumPy arrays of equal length; rows are sorted by the first
+            column, then the second, and so on
+
+        Return value: tuple of NumPy arrays
+    """
+    if not len(columns[0]):
+        return columns
+    order = np.lexsort(columns[::-1])
+    columns = [column[order] for column in columns]
+    keep = np.ones(len(order), dtype=bool)
+    keep[1:] = np.any([column[1:] != column[:-1] for column in columns],
+                        axis=0)
+    return tuple(column[keep] for column in columns)
+
+def gtf_junctions(gtf, extract_splice_sites_path, cache_dir=DEFAULT_CACHE,
+                    processes=1):
+    """ Loads junctions of one GTF from cache, extracting them if necessary
+
+        gtf: path to GTF file
+        extract_splice_sites_path: path to extract_splice_sites.py
+        cache_dir: cache directory
+        processes: number of processes with which to parse GTF
+
+        Return value: tuple (chrom, start, end, strand) as returned by
+            extract_junctions()
+    """
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    cache_path = os.path.join(cache_dir, 'junctions_v{}_{}.npz'.format(
+            _FORMAT_VERSION, file_fingerprint(gtf, cache_dir)
+        ))
+    try:
+        cached = np.load(cache_path)
+        return tuple(cached[name]
+                        for name in ['chrom', 'start', 'end', 'strand'])
+    except IOError:
+        pass
+    chrom, start, end, strand = extract_junctions(gtf,
+                                                    extract_splice_sites_path,
+                                                    processes)
+    _save(cache_path, chrom=chrom, start=start, end=end, strand=strand)
+    return chrom, start, end, strand
+
+def load_junctions(gtfs, extract_splice_sites_path, cache_dir=DEFAULT_CACHE,
+                    processes=1):
+    """ Loads the union of junctions across GTFs
+
+        gtfs: list of paths to GTF files
+        extract_splice_sites_path: path to extract_splice_sites.py
+        cache_dir: cache directory
+        processes: number of processes with which to parse each GTF
+
+        Return value: tuple (chrom, start, end) of NumPy arrays with
+            distinct junctions sorted by chromosome index, start, and end
+    """
+    junctions = [gtf_junctions(gtf, extract_splice_sites_path, cache_dir,
+                                processes) for gtf in gtfs]
+    return _unique_rows(*[np.concatenate([junction[i]
+                                            for junction in junctions])
+                            for i in xrange(3)])
+
+def derive_splice_sites(chrom, start, end, strand, reference_index):
+    """ Finds 5' and 3' splice sites of junctions from reference motifs
+
+        Junctions whose motifs are not canonical or semicanonical are
+        skipped. A warning is written to stderr for each junction whose
+        motifs imply a strand other than the annotated one.
+
+        chrom, start, end, strand: output of extract_junctions()
+        reference_index: object with get_motifs(ref_ids, ref_offs, count)
+            method such as bowtie_index.BowtieIndexReference
+
+        Return value: tuple (five_prime, three_prime); each is a tuple
+            (chrom, position) of NumPy arrays
+    """
+    chrom_names = np.array(REFS)[chrom]
+    motifs = zip(reference_index.get_motifs(chrom_names, start - 1, 2),
+                    reference_index.get_motifs(chrom_names, end - 2, 2))
+    plus = np.array([motif in _PLUS_MOTIFS for motif in motifs], dtype=bool)
+    minus = np.array([motif in _MINUS_MOTIFS for motif in motifs],
+                        dtype=bool)
+    disagreements = int(((plus & (strand != 0))
+                            | (minus & (strand == 0))).sum())
+    sys.stderr.write('extract_splice_sites sign disagrees with sign from '
+                     'reference\n' * disagreements)
+    canonical = plus | minus
+    five = np.where(plus, start, end)[canonical]
+    three = np.where(plus, end, start)[canonical]
+    return ((chrom[canonical], five), (chrom[canonical], three))
+
+def load_splice_sites(gtfs, extract_splice_sites_path, reference_index,
+                        index_fingerprint, cache_dir=DEFAULT_CACHE,
+                        processes=1):
+    """ Loads the union of 5' and 3' splice sites across GTFs
+
+        gtfs: list of paths to GTF files
+        extract_splice_sites_path: path to extract_splice_sites.py
+        reference_index: see derive_splice_sites()
+        index_fingerprint: string identifying reference; e.g., output of
+            reference_fingerprint()
+        cache_dir: cache directory
+        processes: number of processes with which to parse each GTF
+
+        Warnings from derive_splice_sites() are written only when sites are
+        not already cached.
+
+        Return value: tuple (five_prime, three_prime); each is a tuple
+            (chrom, position) of NumPy arrays with distinct sites sorted by
+            chromosome index and position
+    """
+    five_prime, three_prime = [], []
+    for gtf in gtfs:
+        junctions = gtf_junctions(gtf, extract_splice_sites_path, cache_dir,
+                                    processes)
+        cache_path = os.path.join(cache_dir, 'sites_v{}_{}_{}.npz'.format(
+                _FORMAT_VERSION, file_fingerprint(gtf, cache_dir),
+                index_fingerprint
+            ))
+        try:
+            cached = np.load(cache_path)
+            fives = (cached['five_chrom'], cached['five_pos'])
+            threes = (cached['three_chrom'], cached['three_pos'])
+        except IOError:
+            fives, threes = derive_splice_sites(*(junctions
+                                                    + (reference_index,)))
+            fives, threes = _unique_rows(*fives), _unique_rows(*threes)
+            _save(cache_path, five_chrom=fives[0], five_pos=fives[1],
+                    three_chrom=threes[0], three_pos=threes[1])
+        five_prime.append(fives)
+        three_prime.append(threes)
+    return tuple(_unique_rows(*[np.concatenate([site[i] for site in sites])
+                                    for i in xrange(2)])
+                    for sites in (five_prime, three_prime))
@@ -0,0 +1,634 @@
+#!/usr/bin/env python
+"""
+annotation_report.py
+Part of SRA project
+
+Writes the outputs of ann.py, sra_vs_ann.py, and add_ann.py in a single pass
+over all_SRA_introns.tsv.gz, which is read from stdin. Annotation is loaded
+once, each junction is classified once as annotated or not (and, if needed,
+as having annotated 5' and 3' splice sites), and the classification of each
+chunk of junctions is fed to a reducer for each output requested:
+    --ann-stats [file]: per-sample and per-project stats on proportions of
+        junctions found in annotation, as written by ann.py; see its
+        docstring. --sra and --sharq are as for ann.py.
+    --sra-vs-ann [basename]: [basename].coverage.tsv and [basename].ann.tsv,
+        as written by sra_vs_ann.py; see its docstring.
+    --add-ann [file]: input introns with the fields x, y, and z added, as
+        written by add_ann.py; see its docstring. Only this output requires
+        splice sites and hence --bowtie1-idx.
+Any subset of these outputs may be requested, but at least one must be. A
+file of "-" is stdout. --minus-one, which subtracts 1 from end coordinates of
+input junctions as for sra_vs_ann.py, applies to every output.
+
+Introns may instead be read from a store written by intron_store.py by
+specifying its path as the argument of --store.
+
+We executed:
+gzip -cd all_SRA_introns.tsv.gz | python annotation_report.py \
+    --annotations [GTF files] --bowtie1-idx [Bowtie index basename] \
+    --ann-stats [file] --sra-vs-ann [basename] --add-ann [file]
+
+ann.py, sra_vs_ann.py, and add_ann.py use the JunctionClassifier and reducers
+defined here. A reducer has an add() method that takes an IntronChunk, the
+Classification of its junctions, and the text lines the chunk was parsed from
+(or None if it was read from a store) and a finish() method that writes any
+output remaining once every chunk has been added. Requires NumPy.
+"""
+import sys
+import os
+import numpy as np
+import intron_store
+import annotation_cache
+import junction_keys
+from reference_index import open_reference
+
+class Classification(object):
+    """ Annotation status of each junction in an IntronChunk.
+
+        junctions, five_prime and three_prime are bool arrays that are True
+        where a junction, its 5' splice site, and its 3' splice site,
+        respectively, are in annotation; five_prime and three_prime are None
+        if splice sites were not loaded. masks is an int64 array whose bit i
+        is set where a junction is in the ith of several named sets of
+        annotated junctions, or None if there are no such sets.
+    """
+    def __init__(self, junctions, five_prime=None, three_prime=None,
+                    masks=None):
+        self.junctions = junctions
+        self.five_prime = five_prime
+        self.three_prime = three_prime
+        self.masks = masks
+
+class JunctionClassifier(object):
+    """ Classifies junctions of IntronChunks using annotation loaded once. """
+    def __init__(self, junctions, splice_sites=None, end_offset=0,
+                    sorted_input=False, junction_sets=None):
+        """
+            junctions: KeySet of annotated junctions
+            splice_sites: tuple (KeySet of annotated 5' splice sites, KeySet
+                of annotated 3' splice sites) or None
+            end_offset: number to add to end position of every junction
+                before looking it up
+            sorted_input: True iff chunks are added in order of chromosome
+                and start position, in which case they are joined with
+                annotation by merging; see junction_keys.KeyCursor
+            junction_sets: list of KeySets of named sets of annotated
+                junctions whose membership is recorded in masks of
+                Classifications, or None
+        """
+        self.junctions = junctions
+        self.splice_sites = splice_sites
+        self.end_offset = end_offset
+        self.sorted_input = sorted_input
+        self.junction_sets = junction_sets
+        if sorted_input:
+            self.junction_cursor = junction_keys.junction_cursor(junctions)
+            if splice_sites is not None:
+                self.site_cursors = [junction_keys.site_cursor(key_set)
+                                        for key_set in splice_sites]
+
+    def classify(self, chunk):
+        """ Return value: Classification of junctions in chunk """
+        keys = junction_keys.chunk_junction_keys(
+                chunk, annotation_cache.REF_CODES, self.end_offset
+            )
+        if self.junction_sets is not None:
+            masks = junction_keys.membership_masks(self.junction_sets, keys)
+        else:
+            masks = None
+        if self.splice_sites is not None:
+            site_keys = junction_keys.chunk_site_keys(
+                    chunk, annotation_cache.REF_CODES
+                )
+        if self.sorted_input:
+            junction_bounds, site_bounds = junction_keys.chunk_lower_bounds(
+                    chunk, annotation_cache.REF_CODES
+                )
+            junctions = self.junction_cursor.contains(keys, junction_bounds)
+            if self.splice_sites is None:
+                return Classification(junctions, masks=masks)
+            return Classification(junctions, *[
+                    cursor.contains(sites, site_bounds) for cursor, sites
+                    in zip(self.site_cursors, site_keys)
+                ], masks=masks)
+        junctions = self.junctions.contains(keys)
+        if self.splice_sites is None:
+            return Classification(junctions, masks=masks)
+        return Classification(junctions, *[
+                key_set.contains(sites) for key_set, sites
+                in zip(self.splice_sites, site_keys)
+            ], masks=masks)
+
+def load_annotation(gtfs, extract_splice_sites_path,
+                    cache_dir=annotation_cache.DEFAULT_CACHE, reference=None,
+                    processes=1):
+    """ Loads annotated junctions and, optionally, splice sites as KeySets
+
+        gtfs: list of paths to GTF files
+        extract_splice_sites_path: path to extract_splice_sites.py
+        cache_dir: cache directory
+        reference: basename of Bowtie 1 index or path to .2bit or FASTA file
+            with which to derive splice sites, or None to skip them
+        processes: number of processes with which to parse each GTF
+
+        Return value: tuple (KeySet of annotated junctions, splice sites),
+            where splice sites is a tuple (KeySet of 5' splice sites, KeySet
+            of 3' splice sites) or None if reference is None
+    """
+    junctions = junction_keys.junction_key_set(
+            annotation_cache.load_junctions(gtfs, extract_splice_sites_path,
+                                            cache_dir, processes)
+        )
+    if reference is None:
+        return junctions, None
+    splice_sites = tuple(
+            junction_keys.site_key_set(sites) for sites in
+            annotation_cache.load_splice_sites(
+                    gtfs, extract_splice_sites_path,
+                    open_reference(reference),
+                    annotation_cache.reference_fingerprint(reference,
+                                                            cache_dir),
+                    cache_dir, processes
+                )
+        )
+    return junctions, splice_sites
+
+def intron_batches(store=None, stream=None, batch_size=100000):
+    """ Yields consecutive batches of introns
+
+        store: path to store written by intron_store.py or None to read
+            stream
+        stream: iterator over lines in all_SRA_introns or "itn" format
+        batch_size: number of introns in each batch
+
+        Yields tuples (IntronChunk, list of lines chunk was parsed from or
+            None if store was read)
+    """
+    if store is not None:
+        for chunk in intron_store.IntronStore(store).chunks(batch_size):
+            yield chunk, None
+    else:
+        for lines in intron_store.line_batches(stream, batch_size):
+            yield intron_store.parse_lines(lines), lines
+
+def annotation_fields(classification):
+    """ Return value: list of strings "x\ty\tz" of fields added by
+            add_ann.py, one for each classified junction
+    """
+    fields = np.vstack([classification.five_prime,
+                        classification.three_prime,
+                        classification.junctions]).T
+    return ['\t'.join(row) for row in np.where(fields, '1', '0').tolist()]
+
+def annotated_lines(chunk, classification, lines=None):
+    """ Return value: string with introns of chunk, each on its own line with
+            fields of annotation_fields() added; introns are lines if lines
+            is not None
+    """
+    if lines is None:
+        lines = [intron_store.format_record(record)
+                    for record in chunk.records()]
+    return ''.join([
+            '\t'.join([line.strip(), fields]) + '\n' for line, fields
+            in zip(lines, annotation_fields(classification))
+        ])
+
+def load_sra_index(sra):
+    """ Loads mapping of sample indexes to accession numbers
+
+        sra: TSV file whose tab-separated fields are sample index, project
+            accession number, and other accession numbers, respectively
+
+        Return value: tuple (dictionary mapping sample indexes to project
+            accession numbers, dictionary mapping sample indexes to run
+            accession numbers)
+    """
+    index_to_project, index_to_sample = {}, {}
+    with open(sra) as sra_stream:
+        for line in sra_stream:
+            tokens = line.strip().split('\t')
+            index_to_project[int(tokens[0])] = tokens[1]
+            index_to_sample[int(tokens[0])] = tokens[4]
+    return index_to_project, index_to_sample
+
+def load_sharq(sharq):
+    """ Loads SHARQ metadata
+
+        sharq: path to comma-separated SHARQ metadata whose first field is
+            run accession number
+
+        Return value: tuple (tab-separated header of metadata fields,
+            dictionary mapping run accession numbers to tab-separated
+            metadata)
+    """
+    sample_to_metadata = {}
+    with open(sharq) as sharq_stream:
+        header = sharq_stream.readline().partition(',')[2].replace(
+                    ',', '\t'
+                ).strip()
+        for line in sharq_stream:
+            partitioned = line.partition(',')
+            sample_to_metadata[partitioned[0]] = partitioned[2].replace(
+                    ',', '\t'
+                ).strip()
+    return header, sample_to_metadata
+
+def accession_codes(index_to_accession):
+    """ Assigns integer codes to accession numbers
+
+        index_to_accession: dictionary mapping sample indexes to accession
+            numbers
+
+        Return value: tuple (list of accession numbers indexed by code, in
+            order of their smallest sample indexes, int64 NumPy array
+            mapping each sample index to the code of its accession number or
+            -1 if it has none)
+    """
+    names, codes = [], {}
+    table = np.full(max(index_to_accession.keys() or [-1]) + 1, -1,
+                    dtype=np.int64)
+    for index, accession in sorted(index_to_accession.items()):
+        try:
+            table[index] = codes[accession]
+        except KeyError:
+            table[index] = codes[accession] = len(names)
+            names.append(accession)
+    return names, table
+
+class AnnotationStatsReducer(object):
+    """ Accumulates stats written by ann.py.
+
+        Sample and project accession numbers are replaced by integer codes
+        when the reducer is created, and counts are accumulated in arrays
+        indexed by code with np.bincount over the sample indexes and
+        coverages of each chunk. Stats are written for samples and projects
+        in the order in which they are first encountered. This differs from
+        the order of the dictionaries ann.py once accumulated stats in, which
+        Python 2 iterates over in hash order, so rows match those of older
+        output only after sorting.
+    """
+    def __init__(self, output_stream, index_to_project, index_to_sample,
+                    sharq=None):
+        """
+            output_stream: where to write stats
+            index_to_project, index_to_sample: output of load_sra_index()
+            sharq: output of load_sharq() or None
+        """
+        self.output_stream = output_stream
+        self.sharq = sharq
+        self.project_names, self.project_codes = accession_codes(
+                index_to_project
+            )
+        self.sample_names, self.sample_codes = accession_codes(
+                index_to_sample
+            )
+        # Rows are junctions, annotated junctions, reads, and annotated reads
+        self.project_counts = np.zeros((4, len(self.project_names)),
+                                        dtype=np.int64)
+        self.sample_counts = np.zeros((4, len(self.sample_names)),
+                                        dtype=np.int64)
+        self.project_seen = np.zeros(len(self.project_names), dtype=bool)
+        self.sample_seen = np.zeros(len(self.sample_names), dtype=bool)
+        self.project_order, self.sample_order = [], []
+
+    @staticmethod
+    def _counts(codes, annotated, reads, code_count):
+        """ Counts junctions and reads by code
+
+            codes: NumPy array of codes, one per junction
+            annotated: bool NumPy array that is True where a junction is
+                annotated
+            reads: NumPy array of numbers of reads, one per junction
+            code_count: number of codes
+
+            Return value: 4 x code_count array with rows as for
+                project_counts
+        """
+        return np.vstack([
+                np.bincount(codes, minlength=code_count),
+                np.bincount(codes[annotated], minlength=code_count),
+                np.bincount(codes, weights=reads, minlength=code_count),
+                np.bincount(codes[annotated], weights=reads[annotated],
+                            minlength=code_count)
+            ]).astype(np.int64)
+
+    @staticmethod
+    def _record_order(codes, seen, order):
+        """ Appends codes not yet seen to order in order of appearance """
+        unique_codes, first = np.unique(codes, return_index=True)
+        new = ~seen[unique_codes]
+        unique_codes = unique_codes[new][np.argsort(first[new])]
+        seen[unique_codes] = True
+        order.extend(unique_codes.tolist())
+
+    def add(self, chunk, classification, lines=None):
+        """ Adds classified junctions of chunk to stats """
+        if not len(chunk.samples):
+            return
+        unknown = chunk.samples >= len(self.sample_codes)
+        if not np.any(unknown):
+            unknown = self.sample_codes[chunk.samples] < 0
+        if np.any(unknown):
+            raise RuntimeError(
+                    'Sample index {} has no accession number.'.format(
+                            chunk.samples[unknown][0]
+                        )
+                )
+        samples = self.sample_codes[chunk.samples]
+        projects = self.project_codes[chunk.samples]
+        rows = chunk.rows()
+        reads = chunk.coverages.astype(np.float64)
+        self.sample_counts += self._counts(
+                samples, classification.junctions[rows], reads,
+                len(self.sample_names)
+            )
+        self._record_order(samples, self.sample_seen, self.sample_order)
+        # A junction counts once for each project among its samples
+        row_projects, entry_pairs = np.unique(
+                rows * len(self.project_names) + projects,
+                return_inverse=True
+            )
+        pair_projects = row_projects % len(self.project_names)
+        self.project_counts += self._counts(
+                pair_projects,
+                classification.junctions[
+                        row_projects // len(self.project_names)
+                    ],
+                np.bincount(entry_pairs, weights=reads),
+                len(self.project_names)
+            )
+        self._record_order(projects, self.project_seen, self.project_order)
+
+    def finish(self):
+        """ Writes stats """
+        header = ['type', 'accession', 'junctions', 'annotated junctions',
+                    'overlap instances', 'annotated overlap instances',
+                    'proportion of junctions that are annotated',
+                    'proportion of overlap instances that are annotated']
+        if self.sharq is not None:
+            header.append(self.sharq[0])
+            na_line = '\t'.join(['NA']*(self.sharq[0].count('\t')+1))
+        self.output_stream.write('\t'.join(header) + '\n')
+        for accession_type, names, order, counts in [
+                    ('sample', self.sample_names, self.sample_order,
+                        self.sample_counts),
+                    ('project', self.project_names, self.project_order,
+                        self.project_counts)
+                ]:
+            for code in order:
+                accession = names[code]
+                junctions, junctions_ann, reads, reads_ann = [
+                        int(count) for count in counts[:, code]
+                    ]
+                fields = [accession_type, accession, str(junctions),
+                            str(junctions_ann), str(reads), str(reads_ann),
+                            '%.10f' % (float(junctions_ann) / junctions),
+                            '%.10f' % (float(reads_ann) / reads)]
+                if self.sharq is not None:
+                    if accession_type == 'sample':
+                        fields.append(self.sharq[1].get(accession, na_line))
+                    else:
+                        fields.append(na_line)
+                self.output_stream.write('\t'.join(fields) + '\n')
+        self.output_stream.flush()
+
+class CoverageReducer(object):
+    """ Accumulates coverage and sample-threshold curves written by
+        sra_vs_ann.py.
+
+        Counts are accumulated for each bitmask of membership in set_count
+        sets of annotated junctions, so curves for any of the sets and any
+        combination of them are written from a single pass over introns. A
+        Classification without masks gives the mask 1 to junctions that are
+        annotated and 0 to those that are not.
+    """
+    def __init__(self, outputs, set_count=1):
+        """
+            outputs: list of tuples (basename for output files, list of
+                masks of junctions counted as annotated, total number of
+                junctions in annotation); e.g., [(basename, [1], count)] for
+                a single set of annotated junctions
+            set_count: number of sets of annotated junctions
+        """
+        self.mask_count = 1 << set_count
+        self.outputs = []
+        for basename, masks, annotated_junction_count in outputs:
+            annotated = np.zeros(self.mask_count, dtype=bool)
+            annotated[masks] = True
+            self.outputs.append(
+                    (basename, annotated, annotated_junction_count)
+                )
+        # Rows are numbers of samples or sample indexes; columns are masks
+        self.sample_count_junctions = np.zeros((1, self.mask_count),
+                                                dtype=np.int64)
+        self.sample_reads = np.zeros((0, self.mask_count), dtype=np.int64)
+        self.sample_junctions = np.zeros((0, self.mask_count),
+                                            dtype=np.int64)
+
+    def _accumulate(self, totals, rows, masks, weights=None):
+        """ Adds weights (or 1) to totals[rows[i], masks[i]] for every i
+
+            Return value: totals, grown to have at least max(rows) + 1 rows
+        """
+        if not len(rows):
+            return totals
+        row_count = max(len(totals), int(rows.max()) + 1)
+        counts = np.bincount(rows * self.mask_count + masks, weights=weights,
+                                minlength=row_count * self.mask_count)
+        counts = counts.astype(np.int64).reshape(row_count, self.mask_count)
+        counts[:len(totals)] += totals
+        return counts
+
+    def merge(self, other):
+        """ Adds counts accumulated by another CoverageReducer with the same
+            number of sets
+        """
+        for name in ['sample_count_junctions', 'sample_reads',
+                        'sample_junctions']:
+            totals, other_totals = getattr(self, name), getattr(other, name)
+            if len(totals) < len(other_totals):
+                totals, other_totals = other_totals, totals
+            totals = totals.copy()
+            totals[:len(other_totals)] += other_totals
+            setattr(self, name, totals)
+
+    def add(self, chunk, classification, lines=None):
+        """ Adds classified junctions of chunk to curves """
+        if classification.masks is not None:
+            masks = classification.masks
+        else:
+            masks = classification.junctions.astype(np.int64)
+        self.sample_count_junctions = self._accumulate(
+                self.sample_count_junctions, chunk.sample_counts(), masks
+            )
+        entry_masks = masks[chunk.rows()]
+        self.sample_reads = self._accumulate(
+                self.sample_reads, chunk.samples, entry_masks,
+                chunk.coverages.astype(np.float64)
+            )
+        self.sample_junctions = self._accumulate(
+                self.sample_junctions, chunk.samples, entry_masks
+            )
+
+    def finish(self):
+        """ Writes [basename].coverage.tsv and [basename].ann.tsv for each
+            output
+        """
+        sample_indexes = np.flatnonzero(self.sample_junctions.sum(axis=1))
+        for basename, annotated, annotated_junction_count in self.outputs:
+            reads_annotated = self.sample_reads[:, annotated].sum(axis=1)
+            reads_unannotated = self.sample_reads[:, ~annotated].sum(axis=1)
+            junctions_annotated = self.sample_junctions[:, annotated].sum(
+                    axis=1
+                )
+            junctions_unannotated = self.sample_junctions[
+                    :, ~annotated
+                ].sum(axis=1)
+            with open(basename + '.coverage.tsv', 'w') as coverage_stream:
+                for sample_index in sample_indexes.tolist():
+                    coverage_stream.write('%d\t%d\t%d\t%d\t%d\t%d\t%d\n' % (
+                            sample_index, reads_annotated[sample_index],
+                            reads_unannotated[sample_index],
+                            reads_annotated[sample_index]
+                            + reads_unannotated[sample_index],
+                            junctions_annotated[sample_index],
+                            junctions_unannotated[sample_index],
+                            junctions_annotated[sample_index]
+                            + junctions_unannotated[sample_index]
+                        ))
+            annotated_coverage = self.sample_count_junctions[
+                    :, annotated
+                ].sum(axis=1).tolist()
+            unannotated_coverage = self.sample_count_junctions[
+                    :, ~annotated
+                ].sum(axis=1).tolist()
+            annotated_junction_total, unannotated_junction_total = 0, 0
+            with open(basename + '.ann.tsv', 'w') as ann_stream:
+                for coverage in xrange(len(annotated_coverage) - 1, 0, -1):
+                    annotated_junction_total += annotated_coverage[coverage]
+                    unannotated_junction_total \
+                        += unannotated_coverage[coverage]
+                    ann_stream.write('%d\t%d\t%d\t%d\t%d\n' % (
+                            coverage, annotated_junction_total,
+                            unannotated_junction_total,
+                            annotated_junction_total
+                            + unannotated_junction_total,
+                            annotated_junction_count
+                        ))
+
+class AnnotationFieldsReducer(object):
+    """ Writes introns with fields added by add_ann.py as they arrive. """
+    def __init__(self, output_stream):
+        """
+            output_stream: where to write introns
+        """
+        self.output_stream = output_stream
+
+    def add(self, chunk, classification, lines=None):
+        """ Writes introns of chunk with fields added """
+        self.output_stream.write(
+                annotated_lines(chunk, classification, lines)
+            )
+
+    def finish(self):
+        """ Flushes output """
+        self.output_stream.flush()
+
+def _output_stream(path):
+    """ Return value: stdout if path is "-" or file opened for writing """
+    if path == '-':
+        return sys.stdout
+    return open(path, 'w')
+
+if __name__ == '__main__':
+    import argparse
+    # Print file's docstring if -h is invoked
+    parser = argparse.ArgumentParser(description=__doc__,
+                formatter_class=argparse.RawDescriptionHelpFormatter)
+    # Add command-line arguments
+    parser.add_argument('--extract-splice-sites-path', type=str,
+        default=os.path.join(os.path.dirname(__file__),
+                                'extract_splice_sites.py'),
+        help=('path to extract_splice_sites.py from HISAT v0.1.6-beta.'))
+    parser.add_argument('--annotations', type=str, required=True, nargs='+',
+        help='paths to GTF files encoding known junctions')
+    parser.add_argument('--annotation-cache', type=str, required=False,
+        default=annotation_cache.DEFAULT_CACHE,
+        help=('directory in which junctions and splice sites extracted from '
+              'GTFs are cached'))
+    parser.add_argument('--bowtie1-idx', type=str, required=False,
+        default=None,
+        help=('Path to basename of Bowtie 1 index with genome to which '
+              'FASTQs were aligned or path to .2bit or FASTA file with the '
+              'same genome; required by --add-ann'))
+    parser.add_argument('--store', type=str, required=False,
+        default=None,
+        help=('path to intron store written by intron_store.py; read '
+              'instead of stdin if specified'))
+    parser.add_argument('--minus-one', action='store_const', const=True,
+        default=False,
+        help='subtracts 1 from end coordinates of input junctions')
+    parser.add_argument('--sorted-input', action='store_const',
+        const=True, default=False,
+        help=('join introns with annotation by merging; introns must be '
+              'sorted by chromosome and start position'))
+    parser.add_argument('-p', '--processes', type=int, required=False,
+        default=1,
+        help='number of processes with which to parse GTFs')
+    parser.add_argument('--ann-stats', type=str, required=False,
+        default=None,
+        help='where to write stats of ann.py or "-" for stdout')
+    parser.add_argument('-s', '--sra', type=str,
+        default=os.path.join(os.path.dirname(__file__),
+                                'index_to_SRA_accession.tsv'),
+        help=('TSV file whose tab-separated fields are sample index, '
+              'project accession number, and other accession numbers, '
+              'respectively; used by --ann-stats'))
+    parser.add_argument('--sharq', type=str, required=False,
+        default=None,
+        help=('path to SHARQ metadata if available for --ann-stats; '
+              'we used sra-all-fields-2015-9-17.txt'))
+    parser.add_argument('--sra-vs-ann', type=str, required=False,
+        default=None,
+        help='basename for output files of sra_vs_ann.py')
+    parser.add_argument('--add-ann', type=str, required=False,
+        default=None,
+        help='where to write output of add_ann.py or "-" for stdout')
+    args = parser.parse_args()
+
+    if (args.ann_stats is None and args.sra_vs_ann is None
+            and args.add_ann is None):
+        raise RuntimeError('At least one of --ann-stats, --sra-vs-ann, and '
+                           '--add-ann must be specified.')
+    if args.add_ann is not None and args.bowtie1_idx is None:
+        raise RuntimeError('--add-ann requires --bowtie1-idx.')
+    annotated_junctions, splice_sites = load_annotation(
+            args.annotations, args.extract_splice_sites_path,
+            args.annotation_cache,
+            args.bowtie1_idx if args.add_ann is not None else None,
+            args.processes
+        )
+    classifier = JunctionClassifier(annotated_junctions, splice_sites,
+                                    -1 if args.minus_one else 0,
+                                    args.sorted_input)
+    reducers = []
+    if args.ann_stats is not None:
+        reducers.append(AnnotationStatsReducer(
+                _output_stream(args.ann_stats), *load_sra_index(args.sra),
+                sharq=(load_sharq(args.sharq) if args.sharq is not None
+                        else None)
+            ))
+    if args.sra_vs_ann is not None:
+        reducers.append(CoverageReducer(
+                [(args.sra_vs_ann, [1], len(annotated_junctions))]
+            ))
+    if args.add_ann is not None:
+        reducers.append(AnnotationFieldsReducer(
+                _output_stream(args.add_ann)
+            ))
+    for chunk, lines in intron_batches(args.store, sys.stdin):
+        classification = classifier.classify(chunk)
+        for reducer in reducers:
+            reducer.add(chunk, classification, lines)
+    for reducer in reducers:
+        reducer.finish()
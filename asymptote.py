@@ -22,12 +22,40 @@ Input (tab-delimited fields read from stdin):
 detected in samples from 4)
 
 The input is in exactly the same format as Rail-RNA's "itn" deliverable.
+
+If --analytic is specified, no random samples are taken. Instead, for each
+sample size |s|, the expected values of 2) and 3) over all random samples of
+size |s| are computed exactly from a histogram of the number of samples in
+which each intron was found (and, if --min-reads is specified, the number of
+those samples in which it was covered by at least --min-reads reads). Under
+random sampling without replacement, the number of an intron's samples that
+land in s follows a hypergeometric distribution. One line is written per
+sample size, and precision and recall are computed from the expected values.
+Requires NumPy.
+
+If --sparse is specified, random samples are taken as usual, but each chunk of
+introns is evaluated against all of them at once with sparse matrix products:
+the random samples form a boolean matrix whose rows are random samples and
+whose columns are sample indexes, and the chunk forms a sparse matrix whose
+rows are introns and whose columns are sample indexes. Output is identical to
+the default engine's. Requires NumPy and SciPy.
+
+More than one value may be passed to each of --sample-fraction and
+--min-reads, where "none" stands for an unspecified criterion. Every
+combination of the values is then evaluated on the same random samples in a
+single pass over the input. If --basename is specified, output for each
+combination is written to its own file, e.g.,
+BASENAME_sample_fraction_0.05_read_min_5.tsv; otherwise, if there is more than
+one combination, each line written to stdout is prefixed by two fields: the
+sample fraction and the minimum number of reads, with NA denoting an
+unspecified criterion.
 """
 import sys
 import random
 import multiprocessing # faster faster
 import time
 import signal
+from collections import defaultdict
 
 def init_worker():
     """ Prevents KeyboardInterrupt from reaching a pool's workers.
@@ -40,22 +68,24 @@ def init_worker():
     """
     signal.signal(signal.SIGINT, signal.SIG_IGN)
 
-def counts(populations, lines, min_reads=None, sample_fraction=None,
+def counts(populations, lines, filters=((None, None),),
             indexes=range(3000)):
     """ Finds counts for computing intron precisions and recalls
 
         populations: list of sets of sample indexes randomly sampled from
             the set of possible sample indexes
         lines: iterable of some subset of lines input from stdin
-        min_reads: minimum number of reads in which intron should be detected
-            in any one sample to guarantee passing filter OR None if no
-            such criterion should be used
-        sample_fraction: minimum proportion of samples in which intron should
-            be detected to guarantee passing filter OR None if no such
-            criterion should be used
+        filters: list of tuples (min_reads, sample_fraction), one per filter
+            to evaluate. min_reads is the minimum number of reads in which
+            intron should be detected in any one sample to guarantee passing
+            filter OR None if no such criterion should be used;
+            sample_fraction is the minimum proportion of samples in which
+            intron should be detected to guarantee passing filter OR None if
+            no such criterion should be used
         indexes: list of all sample indexes
 
-        Return value: tuple (total number of introns evaluated,
+        Return value: list with one tuple per filter in filters, each of the
+            form (total number of introns evaluated,
                 number of introns passing filter for full range of sample
                 indexes,
                 list of numbers of introns passing filter for each
@@ -65,43 +95,306 @@ def counts(populations, lines, min_reads=None, sample_fraction=None,
                     subset corresponding to list item from populations)
             )
     """
-    population_size = len(populations)
-    passes, intersections = [0]*population_size, [0]*population_size
-    unfiltered, sample_index_count = 0, len(indexes)
-    if sample_fraction is not None:
-        sample_fraction = float(sample_fraction)
-        sample_threshold = round(sample_index_count * sample_fraction)
-    else:
-        sample_threshold = 0
+    population_size, sample_index_count = len(populations), len(indexes)
+    criteria = []
+    for min_reads, sample_fraction in filters:
+        if sample_fraction is not None:
+            sample_fraction = float(sample_fraction)
+            sample_threshold = round(sample_index_count * sample_fraction)
+            population_thresholds = [
+                    round(len(population) * sample_fraction)
+                    for population in populations
+                ]
+        else:
+            sample_threshold, population_thresholds = 0, None
+        criteria.append((min_reads, sample_fraction, sample_threshold,
+                            population_thresholds))
+    need_coverages = any(min_reads is not None for min_reads, _ in filters)
+    passes = [[0]*population_size for _ in filters]
+    intersections = [[0]*population_size for _ in filters]
+    unfiltered = [0]*len(filters)
     for line in lines:
         if not line: continue
         tokens = line.strip().split('\t')
         found_indexes = [int(index) for index in tokens[3].split(',')]
         found_index_set = set(found_indexes)
         coverages = [int(coverage) for coverage in tokens[4].split(',')]
-        read_criterion = (min_reads is not None
-                            and max(coverages) >= min_reads)
-        sample_criterion = (sample_fraction is not None
-                            and len(found_indexes) >= sample_threshold)
-        no_filter = (min_reads is None and sample_fraction is None)
-        intersect_it = False
-        if no_filter or read_criterion or sample_criterion:
-            unfiltered += 1
-            intersect_it = True
-        for i in xrange(population_size):
-            if ((no_filter and populations[i].intersection(found_index_set))
-                or (sample_fraction is not None
-                        and len(populations[i].intersection(found_index_set))
-                            >= round(len(populations[i]) * sample_fraction))
-                or (min_reads is not None
-                        and max([coverage for j, coverage
-                                    in enumerate(coverages)
-                                    if found_indexes[j] in populations[i]])
-                            >= min_reads)):
-                passes[i] += 1
-                if intersect_it:
-                    intersections[i] += 1
-    return (len(lines), unfiltered, passes, intersections)
+        # Intersect with each population once for all filters
+        commons = [population.intersection(found_index_set)
+                    for population in populations]
+        if need_coverages:
+            index_to_coverage = dict(zip(found_indexes, coverages))
+            max_coverages = [max([index_to_coverage[index]
+                                    for index in common]) if common else 0
+                                for common in commons]
+        for j, (min_reads, sample_fraction, sample_threshold,
+                    population_thresholds) in enumerate(criteria):
+            read_criterion = (min_reads is not None
+                                and max(coverages) >= min_reads)
+            sample_criterion = (sample_fraction is not None
+                                and len(found_indexes) >= sample_threshold)
+            no_filter = (min_reads is None and sample_fraction is None)
+            intersect_it = False
+            if no_filter or read_criterion or sample_criterion:
+                unfiltered[j] += 1
+                intersect_it = True
+            filter_passes, filter_intersections = passes[j], intersections[j]
+            for i in xrange(population_size):
+                if ((no_filter and commons[i])
+                    or (sample_fraction is not None
+                            and len(commons[i]) >= population_thresholds[i])
+                    or (min_reads is not None and commons[i]
+                            and max_coverages[i] >= min_reads)):
+                    filter_passes[i] += 1
+                    if intersect_it:
+                        filter_intersections[i] += 1
+    return [(len(lines), unfiltered[j], passes[j], intersections[j])
+                for j in xrange(len(filters))]
+
+def sparse_counts(packed_populations, lines, filters=((None, None),),
+                    sample_index_count=3000, block_size=1024):
+    """ Finds counts for computing intron precisions and recalls
+
+        Equivalent to counts(), but intersections between introns and
+        populations are computed with sparse matrix products.
+
+        packed_populations: NumPy array with one row per population
+            obtained by applying numpy.packbits to each row of a boolean
+            matrix whose element (i, j) is True iff sample index j is in
+            population i
+        lines: iterable of some subset of lines input from stdin
+        filters: list of tuples (min_reads, sample_fraction); see counts()
+        sample_index_count: number of samples spanned by sample indexes
+        block_size: number of introns whose population hit counts are held
+            in memory at once
+
+        Return value: same as that of counts()
+    """
+    import numpy as np
+    from scipy import sparse
+    membership = np.unpackbits(packed_populations, axis=1)[
+                        :, :sample_index_count
+                    ].T.astype(np.float32)
+    population_sizes = membership.sum(axis=0).astype(np.int64).tolist()
+    criteria = []
+    for min_reads, sample_fraction in filters:
+        if sample_fraction is not None:
+            sample_fraction = float(sample_fraction)
+            sample_threshold = round(sample_index_count * sample_fraction)
+            # Same rounding as in counts()
+            population_thresholds = np.array(
+                    [round(size * sample_fraction)
+                        for size in population_sizes]
+                )
+        else:
+            sample_threshold, population_thresholds = 0, None
+        criteria.append((min_reads, sample_fraction, sample_threshold,
+                            population_thresholds))
+    min_reads_values = sorted(set(min_reads for min_reads, _ in filters
+                                    if min_reads is not None))
+    population_size = len(population_sizes)
+    passes = np.zeros((len(filters), population_size), dtype=np.int64)
+    intersections = np.zeros((len(filters), population_size),
+                                dtype=np.int64)
+    unfiltered = np.zeros(len(filters), dtype=np.int64)
+    for start in xrange(0, len(lines), block_size):
+        found_indexes, found_coverages = [], []
+        found_indptr, max_coverages = [0], []
+        for line in lines[start:start+block_size]:
+            if not line: continue
+            tokens = line.strip().split('\t')
+            found_indexes.extend(
+                    [int(index) for index in tokens[3].split(',')]
+                )
+            found_coverages.extend(
+                    [int(coverage) for coverage in tokens[4].split(',')]
+                )
+            found_indptr.append(len(found_indexes))
+            max_coverages.append(max(found_coverages[found_indptr[-2]:]))
+        if not max_coverages: continue
+        shape = (len(max_coverages), sample_index_count)
+        sample_counts = np.diff(found_indptr)
+        max_coverages = np.array(max_coverages)
+        found_coverages = np.array(found_coverages)
+        incidence = sparse.csr_matrix(
+                (np.ones(len(found_indexes), dtype=np.float32),
+                    found_indexes, found_indptr), shape=shape
+            )
+        incidence.sum_duplicates()
+        incidence.data[:] = 1
+        hits = incidence.dot(membership)
+        # Max coverage in population >= min_reads iff some sample with
+        # coverage >= min_reads is in population
+        high_hits = {}
+        for min_reads in min_reads_values:
+            high = sparse.csr_matrix(
+                    ((found_coverages >= min_reads).astype(np.float32),
+                        found_indexes, found_indptr), shape=shape
+                )
+            high.eliminate_zeros()
+            high_hits[min_reads] = (high.dot(membership) > 0)
+        for j, (min_reads, sample_fraction, sample_threshold,
+                    population_thresholds) in enumerate(criteria):
+            no_filter = (min_reads is None and sample_fraction is None)
+            intron_unfiltered = np.zeros(shape[0], dtype=bool)
+            passing = np.zeros(hits.shape, dtype=bool)
+            if no_filter:
+                intron_unfiltered[:] = True
+                passing |= (hits > 0)
+            if sample_fraction is not None:
+                intron_unfiltered |= (sample_counts >= sample_threshold)
+                passing |= (hits >= population_thresholds)
+            if min_reads is not None:
+                intron_unfiltered |= (max_coverages >= min_reads)
+                passing |= high_hits[min_reads]
+            unfiltered[j] += intron_unfiltered.sum()
+            passes[j] += passing.sum(axis=0)
+            intersections[j] += passing[intron_unfiltered].sum(axis=0)
+    return [(len(lines), int(unfiltered[j]), passes[j].tolist(),
+                intersections[j].tolist()) for j in xrange(len(filters))]
+
+def sample_count_histograms(lines, min_reads_values=(None,)):
+    """ Tallies introns by numbers of samples in which they were found
+
+        lines: iterable of lines input from stdin
+        min_reads_values: list of minimum numbers of reads in which intron
+            should be detected in any one sample to guarantee passing filter;
+            None means no such criterion should be used
+
+        Return value: dictionary mapping each item of min_reads_values to
+            a dictionary mapping tuples (number of samples in which intron
+            was found, number of those samples in which intron was covered by
+            at least min_reads reads or 0 if min_reads is None) to numbers of
+            introns
+    """
+    histograms = dict((min_reads, defaultdict(int))
+                        for min_reads in min_reads_values)
+    for line in lines:
+        if not line.strip(): continue
+        coverages = [int(coverage) for coverage
+                        in line.strip().split('\t')[4].split(',')]
+        for min_reads in histograms:
+            if min_reads is None:
+                histograms[min_reads][(len(coverages), 0)] += 1
+            else:
+                histograms[min_reads][
+                        (len(coverages),
+                            sum(1 for coverage in coverages
+                                    if coverage >= min_reads))
+                    ] += 1
+    return histograms
+
+def analytic_counts(histogram, sample_sizes, min_reads=None,
+                        sample_fraction=None, sample_index_count=3000):
+    """ Finds expected counts for computing intron precisions and recalls
+
+        An intron found in k of S samples and covered by at least min_reads
+        reads in m of those samples passes the filter for a random sample of
+        size n unless the random sample includes none of the m samples and
+        fewer than round(n * sample_fraction) of the other k - m samples.
+        The probability of the latter is a sum of hypergeometric terms.
+
+        histogram: item of output of sample_count_histograms()
+        sample_sizes: list of sizes of random samples of sample indexes
+        min_reads: minimum number of reads in which intron should be detected
+            in any one sample to guarantee passing filter OR None if no
+            such criterion should be used
+        sample_fraction: minimum proportion of samples in which intron should
+            be detected to guarantee passing filter OR None if no such
+            criterion should be used
+        sample_index_count: number of samples spanned by sample indexes
+
+        Return value: tuple (total number of introns evaluated,
+                number of introns passing filter for full range of sample
+                indexes,
+                list of expected numbers of introns passing filter for
+                each corresponding sample size in the list sample_sizes,
+                list of expected numbers of introns passing both filters
+                (for full range of sample indexes and random sample of
+                corresponding size from sample_sizes)
+            )
+    """
+    import numpy as np
+    keys = sorted(histogram)
+    found = np.array([key[0] for key in keys], dtype=np.int64)
+    covered = np.array([key[1] for key in keys], dtype=np.int64)
+    weights = np.array([histogram[key] for key in keys], dtype=np.float64)
+    if len(keys) and found.max() > sample_index_count:
+        raise RuntimeError('An intron was found in more samples than are '
+                           'spanned by sample indexes.')
+    log_factorials = np.concatenate(
+            ([0.0], np.cumsum(np.log(np.arange(1, sample_index_count + 1))))
+        )
+    def log_binomial(n, r):
+        """ Return value: array of log(n choose r); -inf where r > n """
+        n, r = np.broadcast_arrays(n, r)
+        valid = (r >= 0) & (r <= n)
+        n, r = np.where(valid, n, 0), np.where(valid, r, 0)
+        return np.where(valid, log_factorials[n] - log_factorials[r]
+                                    - log_factorials[n - r], -np.inf)
+    no_filter = (min_reads is None and sample_fraction is None)
+    if no_filter:
+        # Passes if found in any sampled sample; treat all samples as "high"
+        covered = found
+    if sample_fraction is not None:
+        sample_fraction = float(sample_fraction)
+        sample_threshold = round(sample_index_count * sample_fraction)
+    unfiltered_keys = no_filter | (covered > 0)
+    if sample_fraction is not None:
+        unfiltered_keys |= (found >= sample_threshold)
+    passes, intersections = [], []
+    for sample_size in sample_sizes:
+        log_total = log_binomial(sample_index_count, sample_size)
+        if sample_fraction is None:
+            # Fails only if no "high" sample is drawn
+            failing = np.exp(log_binomial(sample_index_count - covered,
+                                            sample_size) - log_total)
+        else:
+            failing = np.zeros(len(keys))
+            for drawn in xrange(int(round(sample_size * sample_fraction))):
+                failing += np.exp(
+                        log_binomial(found - covered, drawn)
+                        + log_binomial(sample_index_count - found,
+                                        sample_size - drawn)
+                        - log_total
+                    )
+        passing = weights * np.clip(1.0 - failing, 0.0, 1.0)
+        passes.append(float(passing.sum()))
+        intersections.append(float(passing[unfiltered_keys].sum()))
+    return (int(weights.sum()), int(weights[unfiltered_keys].sum()),
+                passes, intersections)
+
+def filter_name(min_reads, sample_fraction):
+    """ Gets suffix identifying a filter in names of output files
+
+        min_reads: minimum number of reads OR None
+        sample_fraction: minimum proportion of samples OR None
+
+        Return value: string; e.g., "sample_fraction_0.05_read_min_5"
+    """
+    name = []
+    if sample_fraction is not None:
+        name.append('sample_fraction_%g' % sample_fraction)
+    if min_reads is not None:
+        name.append('read_min_%d' % min_reads)
+    if not name:
+        return 'no_filter'
+    return '_'.join(name)
+
+def optional(type_):
+    """ Gets argparse type that also accepts "none"
+
+        type_: function converting a command-line string to a value
+
+        Return value: function converting "none" to None and any other
+            command-line string to a value using type_
+    """
+    def convert(value):
+        if value.lower() == 'none':
+            return None
+        return type_(value)
+    convert.__name__ = type_.__name__
+    return convert
 
 if __name__ == '__main__':
     start_time = time.time()
@@ -109,16 +402,19 @@ if __name__ == '__main__':
     # Print file's docstring if -h is invoked
     parser = argparse.ArgumentParser(description=__doc__, 
                 formatter_class=argparse.RawDescriptionHelpFormatter)
-    parser.add_argument('--min-reads', type=int, required=False,
-        default=None,
+    parser.add_argument('--min-reads', type=optional(int), nargs='+',
+        required=False, default=[None],
         help=('minimum number of reads in which a given intron should '
               'appear in any sample to pass filter; leave unspecified '
-              'for no minimum'))
-    parser.add_argument('--sample-fraction', type=float, required=False,
-        default=None,
+              'for no minimum; specify more than one value, including '
+              '"none", to evaluate each in a single pass'))
+    parser.add_argument('--sample-fraction', type=optional(float), nargs='+',
+        required=False, default=[None],
         help=('minimum proportion of samples in which a given intron '
               'should occur to pass filter; leave unspecified for '
-              'no minimum; sample threshold is rounded to nearest integer'))
+              'no minimum; sample threshold is rounded to nearest integer; '
+              'specify more than one value, including "none", to evaluate '
+              'each in a single pass'))
     parser.add_argument('--sample-index-count', type=int, required=False,
         default=3000,
         help=('number of samples spanned by sample indexes; this is 3000 for '
@@ -137,13 +433,106 @@ if __name__ == '__main__':
         default=None,
         help=('number of processes run simultaneously to analyze chunks; '
               'defaults to number of available processing cores'))
+    parser.add_argument('--analytic', action='store_const', const=True,
+        default=False,
+        help=('compute expected counts at each sample size exactly rather '
+              'than by taking random samples; see docstring'))
+    parser.add_argument('--sparse', action='store_const', const=True,
+        default=False,
+        help=('intersect introns with random samples using sparse matrix '
+              'products; see docstring'))
+    parser.add_argument('--seed', type=float, required=False,
+        default=None,
+        help=('seed for taking random samples; defaults to the sum of the '
+              'first --sample-fraction and first --min-reads, ignoring '
+              'those that are unspecified'))
+    parser.add_argument('--basename', type=str, required=False,
+        default=None,
+        help=('write output for each combination of --sample-fraction and '
+              '--min-reads to a separate file whose name begins with this '
+              'string and ends with, e.g., '
+              '"_sample_fraction_0.05_read_min_5.tsv"; otherwise, output '
+              'is written to stdout'))
     args = parser.parse_args()
+    filters = [(min_reads, sample_fraction)
+                for sample_fraction in args.sample_fraction
+                for min_reads in args.min_reads]
+    def open_outputs():
+        """ Opens output streams for filters
+
+            Return value: list of (output stream, list of fields with
+                which to prefix each line) for filters
+        """
+        if args.basename is not None:
+            return [(open('_'.join([args.basename,
+                                    filter_name(*a_filter)]) + '.tsv', 'w'),
+                        []) for a_filter in filters]
+        if len(filters) == 1:
+            return [(sys.stdout, [])]
+        return [(sys.stdout,
+                    ['NA' if sample_fraction is None
+                        else '%g' % sample_fraction,
+                     'NA' if min_reads is None else str(min_reads)])
+                    for min_reads, sample_fraction in filters]
+    if args.analytic:
+        sys.stderr.write('\x1b[KTallying introns...\r')
+        histograms = sample_count_histograms(sys.stdin, args.min_reads)
+        process_time = time.time()
+        print >>sys.stderr, '\x1b[KIntrons tallied in %02f s.' % (
+                    process_time - start_time
+                )
+        sys.stderr.write('\x1b[KComputing and writing output...\r')
+        sample_sizes = range(args.interval, args.sample_index_count,
+                                args.interval)
+        for (min_reads, sample_fraction), (output_stream, prefix) in zip(
+                filters, open_outputs()
+            ):
+            (total_introns, total_filtered_introns, sample_filtered_introns,
+                sample_intersects) = analytic_counts(
+                        histograms[min_reads], sample_sizes, min_reads,
+                        sample_fraction, args.sample_index_count
+                    )
+            print >>sys.stderr, ('\x1b[K%d intron(s) from %d samples were '
+                                 'processed, and %d intron(s) made it '
+                                 'through the filter %s.') % (
+                                        total_introns,
+                                        args.sample_index_count,
+                                        total_filtered_introns,
+                                        filter_name(min_reads,
+                                                    sample_fraction)
+                                    )
+            for i, sample_size in enumerate(sample_sizes):
+                print >>output_stream, '\t'.join(prefix + [
+                        '%d\t%f\t%f\t%08f\t%08f' % (
+                            sample_size,
+                            sample_filtered_introns[i],
+                            sample_intersects[i],
+                            (sample_intersects[i]
+                                / sample_filtered_introns[i])
+                            if sample_filtered_introns[i] else 0.0,
+                            (sample_intersects[i] / total_filtered_introns)
+                            if total_filtered_introns else 0.0
+                        )
+                    ])
+            if output_stream is not sys.stdout:
+                output_stream.close()
+        end_time = time.time()
+        print >>sys.stderr, ('\x1b[KOutput computed and written in %02f s. '
+                             'Entire job finished in %02f s.') % (
+                                    end_time - process_time,
+                                    end_time - start_time
+                                )
+        sys.exit(0)
     sys.stderr.write('\x1b[KPreparing chunks for processing...\r')
     indexes = range(args.sample_index_count)
-    random.seed((args.sample_fraction
-                    if args.sample_fraction is not None else 0)
-                + (args.min_reads
-                    if args.min_reads is not None else 0))
+    if args.seed is None:
+        # All filters are evaluated on the same random samples
+        random.seed((args.sample_fraction[0]
+                        if args.sample_fraction[0] is not None else 0)
+                    + (args.min_reads[0]
+                        if args.min_reads[0] is not None else 0))
+    else:
+        random.seed(args.seed)
     populations = [
                 set(random.sample(indexes, sample_size))
                 for sample_size in xrange(
@@ -155,6 +544,18 @@ if __name__ == '__main__':
         num_processes = multiprocessing.cpu_count()
     else:
         num_processes = args.num_processes
+    if args.sparse:
+        import numpy as np
+        membership = np.zeros((len(populations), args.sample_index_count),
+                                dtype=bool)
+        for i, population in enumerate(populations):
+            membership[i, list(population)] = True
+        count_function = sparse_counts
+        count_populations = np.packbits(membership, axis=1)
+        del membership
+    else:
+        count_function = counts
+        count_populations = populations
     pool = multiprocessing.Pool(num_processes, init_worker, maxtasksperchild=5)
     results = []
     to_dispatch = filter(lambda x: x is not None,
@@ -163,8 +564,10 @@ if __name__ == '__main__':
     dispatch_count, active = 0, 0
     while to_dispatch:
         len_results_before = len(results)
-        pool.apply_async(counts, [populations, to_dispatch, args.min_reads,
-                                    args.sample_fraction, indexes],
+        pool.apply_async(count_function,
+                            [count_populations, to_dispatch, filters,
+                                args.sample_index_count if args.sparse
+                                else indexes],
                             callback=results.append)
         dispatch_count += 1
         active += 1
@@ -184,29 +587,37 @@ if __name__ == '__main__':
                 process_time - start_time
             )
     sys.stderr.write('\x1b[KComputing and writing output...\r')
-    results = zip(*results)
-    total_introns = sum(results[0])
-    total_filtered_introns = sum(results[1])
-    sample_filtered_introns = [sum(chunks) for chunks in zip(*results[2])]
-    sample_intersects = [sum(chunks) for chunks in zip(*results[3])]
     line_format = '%d\t%d\t%d\t%08f\t%08f'
-    print >>sys.stderr, ('\x1b[K%d intron(s) from %d samples were processed, '
-                         'and %d intron(s) made it through the filter.') % (
-                                total_introns,
-                                args.sample_index_count,
-                                total_filtered_introns
-                            )
-    for i in xrange(len(populations)):
-        print line_format % (
-                    len(populations[i]),
-                    sample_filtered_introns[i],  
-                    sample_intersects[i],
-                    (float(sample_intersects[i]) / sample_filtered_introns[i])
-                    if sample_filtered_introns[i] else 0.0,
-                    (float(sample_intersects[i]) / total_filtered_introns)
-                    if total_filtered_introns else 0.0
-                )
+    for j, (output_stream, prefix) in enumerate(open_outputs()):
+        filter_results = zip(*[chunk_results[j] for chunk_results in results])
+        total_introns = sum(filter_results[0])
+        total_filtered_introns = sum(filter_results[1])
+        sample_filtered_introns = [sum(chunks)
+                                    for chunks in zip(*filter_results[2])]
+        sample_intersects = [sum(chunks)
+                                for chunks in zip(*filter_results[3])]
+        print >>sys.stderr, ('\x1b[K%d intron(s) from %d samples were '
+                             'processed, and %d intron(s) made it through '
+                             'the filter %s.') % (
+                                    total_introns,
+                                    args.sample_index_count,
+                                    total_filtered_introns,
+                                    filter_name(*filters[j])
+                                )
+        for i in xrange(len(populations)):
+            print >>output_stream, '\t'.join(prefix + [line_format % (
+                        len(populations[i]),
+                        sample_filtered_introns[i],  
+                        sample_intersects[i],
+                        (float(sample_intersects[i])
+                            / sample_filtered_introns[i])
+                        if sample_filtered_introns[i] else 0.0,
+                        (float(sample_intersects[i]) / total_filtered_introns)
+                        if total_filtered_introns else 0.0
+                    )])
+        if output_stream is not sys.stdout:
+            output_stream.close()
     end_time = time.time()
     print >>sys.stderr, ('\x1b[KOutput computed and written in %02f s. Entire '
                          'job finished in %02f s.') % (end_time - process_time,
-                                                       end_time - start_time)
\ No newline at end of file
+                                                       end_time - start_time)
@@ -0,0 +1,405 @@
+#!/usr/bin/env python
+"""
+bitset_asymptote.py
+Part of SRA project
+
+Evaluates the random sample experiments of asymptote.cpp (and, with
+--absolute, absolute_asymptote.cpp) for many random seeds in a single pass over
+the input. Consider an exon-exon junction filter where a junction is kept if
+and only if it is found in >= some proportion K (or, with --absolute, some
+number K) of RNA-seq samples analyzed. For each seed, random samples of N
+RNA-seq samples are taken from a total of Q RNA-seq samples, and the number of
+junctions J that make it past the filter is found at various values of K.
+For each seed, a table whose rows have the following format is written.
+
+N <tab> K <tab> J
+
+Random samples are drawn exactly as asymptote.cpp draws them with
+std::default_random_engine and std::uniform_int_distribution under libstdc++,
+so the table written for a given seed is the one asymptote.cpp writes for that
+seed. Note that, as in asymptote.cpp, values of K range from 0 in increments of
+--proportion-interval up to but not including --proportion-max.
+absolute_asymptote.cpp fixes its seed at 5, so with --absolute, --seed
+defaults to 5 and the table written without --seed is the one
+absolute_asymptote.cpp writes.
+
+Rather than baking intron and sample counts into bitsets, random samples for
+all seeds are held as rows of a bit-packed matrix, and junctions are read in
+chunks. The number of samples in a random sample in which a junction was found
+is computed by summing rows of the unpacked matrix over the junction's samples
+if the junction was found in few samples and by AND-popcount of the junction's
+packed bit row against the packed matrix otherwise. Requires NumPy and SciPy.
+
+Input (read from stdin) is the junction output of Rail for all of SRA,
+all_SRA_introns.tsv.gz, whose seventh field is a comma-separated list of
+sample indexes. Introns may instead be read from a store written by
+intron_store.py by specifying its path as the argument of --store.
+
+We executed
+gzip -cd all_SRA_introns.tsv.gz | python bitset_asymptote.py \
+    --seed $(seq 0 49) >all_asymptote_results.tsv
+to obtain the results of fifty runs of asymptote.cpp in one pass.
+"""
+import sys
+import multiprocessing # faster faster
+import time
+import signal
+import numpy as np
+from scipy import sparse
+import intron_store
+
+# Number of set bits in each possible byte
+_POPCOUNT = np.array([bin(i).count('1') for i in xrange(256)],
+                        dtype=np.uint16)
+
+def init_worker():
+    """ Prevents KeyboardInterrupt from reaching a pool's workers.
+
+        Exiting gracefully after KeyboardInterrupt or SystemExit is a
+        challenge. The solution implemented here is by John Reese and is from
+        http://noswap.com/blog/python-multiprocessing-keyboardinterrupt .
+
+        No return value.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+class MinstdRand0(object):
+    """ std::minstd_rand0, which is libstdc++'s std::default_random_engine """
+    modulus = 2147483647
+    minimum, maximum = 1, 2147483646
+
+    def __init__(self, seed):
+        self.state = seed % self.modulus
+        if not self.state:
+            self.state = 1
+
+    def __call__(self):
+        self.state = (16807 * self.state) % self.modulus
+        return self.state
+
+    def uniform_int(self, a, b):
+        """ Draws from std::uniform_int_distribution<>(a, b) as libstdc++ does
+
+            a: minimum value
+            b: maximum value
+
+            Return value: random integer on [a, b]
+        """
+        generator_range = self.maximum - self.minimum
+        scaling = generator_range // (b - a + 1)
+        past = (b - a + 1) * scaling
+        value = self() - self.minimum
+        while value >= past:
+            value = self() - self.minimum
+        return value // scaling + a
+
+def random_set(size, sample_count, generator):
+    """ Takes random sample of sample indexes as asymptote.cpp's randomSet()
+
+        Note that sample index 0 is never chosen.
+
+        size: number of sample indexes in random sample
+        sample_count: number of samples spanned by sample indexes
+        generator: MinstdRand0 object
+
+        Return value: set of sample indexes
+    """
+    random_sample = set()
+    for k in xrange(sample_count - size, sample_count):
+        v = generator.uniform_int(1, k)
+        if v not in random_sample:
+            random_sample.add(v)
+        else:
+            random_sample.add(k)
+    return random_sample
+
+def random_sets(seed, sample_count, sample_interval, sample_max,
+                    random_count):
+    """ Takes all random samples asymptote.cpp takes for a seed
+
+        seed: random seed
+        sample_count: number of samples spanned by sample indexes
+        sample_interval: minimum size of random sample as well as interval
+            between successive sizes
+        sample_max: maximum size of random sample
+        random_count: number of random samples to take of each size
+
+        Return value: list of sets of sample indexes
+    """
+    generator = MinstdRand0(seed)
+    return [random_set((i + 1) * sample_interval, sample_count, generator)
+                for i in xrange(sample_max // sample_interval)
+                for _ in xrange(random_count)]
+
+def sample_sets(lines):
+    """ Parses sample indexes of introns from lines of all_SRA_introns
+
+        lines: list of lines
+
+        Return value: tuple (indptr, samples) of NumPy arrays; sample indexes
+            of the intron on line i are samples[indptr[i]:indptr[i+1]]
+    """
+    fields = [line.split('\t', 7)[6] if line.strip() else ''
+                for line in lines]
+    indptr = np.zeros(len(fields) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([field.count(',') + 1 if field else 0
+                                for field in fields])
+    samples = np.fromstring(','.join([field for field in fields if field]),
+                                dtype=np.int64, sep=',')
+    return indptr, samples
+
+def subset_counts(packed_subsets, indptr, samples, thresholds,
+                    sample_count, block_size=1024, dense_cutoff=None):
+    """ Counts introns passing filters in random samples
+
+        packed_subsets: NumPy array with one row per random sample obtained
+            by applying numpy.packbits to each row of a boolean matrix whose
+            element (i, j) is True iff sample index j is in random sample i
+        indptr, samples: sample indexes of intron i are
+            samples[indptr[i]:indptr[i+1]]
+        thresholds: NumPy array whose element (i, k) is the minimum number of
+            samples in random sample i in which an intron must be found to
+            pass filter k
+        sample_count: number of samples spanned by sample indexes
+        block_size: number of introns whose numbers of samples found in
+            random samples are held in memory at once
+        dense_cutoff: introns found in more than this many samples are
+            intersected with random samples by AND-popcount; defaults to the
+            number of bytes in a packed row
+
+        Return value: NumPy array whose element (i, k) is the number of
+            introns found in random sample i that pass filter k
+    """
+    if dense_cutoff is None:
+        dense_cutoff = packed_subsets.shape[1]
+    membership = np.unpackbits(packed_subsets, axis=1)[
+                        :, :sample_count
+                    ].T.astype(np.float32)
+    passed = np.zeros(thresholds.shape, dtype=np.int64)
+    intron_count = len(indptr) - 1
+    for start in xrange(0, intron_count, block_size):
+        stop = min(start + block_size, intron_count)
+        block_indptr = indptr[start:stop+1] - indptr[start]
+        block_samples = samples[indptr[start]:indptr[stop]]
+        if len(block_samples) and block_samples.max() >= sample_count:
+            raise RuntimeError(
+                    'A sample index is not less than the sample count {}; '
+                    'increase --sample-count.'.format(sample_count)
+                )
+        sample_counts = np.diff(block_indptr)
+        incidence = sparse.csr_matrix(
+                (np.ones(len(block_samples), dtype=np.float32),
+                    block_samples, block_indptr),
+                shape=(stop - start, sample_count)
+            )
+        incidence.sum_duplicates()
+        incidence.data[:] = 1
+        dense = np.flatnonzero(sample_counts > dense_cutoff)
+        if len(dense):
+            sparse_rows = np.ones(stop - start, dtype=bool)
+            sparse_rows[dense] = False
+            hits = np.zeros((stop - start, packed_subsets.shape[0]),
+                                dtype=np.int64)
+            hits[sparse_rows] = incidence[sparse_rows].dot(membership)
+            for i in dense:
+                packed_intron = np.packbits(
+                        incidence[i].toarray().ravel().astype(np.uint8)
+                    )
+                hits[i] = _POPCOUNT[packed_subsets & packed_intron].sum(
+                                                                    axis=1
+                                                                )
+        else:
+            hits = incidence.dot(membership).astype(np.int64)
+        found = hits > 0
+        for k in xrange(thresholds.shape[1]):
+            passed[:, k] += (found & (hits >= thresholds[:, k])).sum(axis=0)
+    return passed
+
+def line_counts(packed_subsets, lines, thresholds, sample_count):
+    """ Counts introns passing filters in random samples for lines
+
+        packed_subsets, thresholds, sample_count: see subset_counts()
+        lines: list of lines of all_SRA_introns
+
+        Return value: see subset_counts()
+    """
+    indptr, samples = sample_sets(lines)
+    return subset_counts(packed_subsets, indptr, samples, thresholds,
+                            sample_count)
+
+if __name__ == '__main__':
+    start_time = time.time()
+    import argparse
+    # Print file's docstring if -h is invoked
+    parser = argparse.ArgumentParser(description=__doc__,
+                formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seed', type=int, nargs='+', required=False,
+        default=None,
+        help=('random seeds; a table is written for each; defaults to 0 or, '
+              'with --absolute, 5, the seed absolute_asymptote.cpp fixes'))
+    parser.add_argument('--absolute', action='store_const', const=True,
+        default=False,
+        help=('filter by number rather than proportion of samples as '
+              'absolute_asymptote.cpp does'))
+    parser.add_argument('--sample-count', type=int, required=False,
+        default=21506,
+        help='number of samples spanned by sample indexes')
+    parser.add_argument('--random-count', type=int, required=False,
+        default=None,
+        help=('number of random samples to take of each size; defaults to 1 '
+              'or, with --absolute, 5'))
+    parser.add_argument('--sample-interval', type=int, required=False,
+        default=None,
+        help=('minimum size of random sample as well as interval between '
+              'successive sizes; defaults to 500 or, with --absolute, 100'))
+    parser.add_argument('--sample-max', type=int, required=False,
+        default=None,
+        help=('maximum size of random sample; defaults to 21500 or, with '
+              '--absolute, 20000'))
+    parser.add_argument('--proportion-interval', type=float, required=False,
+        default=0.025,
+        help='interval between successive proportions of samples K')
+    parser.add_argument('--proportion-max', type=float, required=False,
+        default=0.075,
+        help='maximum proportion of samples K')
+    parser.add_argument('--count-interval', type=int, required=False,
+        default=5,
+        help=('interval between successive numbers of samples K with '
+              '--absolute'))
+    parser.add_argument('--count-max', type=int, required=False,
+        default=100,
+        help='maximum number of samples K with --absolute')
+    parser.add_argument('--store', type=str, required=False,
+        default=None,
+        help=('path to intron store written by intron_store.py; read instead '
+              'of stdin'))
+    parser.add_argument('--basename', type=str, required=False,
+        default=None,
+        help=('write table for each seed to a separate file whose name is '
+              'this string followed by "_seed_SEED.tsv"; otherwise, tables '
+              'are written to stdout in the order of --seed'))
+    parser.add_argument('--chunk-size', type=int, required=False,
+        default=100000,
+        help='number of introns a thread should analyze at a time')
+    parser.add_argument('--num-processes', '-p', type=int, required=False,
+        default=None,
+        help=('number of processes run simultaneously to analyze chunks; '
+              'defaults to number of available processing cores'))
+    args = parser.parse_args()
+    for parameter, default, absolute_default in [
+            ('seed', [0], [5]),
+            ('random_count', 1, 5),
+            ('sample_interval', 500, 100),
+            ('sample_max', 21500, 20000)
+        ]:
+        if getattr(args, parameter) is None:
+            setattr(args, parameter,
+                    absolute_default if args.absolute else default)
+    if args.absolute:
+        filter_values = [k * args.count_interval for k in xrange(
+                                args.count_max // args.count_interval + 1
+                            )]
+    else:
+        filter_values = [k * args.proportion_interval for k in xrange(
+                                int(args.proportion_max
+                                        / args.proportion_interval + 1)
+                            )]
+    sys.stderr.write('\x1b[KTaking random samples...\r')
+    subset_sizes, thresholds = [], []
+    membership = []
+    for seed in args.seed:
+        for random_sample in random_sets(seed, args.sample_count,
+                                            args.sample_interval,
+                                            args.sample_max,
+                                            args.random_count):
+            row = np.zeros(args.sample_count, dtype=bool)
+            row[list(random_sample)] = True
+            membership.append(np.packbits(row))
+            subset_sizes.append(len(random_sample))
+            if args.absolute:
+                thresholds.append(filter_values)
+            else:
+                thresholds.append([proportion * len(random_sample)
+                                    for proportion in filter_values])
+    packed_subsets = np.array(membership, dtype=np.uint8)
+    thresholds = np.array(thresholds, dtype=np.float64)
+    del membership
+    if args.num_processes is None:
+        num_processes = multiprocessing.cpu_count()
+    else:
+        num_processes = args.num_processes
+    pool = multiprocessing.Pool(num_processes, init_worker, maxtasksperchild=5)
+    results = []
+    if args.store is not None:
+        store = intron_store.IntronStore(args.store)
+        chunks = (
+                (subset_counts, [packed_subsets,
+                                    np.array(store.indptr[start:stop+1])
+                                        - store.indptr[start],
+                                    np.array(store.samples[
+                                            store.indptr[start]:
+                                            store.indptr[stop]
+                                        ]),
+                                    thresholds, args.sample_count])
+                for start, stop in ((start, min(start + args.chunk_size,
+                                                    len(store)))
+                                    for start in xrange(0, len(store),
+                                                        args.chunk_size))
+            )
+    else:
+        def line_chunks():
+            """ Yields tasks for chunks of lines read from stdin """
+            while True:
+                to_dispatch = filter(lambda x: x is not None,
+                                     [next(sys.stdin, None)
+                                        for _ in xrange(args.chunk_size)])
+                if not to_dispatch: break
+                yield (line_counts, [packed_subsets, to_dispatch,
+                                        thresholds, args.sample_count])
+        chunks = line_chunks()
+    dispatch_count, active = 0, 0
+    for function, function_args in chunks:
+        len_results_before = len(results)
+        pool.apply_async(function, function_args, callback=results.append)
+        dispatch_count += 1
+        active += 1
+        while active >= num_processes:
+            sys.stderr.write('\x1b[KChunks processed: %d\r' % len(results))
+            active -= len(results) - len_results_before
+            time.sleep(0.4)
+    while len(results) < dispatch_count:
+        sys.stderr.write('\x1b[KChunks processed: %d\r' % len(results))
+        time.sleep(0.4)
+    process_time = time.time()
+    print >>sys.stderr, '\x1b[KChunks processed in %02f s.' % (
+                process_time - start_time
+            )
+    sys.stderr.write('\x1b[KWriting output...\r')
+    passed = sum(results) if results else np.zeros(thresholds.shape,
+                                                    dtype=np.int64)
+    subsets_per_seed = len(subset_sizes) // len(args.seed)
+    for seed_index, seed in enumerate(args.seed):
+        if args.basename is not None:
+            output_stream = open(
+                    '%s_seed_%d.tsv' % (args.basename, seed), 'w'
+                )
+        else:
+            output_stream = sys.stdout
+        first = seed_index * subsets_per_seed
+        for k, filter_value in enumerate(filter_values):
+            for i in xrange(first, first + subsets_per_seed):
+                if args.absolute:
+                    print >>output_stream, '%d\t%d\t%d' % (
+                            subset_sizes[i], filter_value, passed[i, k]
+                        )
+                else:
+                    # Matches std::to_string(double)
+                    print >>output_stream, '%d\t%f\t%d' % (
+                            subset_sizes[i], filter_value, passed[i, k]
+                        )
+        if output_stream is not sys.stdout:
+            output_stream.close()
+    end_time = time.time()
+    print >>sys.stderr, ('\x1b[KOutput written in %02f s. Entire job '
+                         'finished in %02f s.') % (end_time - process_time,
+                                                   end_time - start_time)
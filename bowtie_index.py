@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+"""
+bowtie_index.py
+Part of SRA project
+
+Retrieves stretches of the reference from a small (32-bit) Bowtie 1 index for
+add_ann.py, combine.py, and annotation_cache.py. The code is adapted from
+bowtie_index.py in Rail-RNA.
+
+Opening an index requires the reference names from the .1.ebwt file and the
+extents of the unambiguous stretches of the reference from the .3.ebwt file.
+The first time an index is opened, these are written to a sidecar directory
+next to the index whose name is the index basename followed by ".sidecar";
+later runs read the reference names from the sidecar and memory-map its
+stretch tables instead of parsing the index again. The sidecar is ignored and
+rewritten if any index file has changed size or modification time since it
+was written, and it is not written at all if the index's directory is not
+writable. A sidecar has the following files.
+    meta.json: format version, reference names, reference lengths, total
+        number of unambiguous characters, and the sizes and modification times
+        of the .1.ebwt, .3.ebwt, and .4.ebwt files
+    rec_keys.bin: int64 keys of unambiguous stretches; a stretch's key is the
+        index of its reference in the reference names shifted left by 32 bits
+        plus its 0-based start offset, so keys are sorted
+    rec_lengths.bin: int64 lengths of unambiguous stretches
+    rec_unambig_preceding.bin: int64 numbers of unambiguous characters that
+        precede each stretch in the .4.ebwt file
+"""
+import os
+import json
+import struct
+import mmap
+from operator import itemgetter
+import numpy as np
+
+_FORMAT_VERSION = 1
+_INDEX_EXTENSIONS = ['.1.ebwt', '.3.ebwt', '.4.ebwt']
+_TABLES = ['rec_keys', 'rec_lengths', 'rec_unambig_preceding']
+# Record of .3.ebwt file: offset of stretch from end of previous stretch,
+# length of stretch, and whether stretch is first of its reference
+_RECORD = np.dtype([('off', '<u4'), ('len', '<u4'), ('first', 'u1')])
+# Characters decoded by BowtieIndexReference.get_motifs
+_BASES = np.frombuffer(b'ACGTN', dtype=np.uint8)
+
+def query_positions(reference, ref_ids, ref_offs, count):
+    """ Resolves batch queries into reference codes and positions
+
+        Shared by get_motifs() of BowtieIndexReference and of the backends in
+        reference_index.py.
+
+        reference: object with refcodes dictionary mapping reference names
+            to their indexes in refnames
+        ref_ids: sequence of names of reference sequences
+        ref_offs: sequence of 0-based offsets into reference sequences
+        count: number of characters in each stretch
+
+        Return value: tuple (codes, positions); codes is an n x 1 int64 array
+            of reference indexes and positions is an n x count int64 array of
+            0-based offsets of requested characters
+    """
+    rnames, rname_indexes = np.unique(np.asarray(ref_ids),
+                                        return_inverse=True)
+    codes = []
+    for rname in rnames.tolist():
+        try:
+            codes.append(reference.refcodes[rname])
+        except KeyError:
+            raise RuntimeError(
+                    'Reference sequence "%s" is not in reference.' % rname
+                )
+    codes = np.array(codes, dtype=np.int64)[rname_indexes][:, None]
+    positions = (np.asarray(ref_offs, dtype=np.int64)[:, None]
+                    + np.arange(count, dtype=np.int64))
+    return codes, positions
+
+def split_stretches(characters, count):
+    """ Splits an n x count uint8 array of characters into n strings """
+    text = characters.astype(np.uint8).tobytes()
+    return [text[i:i+count] for i in xrange(0, len(text), count)]
+
+def _index_stamps(idx_prefix):
+    """ Return value: list of [size, modification time] of index files """
+    stamps = []
+    for extension in _INDEX_EXTENSIONS:
+        stat = os.stat(idx_prefix + extension)
+        stamps.append([stat.st_size, stat.st_mtime])
+    return stamps
+
+def _parse_refnames(fh1):
+    """ Parses reference names from the .1.ebwt file
+
+        fh1: binary file handle positioned at start of .1.ebwt file
+
+        Return value: list of reference names
+    """
+    sz, struct_unsigned = 4, struct.Struct('I')
+    one = struct.unpack('<i', fh1.read(4))[0]
+    assert one == 1
+
+    ln = struct_unsigned.unpack(fh1.read(sz))[0]
+    line_rate = struct.unpack('<i', fh1.read(4))[0]
+    lines_per_side = struct.unpack('<i', fh1.read(4))[0]
+    _ = struct.unpack('<i', fh1.read(4))[0]
+    ftab_chars = struct.unpack('<i', fh1.read(4))[0]
+    _ = struct.unpack('<i', fh1.read(4))[0]
+
+    nref = struct_unsigned.unpack(fh1.read(sz))[0]
+    # skip ref lengths
+    fh1.seek(nref * sz, 1)
+
+    nfrag = struct_unsigned.unpack(fh1.read(sz))[0]
+    # skip rstarts
+    fh1.seek(nfrag * sz * 3, 1)
+
+    # skip ebwt
+    bwt_sz = ln // 4 + 1
+    line_sz = 1 << line_rate
+    side_sz = line_sz * lines_per_side
+    side_bwt_sz = side_sz - 8
+    num_side_pairs = (bwt_sz + (2*side_bwt_sz) - 1) // (2*side_bwt_sz)
+    ebwt_tot_len = num_side_pairs * 2 * side_sz
+    fh1.seek(ebwt_tot_len, 1)
+
+    # skip zOff
+    fh1.seek(sz, 1)
+
+    # skip fchr
+    fh1.seek(5 * sz, 1)
+
+    # skip ftab
+    ftab_len = (1 << (ftab_chars * 2)) + 1
+    fh1.seek(ftab_len * sz, 1)
+
+    # skip eftab
+    eftab_len = ftab_chars * 2
+    fh1.seek(eftab_len * sz, 1)
+
+    refnames = []
+    while True:
+        refname = fh1.readline()
+        if len(refname) == 0 or ord(refname[0]) == 0:
+            break
+        refnames.append(refname.split()[0])
+    assert len(refnames) == nref
+    return refnames
+
+def _parse_stretches(fh3, refnames):
+    """ Parses extents of unambiguous stretches from the .3.ebwt file
+
+        fh3: binary file handle positioned at start of .3.ebwt file
+        refnames: list of reference names
+
+        Return value: tuple (list of reference lengths, dictionary of tables
+            named in _TABLES, total number of unambiguous characters)
+    """
+    one = struct.unpack('<i', fh3.read(4))[0]
+    assert one == 1
+    nrecs = struct.unpack('I', fh3.read(4))[0]
+    recs = np.fromfile(fh3, dtype=_RECORD, count=nrecs)
+    assert len(recs) == nrecs
+    firsts = np.flatnonzero(recs['first'])
+    assert len(firsts) == len(refnames) and (not nrecs or firsts[0] == 0)
+    ref_indexes = np.cumsum(recs['first'] != 0) - 1
+    offs = recs['off'].astype(np.int64)
+    lens = recs['len'].astype(np.int64)
+    # Offset of end of each stretch from start of its reference
+    ends = np.cumsum(offs + lens)
+    ends -= np.concatenate(([0], ends[firsts[1:] - 1]))[ref_indexes]
+    lengths = np.add.reduceat(offs + lens, firsts) if nrecs else []
+    unambig_preceding = np.cumsum(lens) - lens
+    return ([int(length) for length in lengths],
+            {'rec_keys' : (ref_indexes.astype(np.int64) << 32) + ends - lens,
+             'rec_lengths' : lens,
+             'rec_unambig_preceding' : unambig_preceding},
+            int(lens.sum()))
+
+class BowtieIndexReference(object):
+    """
+    Given prefix of a Bowtie index, parses the reference names, parses the
+    extents of the unambiguous stretches, and memory-maps the file containing
+    the unambiguous-stretch sequences.  get_stretch and get_motifs member
+    functions can retrieve stretches of characters from the reference, even
+    if the stretch contains ambiguous characters.
+    """
+
+    def __init__(self, idx_prefix, sidecar=True):
+        """
+            idx_prefix: basename of Bowtie 1 index
+            sidecar: whether to read and write the sidecar directory
+        """
+        if not os.path.exists(idx_prefix + '.3.ebwt'):
+            raise RuntimeError('No Bowtie index files with prefix "%s"'
+                                    % idx_prefix)
+        self.sidecar_path = idx_prefix + '.sidecar'
+        stamps = _index_stamps(idx_prefix)
+        if not (sidecar and self._load_sidecar(stamps)):
+            with open(idx_prefix + '.1.ebwt', 'rb') as fh1:
+                self.refnames = _parse_refnames(fh1)
+            with open(idx_prefix + '.3.ebwt', 'rb') as fh3:
+                lengths, tables, self.unambig_count = _parse_stretches(
+                        fh3, self.refnames
+                    )
+            self.length = dict(zip(self.refnames, lengths))
+            for table in _TABLES:
+                setattr(self, table, tables[table])
+            if sidecar:
+                self._write_sidecar(stamps)
+
+        #
+        # Memory-map the .4.ebwt file
+        #
+        ln_bytes = (self.unambig_count + 3) // 4
+        with open(idx_prefix + '.4.ebwt', 'rb') as fh4:
+            self.fh4mm = mmap.mmap(fh4.fileno(), ln_bytes,
+                                    flags=mmap.MAP_SHARED,
+                                    prot=mmap.PROT_READ)
+        self.buf = np.frombuffer(self.fh4mm, dtype=np.uint8)
+        self.refcodes = dict((rname, i)
+                                for i, rname in enumerate(self.refnames))
+
+        # To facilitate sorting reference names in order of descending length
+        sorted_rnames = sorted(self.length.items(),
+                               key=lambda x: itemgetter(1)(x), reverse=True)
+        self.rname_to_string = {}
+        self.string_to_rname = {}
+        for i, (rname, _) in enumerate(sorted_rnames):
+            rname_string = ('%012d' % i)
+            self.rname_to_string[rname] = rname_string
+            self.string_to_rname[rname_string] = rname
+        # Handle unmapped reads
+        unmapped_string = ('%012d' % len(sorted_rnames))
+        self.rname_to_string['*'] = unmapped_string
+        self.string_to_rname[unmapped_string] = '*'
+
+        # For compatibility
+        self.rname_lengths = self.length
+
+    def _load_sidecar(self, stamps):
+        """ Reads reference names and memory-maps tables from the sidecar
+
+            stamps: output of _index_stamps() for the index
+
+            Return value: True if the sidecar was current and was loaded;
+                else False
+        """
+        try:
+            with open(os.path.join(self.sidecar_path, 'meta.json')) \
+                    as meta_stream:
+                meta = json.load(meta_stream)
+        except (IOError, ValueError):
+            return False
+        if meta['version'] != _FORMAT_VERSION or meta['stamps'] != stamps:
+            return False
+        self.refnames = [str(rname) for rname in meta['refnames']]
+        self.length = dict(zip(self.refnames, meta['lengths']))
+        self.unambig_count = meta['unambig_count']
+        rec_count = meta['rec_count']
+        for table in _TABLES:
+            if rec_count:
+                setattr(self, table, np.memmap(
+                        os.path.join(self.sidecar_path, table + '.bin'),
+                        dtype=np.int64, mode='r', shape=(rec_count,)
+                    ))
+            else:
+                # mmap cannot map empty files
+                setattr(self, table, np.zeros(0, dtype=np.int64))
+        return True
+
+    def _write_sidecar(self, stamps):
+        """ Writes the sidecar if the index's directory is writable
+
+            stamps: output of _index_stamps() for the index
+
+            No return value.
+        """
+        meta_path = os.path.join(self.sidecar_path, 'meta.json')
+        suffix = '.{}.tmp'.format(os.getpid())
+        try:
+            if not os.path.isdir(self.sidecar_path):
+                os.makedirs(self.sidecar_path)
+            if os.path.exists(meta_path):
+                # Invalidate stale sidecar until this one is finished
+                os.remove(meta_path)
+            for table in _TABLES:
+                table_path = os.path.join(self.sidecar_path, table + '.bin')
+                np.asarray(getattr(self, table), dtype=np.int64).tofile(
+                        table_path + suffix
+                    )
+                os.rename(table_path + suffix, table_path)
+            # Metadata is written last so an interrupted write is unreadable
+            with open(meta_path + suffix, 'w') as meta_stream:
+                json.dump({'version' : _FORMAT_VERSION,
+                           'refnames' : self.refnames,
+                           'lengths' : [self.length[rname]
+                                            for rname in self.refnames],
+                           'unambig_count' : self.unambig_count,
+                           'rec_count' : len(self.rec_keys),
+                           'stamps' : stamps}, meta_stream)
+            os.rename(meta_path + suffix, meta_path)
+        except (IOError, OSError):
+            pass
+
+    def get_motifs(self, ref_ids, ref_offs, count):
+        """
+        Return stretches of characters from the reference for many queries
+        at once. The unambiguous stretch containing every requested character
+        is found with a single binary search, and characters are decoded from
+        the 2-bit packed sequence with array operations. Characters outside
+        unambiguous stretches, including at negative offsets, are N.
+
+        @param ref_ids: sequence of names of ref seqs
+        @param ref_offs: sequence of offsets into reference, 0-based
+        @param count: # of characters in each stretch
+        @return: list of strings extracted from reference
+        """
+        if not len(ref_ids):
+            return []
+        codes, positions = query_positions(self, ref_ids, ref_offs, count)
+        keys = (codes << 32) + positions
+        recs = np.searchsorted(self.rec_keys, keys, side='right') - 1
+        unambiguous = (positions >= 0) & (recs >= 0)
+        recs[~unambiguous] = 0
+        offsets = keys - self.rec_keys[recs]
+        unambiguous &= (((self.rec_keys[recs] >> 32) == codes)
+                        & (offsets < self.rec_lengths[recs]))
+        buf_offs = np.where(unambiguous,
+                            self.rec_unambig_preceding[recs] + offsets, 0)
+        bases = np.where(
+                unambiguous,
+                (self.buf[buf_offs >> 2] >> ((buf_offs & 3) << 1)) & 3,
+                4
+            )
+        return split_stretches(_BASES[bases], count)
+
+    def get_stretch(self, ref_id, ref_off, count):
+        """
+        Return a stretch of characters from the reference, retrieved
+        from the Bowtie index.
+
+        @param ref_id: name of ref seq, up to & excluding whitespace
+        @param ref_off: offset into reference, 0-based
+        @param count: # of characters
+        @return: string extracted from reference
+        """
+        return self.get_motifs([ref_id], [ref_off], count)[0]
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+"""
+cluster.py
+Part of SRA project
+
+Performs pivot correlation clustering of samples on the "itn" output of Rail.
+Samples are vertices of a complete graph, and an edge between two samples is
++ if the Jaccard index of their intron sets is at least --threshold and -
+otherwise. Samples with fewer than --intron-threshold introns are not
+clustered. Until every sample is clustered, a pivot is drawn uniformly at
+random from the unclustered samples, and the pivot and all unclustered samples
+joined to it by + edges form a new cluster.
+
+Unlike cluster.cpp, which this script replaces, intron and sample counts are
+not baked in: each sample's intron set is a row of a sparse matrix sized at
+runtime, and Jaccard indexes between the pivot and the unclustered samples are
+computed --batch-size samples at a time with sparse matrix products. Pivots
+are drawn only from unclustered samples, so no sample is placed in more than
+one cluster. Requires NumPy and SciPy.
+
+Input (tab-delimited fields read from stdin):
+1) Strand (e.g., chr1+)
+2) Intron start position
+3) Intron end position
+4) Comma-separated list of sample indexes
+5) Comma-separated list of numbers of reads in which intron was initially
+detected in samples from 4)
+
+Output: one line per cluster with space-separated sample indexes, the pivot
+first. If more than one seed is passed to --seed, every line is prefixed by
+the seed and a tab, and clusters are written for each seed in turn.
+"""
+import sys
+import time
+import random
+import numpy as np
+from scipy import sparse
+
+def incidence_matrix(input_stream, chunk_size=50000):
+    """ Builds sample x intron incidence matrix from itn lines
+
+        input_stream: where to read itn lines
+        chunk_size: number of lines to parse at a time
+
+        Return value: SciPy CSR matrix whose element (i, j) is 1 if the intron
+            on line j was found in sample i and 0 otherwise
+    """
+    found_indexes, introns = [], []
+    intron_count = 0
+    while True:
+        lines = [line for line in
+                    (next(input_stream, None) for _ in xrange(chunk_size))
+                    if line is not None]
+        if not lines: break
+        fields = [line.split('\t', 4)[3] if line.strip() else ''
+                    for line in lines]
+        lengths = np.array([field.count(',') + 1 if field else 0
+                                for field in fields], dtype=np.int64)
+        found_indexes.append(np.fromstring(
+                ','.join([field for field in fields if field]),
+                dtype=np.int64, sep=','
+            ))
+        introns.append(np.repeat(np.arange(intron_count,
+                                            intron_count + len(lines),
+                                            dtype=np.int64), lengths))
+        intron_count += len(lines)
+    if found_indexes:
+        found_indexes = np.concatenate(found_indexes)
+        introns = np.concatenate(introns)
+    else:
+        found_indexes = np.zeros(0, dtype=np.int64)
+        introns = np.zeros(0, dtype=np.int64)
+    sample_count = int(found_indexes.max()) + 1 if len(found_indexes) else 0
+    incidence = sparse.csr_matrix(
+            (np.ones(len(found_indexes), dtype=np.float32),
+                (found_indexes, introns)),
+            shape=(sample_count, intron_count)
+        )
+    incidence.sum_duplicates()
+    incidence.data[:] = 1
+    return incidence
+
+def pivot_clusters(incidence, seed=5, threshold=0.5, intron_threshold=400,
+                    batch_size=1000):
+    """ Clusters samples by pivot correlation clustering
+
+        incidence: output of incidence_matrix()
+        seed: seed of random number generator from which pivots are drawn
+        threshold: minimum Jaccard index of samples joined by + edge
+        intron_threshold: minimum number of introns in a sample for it to be
+            clustered
+        batch_size: number of unclustered samples whose Jaccard indexes with
+            the pivot are computed at once
+
+        Yield value: list of sample indexes in a cluster, pivot first
+    """
+    intron_counts = np.diff(incidence.indptr)
+    unclustered = np.flatnonzero(intron_counts >= intron_threshold)
+    generator = random.Random(seed)
+    while len(unclustered):
+        pivot = unclustered[generator.randrange(len(unclustered))]
+        pivot_row = incidence[pivot].T
+        joined = np.zeros(len(unclustered), dtype=bool)
+        for start in xrange(0, len(unclustered), batch_size):
+            batch = unclustered[start:start+batch_size]
+            intersected = np.asarray(
+                    incidence[batch].dot(pivot_row).todense()
+                ).ravel()
+            unioned = intron_counts[batch] + intron_counts[pivot] - intersected
+            joined[start:start+batch_size] = (
+                    (unioned > 0)
+                    & (intersected >= threshold * np.maximum(unioned, 1))
+                )
+        joined[unclustered == pivot] = False
+        yield [int(pivot)] + unclustered[joined].tolist()
+        joined[unclustered == pivot] = True
+        unclustered = unclustered[~joined]
+
+if __name__ == '__main__':
+    start_time = time.time()
+    import argparse
+    # Print file's docstring if -h is invoked
+    parser = argparse.ArgumentParser(description=__doc__,
+                formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threshold', type=float, required=False,
+        default=0.5,
+        help='Jaccard index >= this value is + edge; else - edge')
+    parser.add_argument('--intron-threshold', type=int, required=False,
+        default=400,
+        help='minimum number of introns in sample for it to be clustered')
+    parser.add_argument('--seed', type=int, nargs='+', required=False,
+        default=[5],
+        help=('seed of random number generator from which pivots are '
+              'drawn; specify more than one to cluster with each'))
+    parser.add_argument('--batch-size', type=int, required=False,
+        default=1000,
+        help=('number of unclustered samples to compare with a pivot at '
+              'a time'))
+    parser.add_argument('--chunk-size', type=int, required=False,
+        default=50000,
+        help='number of input lines to parse at a time')
+    args = parser.parse_args()
+    print >>sys.stderr, '\x1b[KLoading introns...'
+    incidence = incidence_matrix(sys.stdin, args.chunk_size)
+    load_time = time.time()
+    print >>sys.stderr, ('\x1b[KLoaded %d intron(s) across %d sample(s) in '
+                         '%02f s.') % (incidence.shape[1], incidence.shape[0],
+                                       load_time - start_time)
+    for seed in args.seed:
+        sys.stderr.write('\x1b[KClustering with seed %d...\r' % seed)
+        cluster_count = 0
+        for cluster in pivot_clusters(incidence, seed, args.threshold,
+                                        args.intron_threshold,
+                                        args.batch_size):
+            if len(args.seed) > 1:
+                sys.stdout.write('%d\t' % seed)
+            print ''.join([str(sample) + ' ' for sample in cluster])
+            cluster_count += 1
+        print >>sys.stderr, '\x1b[KSeed %d: %d cluster(s).' % (
+                                                            seed,
+                                                            cluster_count
+                                                        )
+    end_time = time.time()
+    print >>sys.stderr, ('\x1b[KClustering finished in %02f s. Entire job '
+                         'finished in %02f s.') % (end_time - load_time,
+                                                   end_time - start_time)
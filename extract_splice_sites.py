@@ -18,22 +18,59 @@
 # You should have received a copy of the GNU General Public License
 # along with HISAT.  If not, see <http://www.gnu.org/licenses/>.
 #
+# Modified for the SRA project: junctions may be obtained in-process from
+# junction_arrays() or iter_junctions(), gzipped GTFs are read directly, GTFs
+# may be parsed by a pool of processes, and only the gene_id and
+# transcript_id attributes are parsed. Exons are held in compact arrays, and
+# exons are merged and junctions are found one chromosome at a time. Output is
+# identical to that of extract_splice_sites.py from HISAT v0.1.6-beta.
+#
 
 from __future__ import print_function
 
+import os
+import re
+import sys
+import gzip
+import multiprocessing
 from sys import stderr, exit
-from collections import defaultdict as dd, Counter
-from argparse import ArgumentParser, FileType
+from collections import defaultdict as dd
+from argparse import ArgumentParser
+import numpy as np
+
+# Matches gene_id and transcript_id attributes exactly as HISAT does:
+# attributes are the ';'-separated fields preceding the last ';', and an
+# attribute's name and value are separated by the first space after leading
+# whitespace is stripped
+_ATTRIBUTE = re.compile(
+        r'(?:^|;)\s*(gene_id|transcript_id)(?:\s*(?=;)| ([^;]*)(?=;))'
+    )
+_GZIP_MAGIC = b'\x1f\x8b'
+
+if str is bytes:
+    def _decoded(line):
+        return line
+else:
+    def _decoded(line):
+        return line.decode('utf-8')
 
 
-def extract_splice_sites(gtf_file, verbose=False):
-    genes = dd(list)
-    trans = {}
+def _parse_lines(lines):
+    """ Parses valid exon lines of a GTF
 
-    # Parse valid exon lines from the GTF file into a dict by transcript_id
-    for line in gtf_file:
+        lines: iterable of lines as read from a binary stream
 
-        line = line.strip()
+        Return value: tuple (transcripts, exon_transcripts, lefts, rights);
+            transcripts is a list of tuples (transcript_id, gene_id, chrom,
+            strand) from the first exon line of each transcript, in order of
+            appearance; exon_transcripts holds the index in transcripts of the
+            transcript of each exon; lefts and rights hold exon coordinates
+    """
+    transcripts, transcript_index = [], {}
+    exon_transcripts, lefts, rights = [], [], []
+    for line in lines:
+
+        line = _decoded(line).strip()
         if not line or line.startswith('#'):
             continue
         if '#' in line:
@@ -49,74 +86,309 @@ def extract_splice_sites(gtf_file, verbose=False):
         if feature != 'exon' or left >= right:
             continue
 
-        values_dict = {}
-        for attr in values.split(';')[:-1]:
-            attr, _, val = attr.strip().partition(' ')
-            values_dict[attr] = val.strip('"')
+        # Last occurrence of an attribute wins
+        gene_id = transcript_id = None
+        for match in _ATTRIBUTE.finditer(values):
+            value = (match.group(2) or '').rstrip().strip('"')
+            if match.group(1) == 'gene_id':
+                gene_id = value
+            else:
+                transcript_id = value
 
-        if 'gene_id' not in values_dict or \
-                'transcript_id' not in values_dict:
+        if gene_id is None or transcript_id is None:
             continue
 
-        transcript_id = values_dict['transcript_id']
-        if transcript_id not in trans:
-            trans[transcript_id] = [chrom, strand, [[left, right]]]
-            genes[values_dict['gene_id']].append(transcript_id)
-        else:
-            trans[transcript_id][2].append([left, right])
-
-    # Sort exons and merge where separating introns are <=5 bps
-    for tran, [chrom, strand, exons] in trans.items():
-            exons.sort()
-            tmp_exons = [exons[0]]
-            for i in range(1, len(exons)):
-                if exons[i][0] - tmp_exons[-1][1] <= 5:
-                    tmp_exons[-1][1] = exons[i][1]
-                else:
-                    tmp_exons.append(exons[i])
-            trans[tran] = [chrom, strand, tmp_exons]
-
-    # Calculate and print the unique junctions
-    junctions = set()
-    for chrom, strand, exons in trans.values():
-        for i in range(1, len(exons)):
-            junctions.add((chrom, exons[i-1][1], exons[i][0], strand))
-    junctions = sorted(junctions)
-    for chrom, left, right, strand in junctions:
+        try:
+            index = transcript_index[transcript_id]
+        except KeyError:
+            index = transcript_index[transcript_id] = len(transcripts)
+            transcripts.append((transcript_id, gene_id, chrom, strand))
+        exon_transcripts.append(index)
+        lefts.append(left)
+        rights.append(right)
+    return (transcripts, np.array(exon_transcripts, dtype=np.int64),
+            np.array(lefts, dtype=np.int64), np.array(rights, dtype=np.int64))
+
+
+def _parse_byte_range(task):
+    """ Parses lines of a GTF that start in a byte range
+
+        task: tuple (path to uncompressed GTF, start offset, end offset)
+
+        Return value: see _parse_lines()
+    """
+    gtf, start, end = task
+    with open(gtf, 'rb') as gtf_stream:
+        if start:
+            # Line straddling start belongs to previous range
+            gtf_stream.seek(start - 1)
+            gtf_stream.readline()
+
+        def lines():
+            position = gtf_stream.tell()
+            while position < end:
+                line = gtf_stream.readline()
+                if not line:
+                    break
+                yield line
+                position += len(line)
+        return _parse_lines(lines())
+
+
+def _line_batches(gtf_stream, batch_size):
+    """ Yields lists of at most batch_size lines from gtf_stream """
+    batch = []
+    for line in gtf_stream:
+        batch.append(line)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _open_gtf(gtf):
+    """ Opens a GTF, which may be gzipped, as a binary stream
+
+        gtf: path to GTF or "-" for stdin
+
+        Return value: tuple (binary stream, whether GTF is uncompressed file
+            that may be divided into byte ranges)
+    """
+    if gtf == '-':
+        return getattr(sys.stdin, 'buffer', sys.stdin), False
+    with open(gtf, 'rb') as gtf_stream:
+        gzipped = gtf_stream.read(2) == _GZIP_MAGIC
+    if gzipped:
+        return gzip.open(gtf, 'rb'), False
+    return open(gtf, 'rb'), True
+
+
+def _chunk_results(gtf, processes=1, batch_size=100000):
+    """ Parses a GTF, possibly with a pool of processes
+
+        An uncompressed GTF is divided into byte ranges, each parsed by a
+        different process. A gzipped GTF or stdin is instead decompressed in
+        this process and its lines are sent to the pool batch_size at a time.
+
+        gtf: path to GTF or "-" for stdin
+        processes: number of processes to use
+        batch_size: number of lines of a stream to parse at a time
+
+        Yield value: output of _parse_lines() for successive chunks of GTF
+    """
+    gtf_stream, divisible = _open_gtf(gtf)
+    try:
+        if processes <= 1:
+            yield _parse_lines(gtf_stream)
+            return
+        pool = multiprocessing.Pool(processes)
+        try:
+            if divisible:
+                size = os.path.getsize(gtf)
+                range_count = processes * 4
+                offsets = [size * i // range_count
+                            for i in range(range_count + 1)]
+                results = pool.imap(_parse_byte_range,
+                                    [(gtf, offsets[i], offsets[i+1])
+                                        for i in range(range_count)])
+            else:
+                results = pool.imap(_parse_lines,
+                                    _line_batches(gtf_stream, batch_size))
+            for result in results:
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+    finally:
+        if gtf_stream is not getattr(sys.stdin, 'buffer', sys.stdin):
+            gtf_stream.close()
+
+
+def _parse_gtf(gtf, processes=1):
+    """ Combines parsed chunks of a GTF
+
+        Chunks are combined in order, so as in HISAT, the chromosome and
+        strand of a transcript are taken from its first exon line.
+
+        gtf: path to GTF or "-" for stdin
+        processes: number of processes to use
+
+        Return value: tuple (transcript_chroms, transcript_strands,
+            gene_transcript_counts, exon_transcripts, lefts, rights);
+            transcript_chroms and transcript_strands are lists indexed by
+            transcript, gene_transcript_counts maps each gene_id to its number
+            of transcripts, and exon_transcripts, lefts, and rights are as in
+            the output of _parse_lines()
+    """
+    transcript_index = {}
+    transcript_chroms, transcript_strands = [], []
+    gene_transcript_counts = dd(int)
+    exon_transcripts, lefts, rights = [], [], []
+    for (transcripts, chunk_exon_transcripts,
+            chunk_lefts, chunk_rights) in _chunk_results(gtf, processes):
+        global_indexes = np.empty(len(transcripts), dtype=np.int64)
+        for i, (transcript_id, gene_id, chrom, strand) in enumerate(
+                transcripts
+            ):
+            try:
+                global_indexes[i] = transcript_index[transcript_id]
+            except KeyError:
+                global_indexes[i] = transcript_index[transcript_id] = len(
+                        transcript_chroms
+                    )
+                transcript_chroms.append(chrom)
+                transcript_strands.append(strand)
+                gene_transcript_counts[gene_id] += 1
+        exon_transcripts.append(global_indexes[chunk_exon_transcripts])
+        lefts.append(chunk_lefts)
+        rights.append(chunk_rights)
+    if exon_transcripts:
+        exon_transcripts = np.concatenate(exon_transcripts)
+        lefts, rights = np.concatenate(lefts), np.concatenate(rights)
+    else:
+        exon_transcripts, lefts, rights = [np.zeros(0, dtype=np.int64)
+                                            for _ in range(3)]
+    return (transcript_chroms, transcript_strands, gene_transcript_counts,
+            exon_transcripts, lefts, rights)
+
+
+def junction_arrays(gtf, processes=1, stats=None):
+    """ Finds the unique junctions of a GTF one chromosome at a time
+
+        Exons of each transcript are sorted and merged where separating
+        introns are <= 5 bps as in HISAT. Because merging replaces the end of
+        the current merged exon with the end of the next exon, a junction
+        separates consecutive sorted exons exactly when the gap between them
+        exceeds 5 bps.
+
+        gtf: path to GTF, which may be gzipped, or "-" for stdin
+        processes: number of processes with which to parse GTF
+        stats: dictionary to fill with the statistics printed by
+            extract_splice_sites() in verbose mode, or None
+
+        Yield value: tuple (chrom, lefts, rights, strands) in sorted order of
+            chrom; lefts holds the 1-based ends of exons preceding junctions
+            and rights the 1-based starts of exons following them, and
+            junctions are sorted by left, right, and strand
+    """
+    (transcript_chroms, transcript_strands, gene_transcript_counts,
+        exon_transcripts, lefts, rights) = _parse_gtf(gtf, processes)
+    chrom_names = sorted(set(transcript_chroms))
+    strand_names = np.array(sorted(set(transcript_strands)))
+    chrom_codes = dict((chrom, i) for i, chrom in enumerate(chrom_names))
+    strand_codes = dict((strand, i) for i, strand in enumerate(strand_names))
+    transcript_strand_codes = np.array(
+            [strand_codes[strand] for strand in transcript_strands],
+            dtype=np.int64
+        )
+    exon_chroms = np.array(
+            [chrom_codes[chrom] for chrom in transcript_chroms],
+            dtype=np.int64
+        )[exon_transcripts]
+    by_chrom = np.argsort(exon_chroms, kind='mergesort')
+    bounds = np.searchsorted(exon_chroms[by_chrom],
+                             np.arange(len(chrom_names) + 1))
+    exon_count = exon_length_sum = intron_count = intron_length_sum = 0
+    for i, chrom in enumerate(chrom_names):
+        chrom_exons = by_chrom[bounds[i]:bounds[i+1]]
+        transcripts = exon_transcripts[chrom_exons]
+        chrom_lefts, chrom_rights = lefts[chrom_exons], rights[chrom_exons]
+        order = np.lexsort((chrom_rights, chrom_lefts, transcripts))
+        transcripts = transcripts[order]
+        chrom_lefts, chrom_rights = chrom_lefts[order], chrom_rights[order]
+        gaps = chrom_lefts[1:] - chrom_rights[:-1]
+        same_transcript = transcripts[1:] == transcripts[:-1]
+        separated = same_transcript & (gaps > 5)
+        if stats is not None:
+            # Merged exons start where a transcript starts or a gap separates
+            starts = np.flatnonzero(np.concatenate(
+                    ([True], ~same_transcript | separated)
+                ))
+            ends = np.concatenate((starts[1:] - 1, [len(transcripts) - 1]))
+            exon_count += len(starts)
+            exon_length_sum += int(
+                    (chrom_rights[ends] - chrom_lefts[starts] + 1).sum()
+                )
+            intron_count += int(separated.sum())
+            intron_length_sum += int(gaps[separated].sum())
+        junction_lefts = chrom_rights[:-1][separated]
+        junction_rights = chrom_lefts[1:][separated]
+        junction_strands = transcript_strand_codes[
+                transcripts[1:][separated]
+            ]
+        order = np.lexsort((junction_strands, junction_rights,
+                            junction_lefts))
+        junction_lefts = junction_lefts[order]
+        junction_rights = junction_rights[order]
+        junction_strands = junction_strands[order]
+        distinct = np.ones(len(order), dtype=bool)
+        distinct[1:] = ((junction_lefts[1:] != junction_lefts[:-1])
+                        | (junction_rights[1:] != junction_rights[:-1])
+                        | (junction_strands[1:] != junction_strands[:-1]))
+        yield (chrom, junction_lefts[distinct], junction_rights[distinct],
+                strand_names[junction_strands[distinct]])
+    if stats is not None:
+        stats.update({
+                'genes': len(gene_transcript_counts),
+                'multiple_isoform_genes': sum(
+                        count > 1 for count in gene_transcript_counts.values()
+                    ),
+                'transcripts': len(transcript_chroms),
+                'exons': exon_count,
+                'exon_length_sum': exon_length_sum,
+                'introns': intron_count,
+                'intron_length_sum': intron_length_sum
+            })
+
+
+def iter_junctions(gtf, processes=1):
+    """ Yields the unique junctions of a GTF in sorted order
+
+        gtf: path to GTF, which may be gzipped, or "-" for stdin
+        processes: number of processes with which to parse GTF
+
+        Yield value: tuple (chrom, left, right, strand); left is the 1-based
+            end of the exon preceding the junction and right is the 1-based
+            start of the exon following it
+    """
+    for chrom, lefts, rights, strands in junction_arrays(gtf, processes):
+        for left, right, strand in zip(lefts.tolist(), rights.tolist(),
+                                       strands.tolist()):
+            yield chrom, left, right, strand
+
+
+def extract_splice_sites(gtf_file, verbose=False, processes=1):
+    stats = {} if verbose else None
+    for chrom, lefts, rights, strands in junction_arrays(gtf_file, processes,
+                                                         stats):
         # Zero-based offset
-        print('{}\t{}\t{}\t{}'.format(chrom, left-1, right-1, strand))
+        sys.stdout.write(''.join(
+                ['{}\t{}\t{}\t{}\n'.format(chrom, left-1, right-1, strand)
+                    for left, right, strand in zip(lefts.tolist(),
+                                                   rights.tolist(),
+                                                   strands.tolist())]
+            ))
 
     # Print some stats if asked
     if verbose:
-        exon_lengths, intron_lengths, trans_lengths = \
-            Counter(), Counter(), Counter()
-        for chrom, strand, exons in trans.values():
-            tran_len = 0
-            for i, exon in enumerate(exons):
-                exon_len = exon[1]-exon[0]+1
-                exon_lengths[exon_len] += 1
-                tran_len += exon_len
-                if i == 0:
-                    continue
-                intron_lengths[exon[0] - exons[i-1][1]] += 1
-            trans_lengths[tran_len] += 1
-
         print('genes: {}, genes with multiple isoforms: {}'.format(
-                len(genes), sum(len(v) > 1 for v in genes.values())),
+                stats['genes'], stats['multiple_isoform_genes']),
               file=stderr)
         print('transcripts: {}, transcript avg. length: {:d}'.format(
-                len(trans), sum(trans_lengths.elements())/len(trans)),
+                stats['transcripts'],
+                stats['exon_length_sum'] // stats['transcripts']),
               file=stderr)
         print('exons: {}, exon avg. length: {:d}'.format(
-                sum(exon_lengths.values()),
-                sum(exon_lengths.elements())/sum(exon_lengths.values())),
+                stats['exons'],
+                stats['exon_length_sum'] // stats['exons']),
               file=stderr)
         print('introns: {}, intron avg. length: {:d}'.format(
-                sum(intron_lengths.values()),
-                sum(intron_lengths.elements())/sum(intron_lengths.values())),
+                stats['introns'],
+                stats['intron_length_sum'] // stats['introns']),
               file=stderr)
         print('average number of exons per transcript: {:d}'.format(
-                sum(exon_lengths.values())/len(trans)),
+                stats['exons'] // stats['transcripts']),
               file=stderr)
 
 
@@ -125,15 +397,19 @@ if __name__ == '__main__':
         description='Extract splice junctions from a GTF file')
     parser.add_argument('gtf_file',
         nargs='?',
-        type=FileType('r'),
-        help='input GTF file (use "-" for stdin)')
+        type=str,
+        help='input GTF file, which may be gzipped (use "-" for stdin)')
     parser.add_argument('-v', '--verbose',
         dest='verbose',
         action='store_true',
         help='also print some statistics to stderr')
+    parser.add_argument('-p', '--processes',
+        type=int,
+        default=1,
+        help='number of processes with which to parse GTF')
 
     args = parser.parse_args()
     if not args.gtf_file:
         parser.print_help()
         exit(1)
-    extract_splice_sites(args.gtf_file, args.verbose)
+    extract_splice_sites(args.gtf_file, args.verbose, args.processes)
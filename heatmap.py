@@ -23,9 +23,75 @@ line:
 We executed:
 gzip -cd all_SRA_introns.tsv.gz | pypy heatmap.py \
     -s index_to_SRA_accession.tsv >table_for_heatmap.tsv
+
+Introns may instead be read from a store written by intron_store.py by
+specifying its path as the argument of --store.
+
+Project accession numbers are coded as integers, and for each chunk of
+introns, the number of junctions found in each project is counted for each
+number of samples in which a junction is found. Only nonzero counts are kept,
+as (project, number of samples, number of junctions) triples coded as
+positions in a dense matrix with a row for each project and a column for each
+number of samples from 0 to --sample-count; the matrix is allocated once, and
+the counts are added into it in place. A junction found in more than
+--sample-count samples is counted in the last column, which does not change
+the count for any threshold up to 1. Counts of junctions found in at least
+each number of samples are then obtained with one reverse cumulative sum
+along rows, so every threshold column is a single lookup. Projects are
+written in order of their smallest sample indexes. Requires NumPy.
+
+Introns may also be read from a file specified as the argument of --input
+that is either uncompressed or compressed with bgzip. If --processes is
+greater than 1, the input is divided into ranges as described in
+intron_tasks.py, and a pool of worker processes counts each range's
+junctions and returns only its nonzero triples, which are added into the
+matrix, so output is the same for any number of processes.
 """
 import sys
-from collections import defaultdict
+import multiprocessing
+import numpy as np
+import annotation_report
+import intron_tasks
+
+def chunk_histogram(chunk, project_codes, project_count, column_count):
+    """ Counts junctions of an IntronChunk by project and number of samples
+
+        chunk: IntronChunk
+        project_codes: NumPy array mapping sample indexes to project codes
+        project_count: number of projects
+        column_count: number of columns of histogram; junctions found in
+            more samples are counted in the last column
+
+        Return value: tuple (NumPy array of sorted positions in flattened
+            histogram, NumPy array of numbers of junctions at those
+            positions); histogram element (i, j) is number of junctions found
+            in j samples that are found in project i, and only nonzero
+            elements are included
+    """
+    if not len(chunk.samples):
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    unknown = chunk.samples >= len(project_codes)
+    if not np.any(unknown):
+        unknown = project_codes[chunk.samples] < 0
+    if np.any(unknown):
+        raise RuntimeError(
+                'Sample index {} has no project.'.format(
+                        chunk.samples[unknown][0]
+                    )
+            )
+    # Each junction counts once for each project among its samples
+    row_projects = np.unique(
+            chunk.rows() * project_count + project_codes[chunk.samples]
+        )
+    sample_counts = np.minimum(
+            chunk.sample_counts()[row_projects // project_count],
+            column_count - 1
+        )
+    positions, inverse = np.unique(
+            (row_projects % project_count) * column_count + sample_counts,
+            return_inverse=True
+        )
+    return positions, np.bincount(inverse).astype(np.int64)
 
 if __name__ == '__main__':
     import argparse
@@ -52,38 +118,85 @@ if __name__ == '__main__':
     parser.add_argument('--sample-count', type=int,
         default=21504,
         help='total number of SRA samples analyzed')
+    parser.add_argument('--store', type=str, required=False,
+        default=None,
+        help='path to intron store written by intron_store.py; read instead '
+             'of stdin if specified')
+    parser.add_argument('--input', type=str, required=False,
+        default=None,
+        help='path to uncompressed or bgzipped introns; read instead of '
+             'stdin if specified')
+    parser.add_argument('-p', '--processes', type=int, required=False,
+        default=1,
+        help='number of processes among which to divide input')
     args = parser.parse_args()
 
-    index_to_project = {}
-    with open(args.sra) as sra_stream:
-        for line in sra_stream:
-            tokens = line.strip().split('\t')
-            index_to_project[tokens[0]] = tokens[1]
-
-    projects = defaultdict(dict)
-    for line in sys.stdin:
-        tokens = line.strip().split('\t')
-        samples = tokens[-2].strip().split(',')
-        sample_count = len(samples)
-        projects_to_increment = set([index_to_project[sample]
-                                        for sample in samples])
-        for project in projects_to_increment:
-            try:
-                projects[project][sample_count] += 1
-            except KeyError:
-                projects[project][sample_count] = 1
+    project_names, project_codes = annotation_report.accession_codes(
+            annotation_report.load_sra_index(args.sra)[0]
+        )
+
+    # Rows are projects; columns are numbers of samples
+    histogram = np.zeros((len(project_names), args.sample_count + 1),
+                            dtype=np.int64)
+
+    def task_histogram(task):
+        """ Return value: tuple (positions, numbers of junctions) as from
+                chunk_histogram() for a task from intron_tasks.tasks()
+        """
+        positions, junction_counts = [], []
+        for chunk in intron_tasks.task_chunks(task):
+            chunk_positions, chunk_junction_counts = chunk_histogram(
+                    chunk, project_codes, len(project_names),
+                    histogram.shape[1]
+                )
+            positions.append(chunk_positions)
+            junction_counts.append(chunk_junction_counts)
+        if not positions:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        positions, inverse = np.unique(np.concatenate(positions),
+                                        return_inverse=True)
+        return positions, np.bincount(
+                inverse, weights=np.concatenate(junction_counts)
+            ).astype(np.int64)
+
+    def add_task_histogram(task_result):
+        """ Adds numbers of junctions from task_histogram() into histogram
+
+            No return value.
+        """
+        # Positions are distinct, so they are added in place
+        histogram.ravel()[task_result[0]] += task_result[1]
+
+    tasks = intron_tasks.tasks(args.store, args.input, sys.stdin,
+                                args.processes * 4)
+    if args.processes > 1:
+        pool = multiprocessing.Pool(args.processes)
+        try:
+            for task_result in pool.imap_unordered(task_histogram, tasks):
+                add_task_histogram(task_result)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for task in tasks:
+            add_task_histogram(task_histogram(task))
 
     # Dump results; first comes the header line
     thresholds = [args.threshold_interval * i + args.min_threshold
         for i in xrange(int((args.max_threshold - args.min_threshold)
                                 / args.threshold_interval) + 1)]
-    sample_thresholds = [round(float(args.sample_count) * threshold)
-                            for threshold in thresholds]
+    sample_thresholds = np.array(
+            [round(float(args.sample_count) * threshold)
+                for threshold in thresholds]
+        )
+    # at_least[:, i] is number of junctions found in at least i samples
+    at_least = np.zeros((len(project_names), histogram.shape[1] + 1),
+                            dtype=np.int64)
+    at_least[:, :-1] = np.cumsum(histogram[:, ::-1], axis=1)[:, ::-1]
+    columns = np.clip(np.ceil(sample_thresholds), 0,
+                        histogram.shape[1]).astype(np.int64)
     print ('\t'.join([''] + ['%.5f' % threshold for threshold in thresholds]))
-    for project in projects:
-        print '\t'.join([project]
-                        + [str(sum(intron_count
-                                for sample_count, intron_count
-                                in projects[project].items()
-                                if sample_count >= threshold))
-                            for threshold in sample_thresholds])
+    for code in np.flatnonzero(histogram.sum(axis=1)).tolist():
+        print '\t'.join([project_names[code]]
+                        + [str(count) for count
+                            in at_least[code, columns].tolist()])
@@ -0,0 +1,426 @@
+#!/usr/bin/env python
+"""
+intron_store.py
+Part of SRA project
+
+Converts introns from stdin into a columnar binary store that can be opened
+with memory maps, and provides a reader for it. Scanning the store costs a
+sequential pass over a few arrays rather than decompressing and tokenizing
+every line of all_SRA_introns.tsv.gz again.
+
+Input lines may have either of two formats. all_SRA_introns.tsv.gz, the output
+of combine.py, has the following tab-separated fields on each line:
+1. chromosome
+2. start position
+3. end position
+4. strand
+5. start motif (e.g., GT)
+6. end motif (e.g., AG)
+7. comma-separated list of sample indexes in which junction was found
+8. comma-separated list of numbers of reads in each corresponding sample from
+    field 7
+Any fields after the eighth (e.g., those added by add_ann.py) are ignored.
+Rail-RNA's "itn" deliverable has the following tab-separated fields:
+1. Strand (e.g., chr1+)
+2. Intron start position
+3. Intron end position
+4. Comma-separated list of sample indexes
+5. Comma-separated list of numbers of reads in which intron was initially
+detected in samples from 4)
+
+A store is a directory with the following files. Sample indexes and coverages
+are laid out in compressed sparse row (CSR) form: those of intron i occupy
+positions indptr[i] through indptr[i+1] - 1 of samples.bin and coverages.bin.
+    meta.json: intron count, entry count, sample index count, reference
+        names, and motif names
+    chrom.bin: uint16 codes into reference names
+    start.bin: int32 start positions
+    end.bin: int32 end positions
+    strand.bin: uint8 codes into '+-'
+    start_motif.bin, end_motif.bin: uint8 codes into motif names
+    indptr.bin: int64 offsets into samples.bin and coverages.bin
+    samples.bin: uint16 sample indexes
+    coverages.bin: uint32 numbers of reads
+
+We executed:
+gzip -cd all_SRA_introns.tsv.gz | python intron_store.py \
+    --store all_SRA_introns.store
+Scripts that read all_SRA_introns.tsv.gz from stdin accept the store as an
+alternative input via their --store command-line parameters.
+"""
+import sys
+import os
+import json
+import numpy as np
+
+_FORMAT_VERSION = 1
+# Per-intron and per-entry arrays, respectively, and their dtypes
+_INTRON_FIELDS = [('chrom', np.uint16), ('start', np.int32),
+                  ('end', np.int32), ('strand', np.uint8),
+                  ('start_motif', np.uint8), ('end_motif', np.uint8)]
+_ENTRY_FIELDS = [('samples', np.uint16), ('coverages', np.uint32)]
+# '.' is the strand of an intron whose line has none; see parse_lines()
+STRANDS = '+-.'
+_STRAND_CODES = dict((strand, code)
+                        for code, strand in enumerate(STRANDS[:2]))
+
+def _code(names, codes, name, limit):
+    """ Assigns a code to a name, registering the name if it is new.
+
+        names: list of names; code of a name is its index in the list
+        codes: dictionary mapping names to codes
+        name: name to look up
+        limit: number of codes available
+
+        Return value: code of name
+    """
+    try:
+        return codes[name]
+    except KeyError:
+        if len(names) >= limit:
+            raise RuntimeError(
+                    'More than {} distinct values encountered; '
+                    'cannot encode "{}".'.format(limit, name)
+                )
+        codes[name] = len(names)
+        names.append(name)
+        return codes[name]
+
+class IntronChunk(object):
+    """ Block of consecutive introns held as parallel arrays.
+
+        chrom, start_motif and end_motif are codes into chrom_names and
+        motif_names, and strand is a code into STRANDS. The sample indexes
+        and coverages of intron i are samples[indptr[i]:indptr[i+1]] and
+        coverages[indptr[i]:indptr[i+1]].
+    """
+    def __init__(self, chrom_names, motif_names, chrom, start, end, strand,
+                    start_motif, end_motif, indptr, samples, coverages):
+        self.chrom_names = chrom_names
+        self.motif_names = motif_names
+        self.chrom = chrom
+        self.start = start
+        self.end = end
+        self.strand = strand
+        self.start_motif = start_motif
+        self.end_motif = end_motif
+        self.indptr = indptr
+        self.samples = samples
+        self.coverages = coverages
+
+    def __len__(self):
+        return len(self.start)
+
+    def sample_counts(self):
+        """ Return value: array with number of samples for each intron """
+        return np.diff(self.indptr)
+
+    def rows(self):
+        """ Return value: array with intron offset for each entry of samples
+        """
+        return np.repeat(np.arange(len(self), dtype=np.int64),
+                            self.sample_counts())
+
+    def records(self):
+        """ Yields introns as tuples of Python objects.
+
+            Each tuple is (chromosome, start position, end position, strand,
+            start motif, end motif, list of sample indexes, list of
+            coverages).
+        """
+        chroms = [self.chrom_names[code] for code in self.chrom.tolist()]
+        starts, ends = self.start.tolist(), self.end.tolist()
+        strands = [STRANDS[code] for code in self.strand.tolist()]
+        start_motifs = [self.motif_names[code]
+                            for code in self.start_motif.tolist()]
+        end_motifs = [self.motif_names[code]
+                            for code in self.end_motif.tolist()]
+        bounds = self.indptr.tolist()
+        samples, coverages = self.samples.tolist(), self.coverages.tolist()
+        for i in xrange(len(starts)):
+            yield (chroms[i], starts[i], ends[i], strands[i],
+                    start_motifs[i], end_motifs[i],
+                    samples[bounds[i]:bounds[i+1]],
+                    coverages[bounds[i]:bounds[i+1]])
+
+def _split_line(line):
+    """ Splits an input line into its intron fields.
+
+        line: line in all_SRA_introns or "itn" format; see docstring
+
+        Return value: tuple (chromosome, start position string, end position
+            string, strand, start motif, end motif, sample index string,
+            coverage string); motifs are empty for "itn" lines, and the
+            strand is empty if it is not appended to the chromosome
+    """
+    tokens = line.strip().split('\t')
+    if len(tokens) >= 8:
+        return tuple(tokens[:8])
+    if tokens[0][-1] in STRANDS:
+        return (tokens[0][:-1], tokens[1], tokens[2], tokens[0][-1], '', '',
+                    tokens[-2], tokens[-1])
+    return (tokens[0], tokens[1], tokens[2], '', '', '',
+                tokens[-2], tokens[-1])
+
+def tsv_records(stream):
+    """ Yields introns from text lines as tuples of Python objects.
+
+        stream: iterable of lines in all_SRA_introns or "itn" format
+
+        Yields the same tuples as IntronChunk.records().
+    """
+    for line in stream:
+        if not line.strip(): continue
+        (chrom, start, end, strand, start_motif, end_motif,
+            samples, coverages) = _split_line(line)
+        yield (chrom, int(start), int(end), strand, start_motif, end_motif,
+                [int(sample) for sample in samples.split(',')],
+                [int(coverage) for coverage in coverages.split(',')])
+
+def format_record(record):
+    """ Formats a tuple from records() as a line of all_SRA_introns.tsv.gz
+
+        record: tuple yielded by records()
+
+        Return value: line without newline
+    """
+    return '\t'.join([record[0], str(record[1]), str(record[2]), record[3],
+                        record[4], record[5],
+                        ','.join([str(sample) for sample in record[6]]),
+                        ','.join([str(coverage) for coverage in record[7]])])
+
+def parse_lines(lines, strand_required=True):
+    """ Parses text lines into an IntronChunk.
+
+        lines: list of lines in all_SRA_introns or "itn" format
+        strand_required: False iff a line without a strand, such as a line
+            whose chromosome has no +/- suffix and that has fewer than eight
+            fields, is accepted; its intron gets the strand '.'. Only
+            consumers that never read strands should pass False.
+
+        Return value: IntronChunk; its reference and motif names are local to
+            the chunk
+    """
+    chrom_names, chrom_codes, motif_names, motif_codes = [], {}, [], {}
+    chrom, start, end, strand, start_motif, end_motif, counts = (
+            [] for _ in xrange(7)
+        )
+    sample_fields, coverage_fields = [], []
+    for line in lines:
+        if not line.strip(): continue
+        fields = _split_line(line)
+        chrom.append(_code(chrom_names, chrom_codes, fields[0], 1 << 16))
+        start.append(fields[1])
+        end.append(fields[2])
+        try:
+            strand.append(_STRAND_CODES[fields[3]])
+        except KeyError:
+            if strand_required:
+                raise RuntimeError(
+                        'Line "{}" has no strand.'.format(line.strip())
+                    )
+            strand.append(STRANDS.index('.'))
+        start_motif.append(_code(motif_names, motif_codes, fields[4], 1 << 8))
+        end_motif.append(_code(motif_names, motif_codes, fields[5], 1 << 8))
+        counts.append(fields[6].count(',') + 1)
+        sample_fields.append(fields[6])
+        coverage_fields.append(fields[7])
+    indptr = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    if counts:
+        samples = np.fromstring(','.join(sample_fields),
+                                    dtype=np.int64, sep=',')
+        coverages = np.fromstring(','.join(coverage_fields),
+                                    dtype=np.int64, sep=',')
+    else:
+        samples = np.zeros(0, dtype=np.int64)
+        coverages = np.zeros(0, dtype=np.int64)
+    assert len(samples) == len(coverages) == indptr[-1]
+    return IntronChunk(chrom_names, motif_names,
+                        np.array(chrom, dtype=np.uint16),
+                        np.array(start, dtype=np.int64),
+                        np.array(end, dtype=np.int64),
+                        np.array(strand, dtype=np.uint8),
+                        np.array(start_motif, dtype=np.uint8),
+                        np.array(end_motif, dtype=np.uint8),
+                        indptr, samples, coverages)
+
+def line_batches(stream, chunk_size=100000):
+    """ Yields lists of at most chunk_size nonblank lines from stream
+
+        stream: iterator over lines
+        chunk_size: number of lines to read at a time
+    """
+    while True:
+        lines = [line for line in
+                    (next(stream, None) for _ in xrange(chunk_size))
+                    if line is not None]
+        if not lines: break
+        lines = [line for line in lines if line.strip()]
+        if lines:
+            yield lines
+
+def tsv_chunks(stream, chunk_size=100000):
+    """ Yields IntronChunks parsed from text lines
+
+        stream: iterator over lines in all_SRA_introns or "itn" format
+        chunk_size: number of lines to parse at a time
+    """
+    for lines in line_batches(stream, chunk_size):
+        yield parse_lines(lines)
+
+def write_store(stream, path, chunk_size=100000):
+    """ Converts text lines into a store.
+
+        stream: iterable of lines in all_SRA_introns or "itn" format
+        path: directory to which store should be written; created if it
+            does not exist
+        chunk_size: number of lines to parse at a time
+
+        Return value: number of introns written
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+    handles = dict(
+            (field, open(os.path.join(path, field + '.bin'), 'wb'))
+            for field, _ in _INTRON_FIELDS + _ENTRY_FIELDS + [('indptr', None)]
+        )
+    chrom_names, chrom_codes, motif_names, motif_codes = [], {}, [], {}
+    intron_count, entry_count, sample_index_count = 0, 0, 0
+    np.zeros(1, dtype=np.int64).tofile(handles['indptr'])
+    try:
+        for chunk in tsv_chunks(stream, chunk_size):
+            # Translate chunk-local codes into store-wide codes
+            chrom_map = np.array([_code(chrom_names, chrom_codes, name,
+                                        1 << 16)
+                                    for name in chunk.chrom_names],
+                                    dtype=np.uint16)
+            motif_map = np.array([_code(motif_names, motif_codes, name,
+                                        1 << 8)
+                                    for name in chunk.motif_names],
+                                    dtype=np.uint8)
+            for values, dtype, name in [
+                    (chunk.start, np.int32, 'start position'),
+                    (chunk.end, np.int32, 'end position'),
+                    (chunk.samples, np.uint16, 'sample index'),
+                    (chunk.coverages, np.uint32, 'coverage')
+                ]:
+                if len(values) and (values.min() < 0
+                                    or values.max() > np.iinfo(dtype).max):
+                    raise RuntimeError(
+                            'A {} is out of range for the store.'.format(name)
+                        )
+            chrom_map[chunk.chrom].tofile(handles['chrom'])
+            chunk.start.astype(np.int32).tofile(handles['start'])
+            chunk.end.astype(np.int32).tofile(handles['end'])
+            chunk.strand.tofile(handles['strand'])
+            motif_map[chunk.start_motif].tofile(handles['start_motif'])
+            motif_map[chunk.end_motif].tofile(handles['end_motif'])
+            (chunk.indptr[1:] + entry_count).tofile(handles['indptr'])
+            chunk.samples.astype(np.uint16).tofile(handles['samples'])
+            chunk.coverages.astype(np.uint32).tofile(handles['coverages'])
+            intron_count += len(chunk)
+            entry_count += int(chunk.indptr[-1])
+            sample_index_count = max(sample_index_count,
+                                        int(chunk.samples.max()) + 1)
+    finally:
+        for handle in handles.values():
+            handle.close()
+    # Metadata is written last so an interrupted conversion is unreadable
+    with open(os.path.join(path, 'meta.json'), 'w') as meta_stream:
+        json.dump({'version' : _FORMAT_VERSION,
+                   'intron_count' : intron_count,
+                   'entry_count' : entry_count,
+                   'sample_index_count' : sample_index_count,
+                   'chrom_names' : chrom_names,
+                   'motif_names' : motif_names}, meta_stream)
+    return intron_count
+
+class IntronStore(object):
+    """ Memory-maps a store written by write_store().
+
+        Per-intron arrays are attributes chrom, start, end, strand,
+        start_motif, end_motif and indptr; per-entry arrays are attributes
+        samples and coverages. None of them is read into memory until
+        accessed.
+    """
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(os.path.join(path, 'meta.json')) as meta_stream:
+                meta = json.load(meta_stream)
+        except IOError:
+            raise RuntimeError('No intron store at "{}".'.format(path))
+        if meta['version'] != _FORMAT_VERSION:
+            raise RuntimeError(
+                    'Intron store at "{}" has version {}, but version {} '
+                    'is required.'.format(path, meta['version'],
+                                            _FORMAT_VERSION)
+                )
+        self.intron_count = meta['intron_count']
+        self.entry_count = meta['entry_count']
+        self.sample_index_count = meta['sample_index_count']
+        self.chrom_names = [str(name) for name in meta['chrom_names']]
+        self.motif_names = [str(name) for name in meta['motif_names']]
+        for field, dtype in _INTRON_FIELDS:
+            setattr(self, field, self._map(field, dtype, self.intron_count))
+        for field, dtype in _ENTRY_FIELDS:
+            setattr(self, field, self._map(field, dtype, self.entry_count))
+        self.indptr = self._map('indptr', np.int64, self.intron_count + 1)
+
+    def _map(self, field, dtype, count):
+        """ Memory-maps one array of the store.
+
+            field: name of array
+            dtype: NumPy dtype of array
+            count: number of elements in array
+
+            Return value: read-only array
+        """
+        if not count:
+            # mmap cannot map empty files
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(os.path.join(self.path, field + '.bin'),
+                            dtype=dtype, mode='r', shape=(count,))
+
+    def __len__(self):
+        return self.intron_count
+
+    def chunk(self, start, stop):
+        """ Return value: IntronChunk with introns on [start, stop) """
+        stop = min(stop, self.intron_count)
+        first, last = int(self.indptr[start]), int(self.indptr[stop])
+        return IntronChunk(self.chrom_names, self.motif_names,
+                            self.chrom[start:stop], self.start[start:stop],
+                            self.end[start:stop], self.strand[start:stop],
+                            self.start_motif[start:stop],
+                            self.end_motif[start:stop],
+                            self.indptr[start:stop+1] - first,
+                            self.samples[first:last],
+                            self.coverages[first:last])
+
+    def chunks(self, chunk_size=100000):
+        """ Yields consecutive IntronChunks of at most chunk_size introns """
+        for start in xrange(0, self.intron_count, chunk_size):
+            yield self.chunk(start, start + chunk_size)
+
+    def records(self, chunk_size=100000):
+        """ Yields every intron as in IntronChunk.records() """
+        for chunk in self.chunks(chunk_size):
+            for record in chunk.records():
+                yield record
+
+if __name__ == '__main__':
+    import argparse
+    # Print file's docstring if -h is invoked
+    parser = argparse.ArgumentParser(description=__doc__,
+                formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--store', type=str, required=True,
+        help='path to directory in which store should be written')
+    parser.add_argument('--chunk-size', type=int, required=False,
+        default=100000,
+        help='number of input lines to parse at a time')
+    args = parser.parse_args()
+    intron_count = write_store(iter(sys.stdin), args.store, args.chunk_size)
+    sys.stderr.write('Wrote {} intron(s) to "{}".\n'.format(intron_count,
+                                                              args.store))
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+"""
+intron_tasks.py
+Part of SRA project
+
+Divides introns into tasks that can be read independently, so that a pool of
+processes can each build partial results from a share of all_SRA_introns.tsv.gz
+to be merged at the end. Introns may come from any of three sources:
+    1) A store written by intron_store.py, which is divided into ranges of
+        introns.
+    2) A file in all_SRA_introns or "itn" format that is either uncompressed
+        or compressed with bgzip. An uncompressed file is divided into byte
+        ranges and a bgzipped file into ranges of BGZF blocks, each of which
+        is an independent gzip member, so every task decompresses only its own
+        blocks and those holding the end of its last line.
+    3) A stream of lines such as stdin, which is divided into batches of
+        lines. These are read by the process that creates the tasks and are
+        part of the tasks themselves.
+Tasks are picklable tuples; task_chunks() yields the IntronChunks of a task.
+"""
+import os
+import struct
+import zlib
+import intron_store
+
+_BGZF_MAGIC = b'\x1f\x8b\x08\x04'
+# Maximum size of the range of a file read by one task
+_TASK_BYTES = 1 << 25
+
+def _bgzf_block_size(bgzf_stream, offset):
+    """ Reads the size of the BGZF block at an offset
+
+        bgzf_stream: file object opened for binary reading
+        offset: offset of block
+
+        Return value: size of block, or None if there is no BGZF block at
+            offset
+    """
+    bgzf_stream.seek(offset)
+    header = bgzf_stream.read(12)
+    if len(header) < 12 or header[:4] != _BGZF_MAGIC:
+        return None
+    extra = bgzf_stream.read(struct.unpack('<H', header[10:12])[0])
+    position = 0
+    while position + 4 <= len(extra):
+        subfield_length = struct.unpack(
+                '<H', extra[position + 2:position + 4]
+            )[0]
+        if extra[position:position + 2] == b'BC' and subfield_length == 2:
+            return struct.unpack('<H', extra[position + 4:position + 6])[0] + 1
+        position += 4 + subfield_length
+    return None
+
+def bgzf_blocks(path):
+    """ Finds offsets of BGZF blocks in a file compressed with bgzip
+
+        Only block headers are read.
+
+        path: path to file
+
+        Return value: list of offsets of blocks followed by size of file, or
+            None if the file is not compressed with bgzip
+    """
+    size = os.path.getsize(path)
+    offsets = []
+    with open(path, 'rb') as bgzf_stream:
+        offset = 0
+        while offset < size:
+            block_size = _bgzf_block_size(bgzf_stream, offset)
+            if block_size is None:
+                return None
+            offsets.append(offset)
+            offset += block_size
+    offsets.append(size)
+    return offsets
+
+def _inflate(data):
+    """ Return value: decompressed contents of concatenated gzip members """
+    inflated = []
+    while data:
+        decompressor = zlib.decompressobj(31)
+        inflated.append(decompressor.decompress(data))
+        data = decompressor.unused_data
+    return b''.join(inflated)
+
+def _range_data(path, start, end):
+    """ Reads the lines of a file that start in a range
+
+        A task that does not start at the beginning of the file skips through
+        the first newline in its range, and every task reads through the first
+        newline after its range, so each line is read by exactly one task.
+
+        path: path to uncompressed or bgzipped file
+        start, end: range is [start, end); offsets are of BGZF blocks if the
+            file is bgzipped
+
+        Return value: contents of lines
+    """
+    with open(path, 'rb') as range_stream:
+        bgzf = _bgzf_block_size(range_stream, 0) is not None
+        range_stream.seek(start)
+        data = range_stream.read(end - start)
+        if bgzf:
+            data = _inflate(data)
+            tail, offset = [], end
+            while True:
+                block_size = _bgzf_block_size(range_stream, offset)
+                if block_size is None:
+                    break
+                range_stream.seek(offset)
+                block = _inflate(range_stream.read(block_size))
+                offset += block_size
+                newline = block.find(b'\n')
+                if newline >= 0:
+                    tail.append(block[:newline + 1])
+                    break
+                tail.append(block)
+            data += b''.join(tail)
+        else:
+            data += range_stream.readline()
+    if start:
+        data = data.partition(b'\n')[2]
+    return data
+
+def tasks(store=None, path=None, stream=None, task_count=1,
+            chunk_size=100000):
+    """ Divides introns into tasks
+
+        Exactly one of store, path, and stream should be specified.
+
+        store: path to store written by intron_store.py
+        path: path to uncompressed or bgzipped file of introns
+        stream: iterator over lines of introns
+        task_count: number of tasks into which to divide a store or file;
+            a file is divided into more tasks if needed so that each reads at
+            most 32 MB of it
+        chunk_size: number of lines in each task read from stream
+
+        Return value: iterable of tasks
+    """
+    if store is not None:
+        intron_count = len(intron_store.IntronStore(store))
+        bounds = [intron_count * i // task_count
+                    for i in range(task_count + 1)]
+        return [('store', store, bounds[i], bounds[i + 1])
+                    for i in range(task_count) if bounds[i] < bounds[i + 1]]
+    if path is not None:
+        with open(path, 'rb') as input_stream:
+            magic = input_stream.read(2)
+        task_count = max(task_count,
+                            -(-os.path.getsize(path) // _TASK_BYTES))
+        if magic == b'\x1f\x8b':
+            offsets = bgzf_blocks(path)
+            if offsets is None:
+                raise RuntimeError(
+                        '"{}" is compressed with gzip but not bgzip; '
+                        'recompress it with bgzip or decompress it.'.format(
+                                path
+                            )
+                    )
+            block_count = len(offsets) - 1
+            bounds = [offsets[block_count * i // task_count]
+                        for i in range(task_count + 1)]
+        else:
+            size = os.path.getsize(path)
+            bounds = [size * i // task_count for i in range(task_count + 1)]
+        return [('file', path, bounds[i], bounds[i + 1])
+                    for i in range(task_count) if bounds[i] < bounds[i + 1]]
+    return (('lines', lines)
+                for lines in intron_store.line_batches(stream, chunk_size))
+
+def task_chunks(task, chunk_size=100000, strand_required=True):
+    """ Yields IntronChunks of at most chunk_size introns from a task
+
+        task: task from tasks()
+        chunk_size: number of introns in each chunk
+        strand_required: False iff lines without strands are accepted; see
+            intron_store.parse_lines()
+    """
+    if task[0] == 'store':
+        store = intron_store.IntronStore(task[1])
+        for start in range(task[2], task[3], chunk_size):
+            yield store.chunk(start, min(start + chunk_size, task[3]))
+        return
+    if task[0] == 'lines':
+        yield intron_store.parse_lines(task[1], strand_required)
+        return
+    data = _range_data(*task[1:])
+    if not isinstance(data, str):
+        data = data.decode('ascii')
+    lines = data.splitlines()
+    for start in range(0, len(lines), chunk_size):
+        yield intron_store.parse_lines(lines[start:start + chunk_size],
+                                        strand_required)
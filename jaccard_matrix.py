@@ -3,8 +3,6 @@ jaccard_matrix.py
 Part of SRA project
 
 Constructs Jaccard similarity matrix for intron sets across sample indexes.
-Uses twice as much memory as it needs to constructing a symmetric matrix, but
-who cares?
 
 Input (tab-delimited fields; read from file):
 1) Strand (e.g., chr1+)
@@ -19,15 +17,55 @@ Tab-delimited output:
 2) Second sample index
 3) Jaccard index
 
-The input is in exactly the same format as Rail-RNA's "itn" deliverable.
+The input is in exactly the same format as Rail-RNA's "itn" deliverable. The
+first line of output is a semicolon-separated list of sample indexes filtered
+out for having too few introns.
+
+Intersections are computed from a sparse matrix X whose rows are samples and
+whose columns are introns: the number of introns in common between each pair of
+samples is an element of X X^T. The input is read once: workers parse chunks
+of input lines into the nonzero entries of X, from which the numbers of
+introns per sample are counted and X is built once after samples are
+filtered. A new pool of workers is then forked so that all workers share X.
+The rows of the upper triangle of X X^T are divided into one range per
+worker, with about the same number of pairs of samples in each range, and
+each worker computes its range from X in blocks of --block-size rows and
+returns it once as a condensed array; together, the arrays of all workers are
+the condensed array of intersections. Unions are computed from numbers of
+introns per sample minus intersections. Requires NumPy and SciPy.
+
+If --tiled is specified, the Jaccard matrix is computed --tile-size rows at a
+time, with the rows of each tile divided among workers as above, so only the
+intersections of one tile are ever held in memory. Jaccard indexes are
+written with single precision to a store that can be read without loading
+the whole matrix and exported as text with jaccard_store.py.
+
+If --approximate is specified, the Jaccard matrix is instead estimated with
+MinHash signatures computed in a single pass over the input. Each intron is
+keyed on its chromosome, start position, and end position, with only the
+chromosome name (which includes the strand) reduced to its CRC-32 checksum,
+and --signature-length universal hash functions of these three numbers
+modulo the Mersenne prime 2^31 - 1 are applied to the key. Distinct introns
+thus collide under each hash function independently with probability
+2^-31 rather than being merged by every hash function. Each sample's
+signature is the list of minima of the hash functions over its introns. The
+fraction of hash functions on which two samples' signatures agree is an
+unbiased estimate of their Jaccard index J with standard error
+sqrt(J(1-J)/K) <= 1/(2 sqrt(K)), where K is the signature length. Signatures
+are divided into --bands bands, and only pairs of samples whose signatures
+agree on all of some band are considered (locality-sensitive hashing). Only
+pairs of distinct samples with estimated Jaccard index at least --min-jaccard
+are written, with the estimated Jaccard index in place of the exact one.
 """
 import sys
 import multiprocessing # faster faster
-from threading import Thread
 import time
 import signal
-from collections import defaultdict
-from itertools import combinations_with_replacement
+import random
+import zlib
+import numpy as np
+from scipy import sparse
+from jaccard_store import condensed_index, JaccardStoreWriter
 
 def init_worker():
     """ Prevents KeyboardInterrupt from reaching a pool's workers.
@@ -40,80 +78,345 @@ def init_worker():
     """
     signal.signal(signal.SIGINT, signal.SIG_IGN)
 
-def count_listener(q, intron_counts):
-    """ Accumulates intron counts.
+def sample_indexes(lines):
+    """ Gets sample indexes from intron lines
 
-        q: queue with sample indexes
-        intron_counts: defaultdict mapping sample indexes to intron counts
+        lines: iterable of some subset of lines input from stdin
 
-        No return value.
+        Return value: tuple (NumPy array of sample indexes in which introns
+            were found, NumPy array of corresponding intron positions in
+            lines)
     """
-    last_index = q.get()
-    while last_index != -1:
-        intron_counts[last_index] += 1
-        last_index = q.get()
+    found_indexes, introns = [], []
+    for i, line in enumerate(lines):
+        if not line: continue
+        tokens = line.strip().split('\t')
+        indexes = [int(index) for index in tokens[3].split(',')]
+        found_indexes.extend(indexes)
+        introns.extend([i]*len(indexes))
+    return (np.array(found_indexes, dtype=np.int64),
+                np.array(introns, dtype=np.int64))
 
-def matrix_listener(q, matrix):
-    """ Accumulates intersections across samples.
+def incidences(lines, first_intron=0):
+    """ Finds nonzero entries of incidence matrix X from intron lines
 
-        q: queue with sample indexes
-        matrix: matrix i for which i[k][l] is the number of introns in
-            common between samples k and l, or matrix u for which u[k][l] is
-            the number of introns found in either sample k or sample l
+        lines: iterable of some subset of lines input from stdin
+        first_intron: column of X of intron on first line
 
-        No return value.
+        Return value: tuple (NumPy int32 array of sample indexes in which
+            introns were found, NumPy int32 array of corresponding columns
+            of X)
+    """
+    found_indexes, introns = sample_indexes(lines)
+    return (found_indexes.astype(np.int32),
+                (introns + first_intron).astype(np.int32))
+
+# Mersenne prime modulus of universal hash functions for MinHash
+_PRIME = (1 << 31) - 1
+# Chromosome, start position, and end position
+_KEY_FIELDS = 3
+
+def hash_coefficients(signature_length, seed=0):
+    """ Draws coefficients of universal hash functions for MinHash
+
+        signature_length: number of hash functions
+        seed: seed of random number generator
+
+        Return value: tuple (NumPy array of multipliers with one row for
+            each of the _KEY_FIELDS fields of an intron key, NumPy array of
+            addends); hash function i maps key x to
+            (sum over j of multipliers[j, i] * x[j] + addends[i]) mod _PRIME
     """
-    last_record = q.get()
-    while last_record != -1:
-        matrix[last_record[1]][last_record[2]] += 1
-        last_record = q.get()
+    generator = random.Random(seed)
+    return (np.array([[generator.randint(1, _PRIME - 1)
+                        for _ in xrange(signature_length)]
+                        for _ in xrange(_KEY_FIELDS)], dtype=np.int64),
+            np.array([generator.randint(0, _PRIME - 1)
+                        for _ in xrange(signature_length)], dtype=np.int64))
 
-def counts(q, lines):
-    """ Finds intron counts across samples
+def intron_keys(lines):
+    """ Keys introns on their chromosomes, start positions, and end positions
 
-        q: queue for accumulating results
         lines: iterable of some subset of lines input from stdin
 
-        Return value: 0 if successful
+        Return value: NumPy array with a row for each line holding the
+            CRC-32 checksum of its chromosome name, its start position, and
+            its end position, each reduced modulo _PRIME; a blank line gets
+            a row of zeros
     """
+    keys = []
     for line in lines:
-        if not line: continue
-        tokens = line.strip().split('\t')
-        for index in tokens[3].split(','):
-            q.put(int(index))
-    return 0
+        if not line:
+            keys.append((0, 0, 0))
+            continue
+        tokens = line.split('\t', 3)
+        keys.append((zlib.crc32(tokens[0]) & 0xffffffff, int(tokens[1]),
+                        int(tokens[2])))
+    return np.array(keys, dtype=np.int64).reshape(-1, _KEY_FIELDS) % _PRIME
 
-def intersections_and_unions(q_i, q_u, lines, forbidden_samples=set(),
-                                sample_count=3000):
-    """ Updates intersections/unions across samples for set of intron lines.
+def minhashes(lines, coefficients, sample_count=3000, block_size=65536):
+    """ Finds intron counts and MinHash signatures across samples
 
-        q_i: queue for accumulating intersections
-        q_u: queue for accumulating unions
         lines: iterable of some subset of lines input from stdin
-        forbidden_samples: set of samples to exclude from consideration
-        sample_count: number of samples
-        
-        Return value: 2-tuple whose elements are lists of lists i and u.
-        i[k][l] is the number of introns in common between samples
-        k and l, and u[k][l] is the number of introns found in either sample k
-        or sample l.
+        coefficients: output of hash_coefficients()
+        sample_count: number of samples; sample indexes beyond it get no
+            signatures
+        block_size: maximum number of (sample, intron) pairs whose hashes
+            are held in memory at once
+
+        Return value: tuple (NumPy array of length at least sample_count
+            whose ith element is the number of introns found in sample i,
+            NumPy array with one row per sample index whose
+            row i is the signature of sample i; a row of a sample in which no
+            introns were found is filled with _PRIME)
     """
-    for line in lines:
-        if not line: continue
-        tokens = line.strip().split('\t')
-        found_indexes = [int(index) for index in tokens[3].split(',')
-                            if index not in forbidden_samples]
-        for i, j in combinations_with_replacement(found_indexes, 2):
-            q_i.put((True, i, j))
-            if i != j:
-                q_i.put((True, j, i))
-        for i in xrange(sample_count):
-            if i in forbidden_samples: continue
-            for j in found_indexes:
-                q_u.put((False, i, j))
-                if i != j:
-                    q_u.put((False, j, i))
-    return 0
+    multipliers, addends = coefficients
+    keys = intron_keys(lines)
+    # Each term is below 2^62, so sums never overflow int64
+    hashes = np.tile(addends, (len(keys), 1))
+    for field in xrange(_KEY_FIELDS):
+        hashes += keys[:, field, None] * multipliers[field] % _PRIME
+        hashes %= _PRIME
+    hashes = hashes.astype(np.uint32)
+    found_indexes, introns = sample_indexes(lines)
+    intron_counts = np.bincount(found_indexes, minlength=sample_count)
+    signatures = np.empty((sample_count, len(addends)), dtype=np.uint32)
+    signatures.fill(_PRIME)
+    kept = found_indexes < sample_count
+    found_indexes, introns = found_indexes[kept], introns[kept]
+    order = np.argsort(found_indexes, kind='mergesort')
+    for start in xrange(0, len(order), block_size):
+        block = order[start:start+block_size]
+        block_indexes = found_indexes[block]
+        boundaries = np.concatenate(
+                ([0], np.flatnonzero(np.diff(block_indexes)) + 1)
+            )
+        block_indexes = block_indexes[boundaries]
+        signatures[block_indexes] = np.minimum(
+                signatures[block_indexes],
+                np.minimum.reduceat(hashes[introns[block]], boundaries,
+                                        axis=0)
+            )
+    return intron_counts, signatures
+
+def choose_bands(signature_length, min_jaccard):
+    """ Chooses number of LSH bands for a similarity cutoff
+
+        The band count b must divide the signature length K. A pair of
+        samples with Jaccard index J agrees on all of some band with
+        probability 1 - (1 - J^r)^b, where r = K/b, which rises most steeply
+        near J = (1/b)^(1/r). The b whose (1/b)^(1/r) is largest but not
+        greater than min_jaccard is chosen so that few pairs above the cutoff
+        are missed.
+
+        signature_length: length of MinHash signatures
+        min_jaccard: minimum Jaccard index of a pair of samples to output
+
+        Return value: number of bands
+    """
+    bands = signature_length
+    for candidate in xrange(1, signature_length + 1):
+        if signature_length % candidate: continue
+        if lsh_threshold(candidate, signature_length) <= min_jaccard:
+            return candidate
+    return bands
+
+def lsh_threshold(bands, signature_length):
+    """ Gets Jaccard index near which LSH candidate probability rises steeply
+
+        bands: number of bands
+        signature_length: length of MinHash signatures
+
+        Return value: (1/b)^(1/r), where b is the number of bands and r is
+            the number of rows per band
+    """
+    return (1.0 / bands)**(float(bands) / signature_length)
+
+def lsh_candidates(signatures, bands):
+    """ Finds pairs of samples whose signatures agree on all of some band
+
+        signatures: NumPy array whose rows are MinHash signatures
+        bands: number of bands into which signatures are divided
+
+        Return value: sorted list of tuples (k, l), k < l, where k and l are
+            row indexes of signatures
+    """
+    rows = signatures.shape[1] // bands
+    candidates = set()
+    for band in xrange(bands):
+        band_signatures = np.ascontiguousarray(
+                signatures[:, band*rows:(band+1)*rows]
+            )
+        band_keys = band_signatures.view(
+                np.dtype((np.void, band_signatures.dtype.itemsize * rows))
+            ).ravel()
+        _, buckets = np.unique(band_keys, return_inverse=True)
+        order = np.argsort(buckets, kind='mergesort')
+        boundaries = np.flatnonzero(np.diff(buckets[order])) + 1
+        for members in np.split(order, boundaries):
+            if len(members) < 2: continue
+            members = sorted(members.tolist())
+            for i, k in enumerate(members):
+                for l in members[i+1:]:
+                    candidates.add((k, l))
+    return sorted(candidates)
+
+def estimated_jaccards(signatures, pairs, block_size=65536):
+    """ Estimates Jaccard indexes of pairs of samples from signatures
+
+        signatures: NumPy array whose rows are MinHash signatures
+        pairs: list of tuples (k, l) of row indexes of signatures
+        block_size: number of pairs to compare at once
+
+        Return value: list of estimated Jaccard indexes of pairs
+    """
+    jaccards = []
+    for start in xrange(0, len(pairs), block_size):
+        block = np.array(pairs[start:start+block_size],
+                            dtype=np.int64).reshape(-1, 2)
+        jaccards.extend((signatures[block[:, 0]]
+                            == signatures[block[:, 1]]).mean(axis=1).tolist())
+    return jaccards
+
+def incidence_matrix(found_indexes, introns, positions, intron_count):
+    """ Builds incidence matrix X of samples under consideration
+
+        found_indexes: NumPy array of sample indexes in which introns were
+            found
+        introns: NumPy array of corresponding columns of X
+        positions: NumPy array whose ith element is the position of sample i
+            among samples under consideration or -1 if sample i should be
+            excluded; sample indexes beyond its end are excluded
+        intron_count: number of columns of X
+
+        Return value: SciPy CSR matrix X whose element (k, l) is 1 if intron
+            l was found in the sample at position k and 0 otherwise
+    """
+    kept_count = int(positions.max()) + 1
+    kept = found_indexes < len(positions)
+    found_indexes, introns = found_indexes[kept], introns[kept]
+    found_positions = positions[found_indexes]
+    kept = found_positions >= 0
+    incidence = sparse.csr_matrix(
+            (np.ones(kept.sum(), dtype=np.uint32),
+                (found_positions[kept], introns[kept])),
+            shape=(kept_count, intron_count)
+        )
+    incidence.sum_duplicates()
+    incidence.data[:] = 1
+    return incidence
+
+def row_ranges(rows, kept_count, range_count):
+    """ Divides rows of intersection matrix into ranges with similar numbers
+        of pairs of samples
+
+        rows: tuple (first row, last row + 1) of intersection matrix to divide
+        kept_count: number of samples under consideration
+        range_count: maximum number of ranges
+
+        Return value: list of tuples (first row, last row + 1)
+    """
+    row_indexes = np.arange(rows[0], rows[1], dtype=np.int64)
+    if not len(row_indexes):
+        return []
+    pair_counts = np.cumsum(kept_count - row_indexes - 1)
+    targets = pair_counts[-1] * np.arange(1, range_count,
+                                            dtype=np.int64) // range_count
+    bounds = sorted(set([rows[0], rows[1]] + (
+            rows[0] + np.searchsorted(pair_counts, targets) + 1
+        ).tolist()))
+    return [(start, stop) for start, stop in zip(bounds, bounds[1:])
+                if start < min(stop, rows[1])]
+
+def range_intersections(incidence, rows, block_size=1024):
+    """ Finds numbers of introns in common for a range of rows of the
+        intersection matrix
+
+        incidence: incidence matrix X from incidence_matrix()
+        rows: tuple (first row, last row + 1) of intersection matrix
+        block_size: number of rows of X X^T to compute at once
+
+        Return value: NumPy uint32 array of condensed upper triangle entries
+            of rows of intersection matrix. Intersection matrix element
+            (k, l) is the number of introns in common between samples at
+            positions k and l.
+    """
+    kept_count = incidence.shape[0]
+    offset = condensed_index(rows[0], rows[0] + 1, kept_count)
+    row_intersections = np.zeros(
+            condensed_index(rows[1], rows[1] + 1, kept_count) - offset,
+            dtype=np.uint32
+        )
+    for start in xrange(rows[0], rows[1], block_size):
+        stop = min(start + block_size, rows[1])
+        block = sparse.triu(
+                incidence[start:stop].dot(incidence[start:].T), k=1
+            )
+        block_rows = block.row.astype(np.int64) + start
+        row_intersections[
+                condensed_index(block_rows, block.col + start, kept_count)
+                - offset
+            ] = block.data
+    return row_intersections
+
+def tile_jaccards(tile_intersections, intron_counts, rows):
+    """ Computes Jaccard indexes for consecutive rows of Jaccard matrix
+
+        tile_intersections: condensed upper triangle entries of rows of
+            intersection matrix
+        intron_counts: NumPy array whose kth element is the number of introns
+            found in the sample at position k
+        rows: tuple (first row, last row + 1) of intersection matrix in
+            tile_intersections
+
+        Return value: NumPy float32 array of condensed upper triangle entries
+            of Jaccard matrix; undefined Jaccard indexes are NaN
+    """
+    kept_count = len(intron_counts)
+    row_indexes = np.arange(rows[0], rows[1], dtype=np.int64)
+    row_lengths = kept_count - row_indexes - 1
+    pair_rows = np.repeat(row_indexes, row_lengths)
+    # Column of each pair is its offset within its row plus row index plus 1
+    row_starts = np.repeat(np.cumsum(row_lengths) - row_lengths, row_lengths)
+    pair_columns = (np.arange(len(pair_rows), dtype=np.int64) - row_starts
+                        + pair_rows + 1)
+    common = tile_intersections.astype(np.int64)
+    unions = (intron_counts[pair_rows] + intron_counts[pair_columns]
+                - common)
+    jaccards = np.empty(len(common), dtype=np.float32)
+    jaccards.fill(np.nan)
+    defined = unions > 0
+    jaccards[defined] = (common[defined].astype(np.float64)
+                            / unions[defined])
+    return jaccards
+
+def jaccard_rows(intersection_matrix, intron_counts, kept_samples):
+    """ Generates rows of Jaccard matrix
+
+        intersection_matrix: condensed upper triangle of intersection
+            matrix as returned by range_intersections() for all rows
+        intron_counts: NumPy array whose ith element is the number of introns
+            found in sample i
+        kept_samples: sorted list of samples under consideration
+
+        Yield value: tuple (sample index, list of samples indexes from
+            kept_samples >= that sample index, list of Jaccard indexes,
+            where None stands for an undefined Jaccard index)
+    """
+    kept_count = len(kept_samples)
+    kept_counts = intron_counts[kept_samples].astype(np.int64)
+    for i, sample in enumerate(kept_samples):
+        start = condensed_index(i, i + 1, kept_count)
+        common = intersection_matrix[
+                start:start + kept_count - i - 1
+            ].astype(np.int64)
+        unions = kept_counts[i] + kept_counts[i+1:] - common
+        jaccards = common / np.maximum(unions, 1).astype(np.float64)
+        yield (sample, kept_samples[i:],
+                [1.0 if kept_counts[i] else None] + [
+                    jaccard if union else None for jaccard, union
+                    in zip(jaccards.tolist(), unions.tolist())
+                ])
 
 if __name__ == '__main__':
     start_time = time.time()
@@ -123,8 +426,7 @@ if __name__ == '__main__':
                 formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument('--sample-count', type=int, required=False,
         default=100,
-        help=('number of samples of all sample indexes to take at each'
-              'sample size'))
+        help='number of samples spanned by sample indexes')
     parser.add_argument('--input', '-i', type=str, required=True,
         help='path to input file')
     parser.add_argument('--filter', type=int, required=False,
@@ -133,32 +435,117 @@ if __name__ == '__main__':
     parser.add_argument('--chunk-size', type=int, required=False,
         default=50000,
         help='number of input lines a thread should analyze at a time')
+    parser.add_argument('--block-size', type=int, required=False,
+        default=1024,
+        help=('number of rows of the intersection matrix a thread should '
+              'compute at a time'))
     parser.add_argument('--num-processes', '-p', type=int, required=False,
         default=None,
         help=('number of processes run simultaneously to analyze chunks; '
               'defaults to number of available processing cores'))
+    parser.add_argument('--tiled', type=str, required=False,
+        default=None,
+        help=('path to directory in which Jaccard matrix should be written '
+              'tile by tile as a store instead of as text; see docstring'))
+    parser.add_argument('--tile-size', type=int, required=False,
+        default=2048,
+        help='number of rows of the Jaccard matrix per tile for --tiled')
+    parser.add_argument('--approximate', action='store_const', const=True,
+        default=False,
+        help=('estimate Jaccard indexes from MinHash signatures and output '
+              'only similar pairs of samples; see docstring'))
+    parser.add_argument('--signature-length', type=int, required=False,
+        default=128,
+        help='number of hash functions in each MinHash signature')
+    parser.add_argument('--bands', type=int, required=False,
+        default=None,
+        help=('number of LSH bands into which signatures are divided; must '
+              'divide --signature-length; defaults to the number whose '
+              'threshold is closest to --min-jaccard from below'))
+    parser.add_argument('--min-jaccard', type=float, required=False,
+        default=0.5,
+        help=('minimum estimated Jaccard index of a pair of samples to '
+              'output in --approximate mode'))
+    parser.add_argument('--seed', type=int, required=False,
+        default=0,
+        help='seed for drawing MinHash hash functions')
     args = parser.parse_args()
+    if args.approximate and args.tiled is not None:
+        raise RuntimeError('--approximate and --tiled are incompatible.')
+    if args.approximate:
+        if args.bands is None:
+            args.bands = choose_bands(args.signature_length, args.min_jaccard)
+        elif args.signature_length % args.bands:
+            raise RuntimeError(
+                    '--bands must divide --signature-length.'
+                )
+        coefficients = hash_coefficients(args.signature_length, args.seed)
     if args.num_processes is None:
         num_processes = multiprocessing.cpu_count()
     else:
         num_processes = args.num_processes
     pool = multiprocessing.Pool(num_processes, init_worker, maxtasksperchild=5)
-    manager = multiprocessing.Manager()
-    q = manager.Queue()
-    intron_counts = defaultdict(int)
+    intron_counts = [np.zeros(args.sample_count, dtype=np.int64)]
     results = []
-    print >>sys.stderr, '\x1b[KCounting introns...'
-    listener = Thread(target=count_listener, args=(q, intron_counts))
-    listener.daemon = True
-    listener.start()
+    def add_counts(chunk_counts):
+        """ Adds intron counts from a chunk to running total
+
+            chunk_counts: NumPy array of intron counts returned by
+                minhashes()
+
+            No return value.
+        """
+        if len(chunk_counts) > len(intron_counts[0]):
+            chunk_counts[:len(intron_counts[0])] += intron_counts[0]
+            intron_counts[0] = chunk_counts
+        else:
+            intron_counts[0][:len(chunk_counts)] += chunk_counts
+        results.append(0)
+    signatures = [None]
+    def add_minhashes(chunk_minhashes):
+        """ Adds intron counts and signatures from a chunk to running totals
+
+            chunk_minhashes: tuple returned by minhashes()
+
+            No return value.
+        """
+        if signatures[0] is None:
+            signatures[0] = chunk_minhashes[1]
+        else:
+            np.minimum(signatures[0], chunk_minhashes[1],
+                        out=signatures[0])
+        add_counts(chunk_minhashes[0])
+    found_indexes, introns = [], []
+    def add_incidences(chunk_incidences):
+        """ Collects nonzero entries of X from a chunk
+
+            chunk_incidences: tuple returned by incidences()
+
+            No return value.
+        """
+        found_indexes.append(chunk_incidences[0])
+        introns.append(chunk_incidences[1])
+        results.append(0)
+    if args.approximate:
+        print >>sys.stderr, ('\x1b[KCounting introns and computing '
+                             'signatures...')
+    else:
+        print >>sys.stderr, '\x1b[KReading introns...'
     with open(args.input) as input_stream:
         to_dispatch = filter(lambda x: x is not None,
                              [next(input_stream, None)
                                 for _ in xrange(args.chunk_size)])
-        dispatch_count, active = 0, 0
+        dispatch_count, active, intron_count = 0, 0, 0
         while to_dispatch:
             len_results_before = len(results)
-            pool.apply_async(counts, [q, to_dispatch], callback=results.append)
+            if args.approximate:
+                pool.apply_async(minhashes,
+                    [to_dispatch, coefficients, args.sample_count],
+                                    callback=add_minhashes)
+            else:
+                pool.apply_async(incidences, [to_dispatch, intron_count],
+                                    callback=add_incidences)
+            intron_count += len(to_dispatch)
             dispatch_count += 1
             active += 1
             while active >= num_processes:
@@ -172,79 +559,176 @@ if __name__ == '__main__':
     while len(results) < dispatch_count:
         sys.stderr.write('\x1b[KChunks processed: %d\r' % len(results))
         time.sleep(0.4)
-    q.put(-1)
-    listener.join()
+    if args.approximate:
+        intron_counts = intron_counts[0]
+    else:
+        pool.close()
+        pool.join()
+        found_indexes = np.concatenate(
+                found_indexes or [np.zeros(0, dtype=np.int32)]
+            )
+        introns = np.concatenate(introns or [np.zeros(0, dtype=np.int32)])
+        intron_counts = np.bincount(found_indexes,
+                                        minlength=args.sample_count)
     process_time = time.time()
     print >>sys.stderr, '\x1b[KChunks processed in %02f s.' % (
                 process_time - start_time
             )
-    forbidden_samples = set(
-                [int(sample_index) for sample_index in intron_counts
-                    if intron_counts[sample_index] < args.filter]
-            )
+    # Samples in which no introns were found are not filtered out
+    forbidden_samples = set(np.flatnonzero(
+                (intron_counts > 0) & (intron_counts < args.filter)
+            ).tolist())
     print >>sys.stderr, '\x1b[K%d samples filtered out.' % len(
                                                             forbidden_samples
                                                         )
+    if args.tiled is None:
+        print ';'.join(map(str, sorted(forbidden_samples)))
+    if args.approximate:
+        print >>sys.stderr, '\x1b[KFinding candidate pairs...'
+        # Samples in which no introns were found have no signatures
+        kept_samples = [i for i in xrange(args.sample_count)
+                            if i not in forbidden_samples
+                            and intron_counts[i]]
+        if signatures[0] is None:
+            signatures[0] = np.zeros((args.sample_count,
+                                        args.signature_length),
+                                        dtype=np.uint32)
+        signatures = signatures[0][kept_samples]
+        pairs = lsh_candidates(signatures, args.bands)
+        jaccards = estimated_jaccards(signatures, pairs)
+        similar_pairs = 0
+        for (k, l), jaccard in zip(pairs, jaccards):
+            if jaccard >= args.min_jaccard:
+                print '%d\t%d\t%.15f' % (
+                        kept_samples[k], kept_samples[l], jaccard
+                    )
+                similar_pairs += 1
+        end_time = time.time()
+        print >>sys.stderr, ('\x1b[K%d of %d candidate pair(s) had estimated '
+                             'Jaccard index at least %f. Signatures of %d '
+                             'hash functions give standard error '
+                             'sqrt(J(1-J)/%d) <= %f; %d band(s) of %d '
+                             'row(s) have threshold %f.') % (
+                                    similar_pairs, len(pairs),
+                                    args.min_jaccard, args.signature_length,
+                                    args.signature_length,
+                                    0.5 / args.signature_length**0.5,
+                                    args.bands,
+                                    args.signature_length // args.bands,
+                                    lsh_threshold(args.bands,
+                                                    args.signature_length)
+                                )
+        print >>sys.stderr, ('\x1b[KOutput computed and written in %02f s. '
+                             'Entire job finished in %02f s.') % (
+                                    end_time - process_time,
+                                    end_time - start_time
+                                )
+        sys.exit(0)
     print >>sys.stderr, '\x1b[KComputing Jaccard matrix...'
-    print ';'.join(map(str, sorted(forbidden_samples)))
-    intersections = [[0 for _ in xrange(args.sample_count)]
-                        for __ in xrange(args.sample_count)]
-    unions = [[0 for _ in xrange(args.sample_count)]
-                 for __ in xrange(args.sample_count)]
-    results = []
-    q_i, q_u = manager.Queue(), manager.Queue()
-    listener_i = Thread(target=matrix_listener, args=(q, intersections))
-    listener_i.daemon = True
-    listener_i.start()
-    listener_u = Thread(target=matrix_listener, args=(q, unions))
-    listener_u.daemon = True
-    listener_u.start()
-    with open(args.input) as input_stream:
-        to_dispatch = filter(lambda x: x is not None,
-                             [next(input_stream, None)
-                                for _ in xrange(args.chunk_size)])
-        dispatch_count, active = 0, 0
-        while to_dispatch:
-            len_results_before = len(results)
-            pool.apply_async(intersections_and_unions,
-                [q_i, q_u, to_dispatch, forbidden_samples, args.sample_count],
-                                callback=results.append)
-            dispatch_count += 1
-            active += 1
-            while active >= num_processes:
-                sys.stderr.write('\x1b[KChunks processed: %d\r' % len(results))
-                active -= len(results) - len_results_before
+    kept_samples = [i for i in xrange(args.sample_count)
+                        if i not in forbidden_samples]
+    positions = -np.ones(args.sample_count, dtype=np.int64)
+    positions[kept_samples] = np.arange(len(kept_samples))
+    incidence = incidence_matrix(found_indexes, introns, positions,
+                                    intron_count)
+    del found_indexes, introns
+    def row_range_intersections(rows):
+        """ Return value: tuple (rows, intersections of rows from
+                range_intersections())
+        """
+        return rows, range_intersections(incidence, rows, args.block_size)
+    # Workers are forked after X is built so they share it
+    pool = multiprocessing.Pool(num_processes, init_worker, maxtasksperchild=5)
+    if args.tiled is not None:
+        kept_counts = intron_counts[kept_samples].astype(np.int64)
+        writer = JaccardStoreWriter(args.tiled, args.sample_count,
+                                        kept_samples, forbidden_samples,
+                                        kept_counts)
+        for tile_start in xrange(0, max(len(kept_samples) - 1, 0),
+                                    args.tile_size):
+            tile = (tile_start, min(tile_start + args.tile_size,
+                                        len(kept_samples) - 1))
+            offset = condensed_index(tile[0], tile[0] + 1, len(kept_samples))
+            tile_intersections = np.zeros(
+                    condensed_index(tile[1], tile[1] + 1, len(kept_samples))
+                    - offset, dtype=np.uint32
+                )
+            results = []
+            def add_tile_intersections(range_result):
+                """ Copies intersections of a range of rows into tile
+
+                    range_result: tuple returned by
+                        row_range_intersections()
+
+                    No return value.
+                """
+                rows, row_intersections = range_result
+                start = condensed_index(rows[0], rows[0] + 1,
+                                            len(kept_samples)) - offset
+                tile_intersections[
+                        start:start + len(row_intersections)
+                    ] = row_intersections
+                results.append(0)
+            ranges = row_ranges(tile, len(kept_samples), num_processes)
+            for rows in ranges:
+                pool.apply_async(row_range_intersections, [rows],
+                                    callback=add_tile_intersections)
+            while len(results) < len(ranges):
+                sys.stderr.write(
+                        '\x1b[KRows %d-%d: row ranges processed: %d of %d\r'
+                        % (tile[0], tile[1] - 1, len(results), len(ranges))
+                    )
                 time.sleep(0.4)
-            to_dispatch = filter(lambda x: x is not None,
-                                 [next(input_stream, None)
-                                    for _ in xrange(args.chunk_size)]
-                            )
-    while len(results) < dispatch_count:
-        sys.stderr.write('\x1b[KChunks processed: %d\r' % len(results))
+            writer.write_rows(tile[0], tile_jaccards(tile_intersections,
+                                                        kept_counts, tile))
+        writer.close()
+        end_time = time.time()
+        print >>sys.stderr, ('\x1b[KJaccard matrix written to "%s" in %02f '
+                             's. Entire job finished in %02f s.') % (
+                                    args.tiled,
+                                    end_time - process_time,
+                                    end_time - start_time
+                                )
+        sys.exit(0)
+    intersection_matrix = np.zeros(
+            len(kept_samples) * (len(kept_samples) - 1) // 2, dtype=np.uint32
+        )
+    results = []
+    def add_intersections(range_result):
+        """ Copies intersections of a range of rows into full matrix
+
+            range_result: tuple returned by row_range_intersections()
+
+            No return value.
+        """
+        rows, row_intersections = range_result
+        start = condensed_index(rows[0], rows[0] + 1, len(kept_samples))
+        intersection_matrix[
+                start:start + len(row_intersections)
+            ] = row_intersections
+        results.append(0)
+    ranges = row_ranges((0, len(kept_samples)), len(kept_samples),
+                            num_processes)
+    for rows in ranges:
+        pool.apply_async(row_range_intersections, [rows],
+                            callback=add_intersections)
+    while len(results) < len(ranges):
+        sys.stderr.write('\x1b[KRow ranges processed: %d of %d\r'
+                            % (len(results), len(ranges)))
         time.sleep(0.4)
-    q_i.put(-1)
-    q_u.put(-1)
-    listener_i.join()
-    listener_u.join()
     second_process_time = time.time()
-    print >>sys.stderr, '\x1b[KChunks processed in %02f s.' % (
+    print >>sys.stderr, '\x1b[KRow ranges processed in %02f s.' % (
                 second_process_time - process_time
             )
     sys.stderr.write('\x1b[KComputing and writing output...\r')
-    for i in xrange(args.sample_count):
-        if i in forbidden_samples: continue
-        for j in xrange(i, args.sample_count):
-            if j in forbidden_samples: continue
-            assert intersections[i][j] == intersections[j][i]
-            assert unions[i][j] == unions[j][i]
-            assert i != j or intersections[i][j] == unions[i][j]
-            try:
-                print '%d\t%d\t%.15f' % (
-                        i, j, float(intersections[i][j]) / unions[i][j]
-                    )
-            except ZeroDivisionError:
+    for i, samples, jaccards in jaccard_rows(intersection_matrix,
+                                                intron_counts, kept_samples):
+        for j, jaccard in zip(samples, jaccards):
+            if jaccard is None:
                 print '%d\t%d\tNA' % (i, j)
+            else:
+                print '%d\t%d\t%.15f' % (i, j, jaccard)
     end_time = time.time()
     print >>sys.stderr, ('\x1b[KOutput computed and written in %02f s. Entire '
                          'job finished in %02f s.') % (end_time - process_time,
-                                                       end_time - start_time)
\ No newline at end of file
+                                                       end_time - start_time)
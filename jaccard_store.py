@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+"""
+jaccard_store.py
+Part of SRA project
+
+Reads Jaccard similarity matrices written by jaccard_matrix.py --tiled and
+exports them as text. A matrix over tens of thousands of samples is never read
+into memory in full: rows, blocks, and nearest neighbors of samples are looked
+up through memory maps.
+
+A store is a directory with the following files. Only samples that were not
+filtered out ("kept" samples) have rows in the matrix, and kept samples are
+ordered by sample index.
+    meta.json: format version, number of samples spanned by sample indexes,
+        sorted list of kept sample indexes, and sorted list of sample indexes
+        that were filtered out
+    intron_counts.bin: int64 numbers of introns found in each kept sample
+    jaccard.bin: float32 condensed upper triangle of the matrix excluding the
+        diagonal, in the row-major order of
+        scipy.spatial.distance.squareform; an undefined Jaccard index (i.e.,
+        between two samples in which no introns were found) is NaN
+
+--export writes the matrix in the text format of jaccard_matrix.py: a line
+with the semicolon-separated list of sample indexes that were filtered out
+followed by one line per pair of kept samples (i, j), i <= j, with tab-
+separated fields
+1) First sample index
+2) Second sample index
+3) Jaccard index (NA if undefined)
+Jaccard indexes are stored with single precision. --sample SAMPLE --top-k K
+instead writes the K samples most similar to SAMPLE, one per line, with the
+fields above.
+"""
+import sys
+import os
+import json
+import numpy as np
+
+_FORMAT_VERSION = 1
+
+def condensed_index(i, j, kept_count):
+    """ Gets position of (i, j) in condensed upper triangle of a matrix
+
+        The condensed upper triangle excludes the diagonal and follows the
+        row-major order of scipy.spatial.distance.squareform.
+
+        i: row index (or NumPy array of row indexes)
+        j: column index (or NumPy array of column indexes) > i
+        kept_count: number of rows in matrix
+
+        Return value: index (or NumPy array of indexes)
+    """
+    return kept_count * i - i * (i + 1) // 2 + j - i - 1
+
+class JaccardStoreWriter(object):
+    """ Creates a store whose matrix is filled in row block by row block.
+
+        Jaccard indexes are written to the memory-mapped array jaccard
+        directly or with write_rows(). The store is unreadable until close()
+        is called.
+    """
+    def __init__(self, path, sample_count, kept_samples, forbidden_samples,
+                    intron_counts):
+        """
+            path: path to directory in which store should be written
+            sample_count: number of samples spanned by sample indexes
+            kept_samples: sorted list of sample indexes with rows in matrix
+            forbidden_samples: iterable of sample indexes filtered out
+            intron_counts: numbers of introns found in kept samples
+        """
+        self.path = path
+        self.sample_count = sample_count
+        self.kept_samples = list(kept_samples)
+        self.forbidden_samples = sorted(forbidden_samples)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        meta_path = os.path.join(path, 'meta.json')
+        if os.path.exists(meta_path):
+            # Invalidate any previous store until this one is finished
+            os.remove(meta_path)
+        np.asarray(intron_counts, dtype=np.int64).tofile(
+                os.path.join(path, 'intron_counts.bin')
+            )
+        kept_count = len(self.kept_samples)
+        self.pair_count = kept_count * (kept_count - 1) // 2
+        if self.pair_count:
+            self.jaccard = np.memmap(os.path.join(path, 'jaccard.bin'),
+                                        dtype=np.float32, mode='w+',
+                                        shape=(self.pair_count,))
+        else:
+            open(os.path.join(path, 'jaccard.bin'), 'w').close()
+            self.jaccard = np.zeros(0, dtype=np.float32)
+
+    def write_rows(self, start, values):
+        """ Writes Jaccard indexes for consecutive rows of the matrix.
+
+            start: position of first kept sample whose row is written
+            values: condensed upper triangle entries of that and subsequent
+                rows
+
+            No return value.
+        """
+        offset = condensed_index(start, start + 1, len(self.kept_samples))
+        self.jaccard[offset:offset + len(values)] = values
+
+    def close(self):
+        """ Flushes the matrix and writes metadata. """
+        if isinstance(self.jaccard, np.memmap):
+            self.jaccard.flush()
+        # Metadata is written last so an interrupted run is unreadable
+        with open(os.path.join(self.path, 'meta.json'), 'w') as meta_stream:
+            json.dump({'version' : _FORMAT_VERSION,
+                       'sample_count' : self.sample_count,
+                       'kept_samples' : self.kept_samples,
+                       'forbidden_samples' : self.forbidden_samples},
+                       meta_stream)
+
+class JaccardStore(object):
+    """ Memory-maps a store written by JaccardStoreWriter.
+
+        Rows and blocks of the full symmetric matrix are indexed by sample
+        index rather than by position among kept samples. The diagonal
+        element of a kept sample is 1 if any introns were found in it and NaN
+        otherwise.
+    """
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(os.path.join(path, 'meta.json')) as meta_stream:
+                meta = json.load(meta_stream)
+        except IOError:
+            raise RuntimeError('No Jaccard store at "{}".'.format(path))
+        if meta['version'] != _FORMAT_VERSION:
+            raise RuntimeError(
+                    'Jaccard store at "{}" has version {}, but version {} '
+                    'is required.'.format(path, meta['version'],
+                                            _FORMAT_VERSION)
+                )
+        self.sample_count = meta['sample_count']
+        self.kept_samples = np.array(meta['kept_samples'], dtype=np.int64)
+        self.forbidden_samples = meta['forbidden_samples']
+        kept_count = len(self.kept_samples)
+        self.intron_counts = np.fromfile(
+                os.path.join(path, 'intron_counts.bin'), dtype=np.int64
+            )
+        if kept_count > 1:
+            self.jaccard = np.memmap(os.path.join(path, 'jaccard.bin'),
+                                        dtype=np.float32, mode='r',
+                                        shape=(kept_count * (kept_count - 1)
+                                                // 2,))
+        else:
+            # mmap cannot map empty files
+            self.jaccard = np.zeros(0, dtype=np.float32)
+
+    def __len__(self):
+        return len(self.kept_samples)
+
+    def position(self, sample):
+        """ Return value: position of sample among kept samples """
+        position = int(np.searchsorted(self.kept_samples, sample))
+        if (position == len(self.kept_samples)
+                or self.kept_samples[position] != sample):
+            raise RuntimeError(
+                    'Sample index {} has no row in the Jaccard '
+                    'matrix.'.format(sample)
+                )
+        return position
+
+    def _diagonal(self, position):
+        """ Return value: diagonal element at position among kept samples """
+        return 1.0 if self.intron_counts[position] else np.nan
+
+    def upper_row(self, position):
+        """ Gets the part of a row on and to the right of the diagonal
+
+            position: position of sample among kept samples
+
+            Return value: NumPy float32 array of Jaccard indexes between the
+                sample and kept samples at positions >= position
+        """
+        kept_count = len(self.kept_samples)
+        start = condensed_index(position, position + 1, kept_count)
+        return np.concatenate((
+                np.array([self._diagonal(position)], dtype=np.float32),
+                self.jaccard[start:start + kept_count - position - 1]
+            ))
+
+    def row(self, sample):
+        """ Gets a full row of the matrix
+
+            sample: sample index
+
+            Return value: NumPy float32 array of Jaccard indexes between
+                sample and each kept sample, ordered as kept_samples
+        """
+        position = self.position(sample)
+        lower = np.arange(position, dtype=np.int64)
+        return np.concatenate((
+                self.jaccard[condensed_index(lower, position,
+                                                len(self.kept_samples))],
+                self.upper_row(position)
+            ))
+
+    def block(self, row_samples, column_samples):
+        """ Gets a block of the matrix
+
+            row_samples: list of sample indexes of rows
+            column_samples: list of sample indexes of columns
+
+            Return value: 2D NumPy float32 array
+        """
+        columns = [self.position(sample) for sample in column_samples]
+        return np.array([self.row(sample)[columns]
+                            for sample in row_samples],
+                            dtype=np.float32).reshape(len(row_samples),
+                                                        len(columns))
+
+    def top_k(self, sample, k):
+        """ Finds the samples most similar to a sample
+
+            sample: sample index
+            k: number of samples to find
+
+            Return value: list of at most k tuples (sample index, Jaccard
+                index) in descending order of Jaccard index, excluding sample
+                itself and undefined Jaccard indexes
+        """
+        jaccards = self.row(sample)
+        jaccards[self.position(sample)] = np.nan
+        candidates = np.flatnonzero(~np.isnan(jaccards))
+        if len(candidates) > k:
+            candidates = candidates[
+                    np.argpartition(-jaccards[candidates], k - 1)[:k]
+                ]
+        candidates = candidates[np.argsort(-jaccards[candidates],
+                                            kind='mergesort')]
+        return [(int(self.kept_samples[i]), float(jaccards[i]))
+                    for i in candidates]
+
+    def export(self, output_stream):
+        """ Writes matrix in the text format of jaccard_matrix.py
+
+            output_stream: where to write output
+
+            No return value.
+        """
+        output_stream.write(';'.join(map(str, self.forbidden_samples))
+                                + '\n')
+        kept_samples = self.kept_samples.tolist()
+        for position, sample in enumerate(kept_samples):
+            for other_sample, jaccard in zip(
+                    kept_samples[position:],
+                    self.upper_row(position).tolist()
+                ):
+                if jaccard != jaccard:
+                    output_stream.write('%d\t%d\tNA\n' % (
+                            sample, other_sample
+                        ))
+                else:
+                    output_stream.write('%d\t%d\t%.15f\n' % (
+                            sample, other_sample, jaccard
+                        ))
+
+if __name__ == '__main__':
+    import argparse
+    # Print file's docstring if -h is invoked
+    parser = argparse.ArgumentParser(description=__doc__,
+                formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--store', type=str, required=True,
+        help='path to store written by jaccard_matrix.py --tiled')
+    parser.add_argument('--export', action='store_const', const=True,
+        default=False,
+        help='write the whole matrix to stdout as text')
+    parser.add_argument('--sample', type=int, required=False,
+        default=None,
+        help='sample index whose most similar samples should be written')
+    parser.add_argument('--top-k', type=int, required=False,
+        default=10,
+        help='number of most similar samples to write for --sample')
+    args = parser.parse_args()
+    store = JaccardStore(args.store)
+    if args.export:
+        store.export(sys.stdout)
+    elif args.sample is not None:
+        for sample, jaccard in store.top_k(args.sample, args.top_k):
+            sys.stdout.write('%d\t%d\t%.15f\n' % (args.sample, sample,
+                                                     jaccard))
+    else:
+        raise RuntimeError('Specify either --export or --sample.')
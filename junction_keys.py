@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+"""
+junction_keys.py
+Part of SRA project
+
+Packs junctions and splice sites into int64 keys so sets of them can be held
+as sorted arrays and membership can be tested for a whole chunk of introns
+with a single call to searchsorted rather than one set lookup per intron.
+
+A junction's key is its chromosome code shifted left by 56 bits ORed with its
+start position shifted left by 28 bits ORed with its end position. A splice
+site's key is its chromosome code shifted left by 32 bits ORed with its
+position. Chromosome codes are indexes into a list of chromosome names, e.g.,
+annotation_cache.REFS, and must be less than MAX_CHROMS; positions of
+junctions must be less than 2^28, which exceeds the length of every human
+chromosome. A junction or splice site on a chromosome without a code or with a
+position out of range gets the key -1, which is never in a KeySet.
+
+When junctions arrive sorted by chromosome and start position, as in
+all_SRA_introns.tsv.gz, a KeyCursor joins them against a KeySet by merging:
+every key of a junction or of its splice sites is at least the key of its
+chromosome and start position, so a cursor into the KeySet's keys for each
+chromosome only moves forward, and each chunk of junctions is searched for
+only among the keys of its chromosome that lie past the cursor.
+"""
+import numpy as np
+
+MAX_CHROMS = 1 << 7
+_POSITION_BITS = 28
+_SITE_BITS = 32
+
+def chrom_codes(names, codes):
+    """ Looks up codes of chromosome names
+
+        names: iterable of chromosome names
+        codes: dictionary mapping chromosome names to codes
+
+        Return value: int64 NumPy array of codes, -1 for names without codes
+    """
+    return np.array([codes.get(name, -1) for name in names], dtype=np.int64)
+
+def junction_keys(chroms, starts, ends):
+    """ Packs junctions into keys
+
+        chroms: NumPy array of chromosome codes
+        starts: NumPy array of start positions
+        ends: NumPy array of end positions
+
+        Return value: int64 NumPy array of keys
+    """
+    chroms = np.asarray(chroms, dtype=np.int64)
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    valid = ((chroms >= 0) & (chroms < MAX_CHROMS)
+             & (starts >= 0) & (starts < (1 << _POSITION_BITS))
+             & (ends >= 0) & (ends < (1 << _POSITION_BITS)))
+    keys = ((chroms << (2 * _POSITION_BITS))
+            | (starts << _POSITION_BITS) | ends)
+    keys[~valid] = -1
+    return keys
+
+def site_keys(chroms, positions):
+    """ Packs splice sites into keys
+
+        chroms: NumPy array of chromosome codes
+        positions: NumPy array of positions
+
+        Return value: int64 NumPy array of keys
+    """
+    chroms = np.asarray(chroms, dtype=np.int64)
+    positions = np.asarray(positions, dtype=np.int64)
+    valid = ((chroms >= 0) & (chroms < MAX_CHROMS)
+             & (positions >= 0) & (positions < (1 << _SITE_BITS)))
+    keys = (chroms << _SITE_BITS) | positions
+    keys[~valid] = -1
+    return keys
+
+def chunk_junction_keys(chunk, codes, end_offset=0):
+    """ Packs the junctions of an IntronChunk into keys
+
+        chunk: IntronChunk
+        codes: dictionary mapping chromosome names to codes
+        end_offset: number to add to every end position
+
+        Return value: int64 NumPy array of keys
+    """
+    return junction_keys(chrom_codes(chunk.chrom_names, codes)[chunk.chrom],
+                            chunk.start, chunk.end + end_offset)
+
+def chunk_site_keys(chunk, codes):
+    """ Packs the 5' and 3' splice sites of an IntronChunk into keys
+
+        A junction's 5' splice site is its start position if it is on the
+        forward strand and its end position otherwise.
+
+        chunk: IntronChunk
+        codes: dictionary mapping chromosome names to codes
+
+        Return value: tuple (5' keys, 3' keys) of int64 NumPy arrays
+    """
+    chroms = chrom_codes(chunk.chrom_names, codes)[chunk.chrom]
+    forward = chunk.strand == 0
+    return (site_keys(chroms, np.where(forward, chunk.start, chunk.end)),
+            site_keys(chroms, np.where(forward, chunk.end, chunk.start)))
+
+class KeySet(object):
+    """ Set of junction or splice site keys held as a sorted array. """
+    def __init__(self, keys=()):
+        """
+            keys: NumPy array of keys; keys of -1 are ignored
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        self.keys = np.unique(keys[keys >= 0])
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, keys):
+        """ Adds keys to the set; keys of -1 are ignored. """
+        keys = np.asarray(keys, dtype=np.int64)
+        self.keys = np.union1d(self.keys, keys[keys >= 0])
+
+    def contains(self, keys):
+        """ Tests membership of keys
+
+            keys: NumPy array of keys
+
+            Return value: bool NumPy array that is True where a key is in
+                the set
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        if not len(self.keys):
+            return np.zeros(len(keys), dtype=bool)
+        positions = np.minimum(np.searchsorted(self.keys, keys),
+                               len(self.keys) - 1)
+        return self.keys[positions] == keys
+
+def membership_masks(key_sets, keys):
+    """ Tests membership of keys in each of several KeySets at once
+
+        key_sets: list of KeySets
+        keys: NumPy array of keys
+
+        Return value: int64 NumPy array whose bit i is set where a key is in
+            key_sets[i]
+    """
+    masks = np.zeros(len(keys), dtype=np.int64)
+    for i, key_set in enumerate(key_sets):
+        masks |= key_set.contains(keys).astype(np.int64) << i
+    return masks
+
+def junction_key_set(junctions):
+    """ Builds a KeySet from output of annotation_cache.load_junctions() """
+    return KeySet(junction_keys(*junctions))
+
+def site_key_set(sites):
+    """ Builds a KeySet from one element of output of
+        annotation_cache.load_splice_sites()
+    """
+    return KeySet(site_keys(*sites))
+
+class KeyCursor(object):
+    """ Merges keys of junctions sorted by chromosome and start position
+        against a KeySet.
+    """
+    def __init__(self, key_set, chrom_shift):
+        """
+            key_set: KeySet
+            chrom_shift: number of bits by which chromosome codes are shifted
+                in keys
+        """
+        self.keys = key_set.keys
+        self.chrom_shift = chrom_shift
+        # Index of first key of each chromosome; the last entry is the end
+        bounds = np.searchsorted(
+                self.keys,
+                np.arange(MAX_CHROMS, dtype=np.int64) << chrom_shift
+            )
+        self.cursors = bounds.copy()
+        self.ends = np.append(bounds[1:], len(self.keys))
+        # Largest lower bound passed for each chromosome
+        self.lower_bounds = np.full(MAX_CHROMS, -1, dtype=np.int64)
+
+    def contains(self, keys, lower_bounds):
+        """ Tests membership of keys, advancing cursors
+
+            keys: NumPy array of keys
+            lower_bounds: NumPy array with, for each key, the key of its
+                junction's chromosome and start position, or -1 if it has
+                none; these must not decrease within a chromosome across
+                calls
+
+            Return value: bool NumPy array that is True where a key is in
+                the set
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        lower_bounds = np.asarray(lower_bounds, dtype=np.int64)
+        found = np.zeros(len(keys), dtype=bool)
+        chroms = lower_bounds >> self.chrom_shift
+        for chrom in np.unique(chroms[lower_bounds >= 0]).tolist():
+            rows = np.flatnonzero((chroms == chrom) & (lower_bounds >= 0))
+            bounds = lower_bounds[rows]
+            if (bounds[0] < self.lower_bounds[chrom]
+                    or np.any(bounds[1:] < bounds[:-1])):
+                raise RuntimeError(
+                        'Junctions are not sorted by chromosome and start '
+                        'position.'
+                    )
+            self.lower_bounds[chrom] = bounds[-1]
+            end = self.ends[chrom]
+            cursor = self.cursors[chrom] + np.searchsorted(
+                    self.keys[self.cursors[chrom]:end], bounds[0]
+                )
+            self.cursors[chrom] = cursor
+            window = self.keys[cursor:end]
+            if not len(window):
+                continue
+            queries = keys[rows]
+            positions = np.minimum(np.searchsorted(window, queries),
+                                    len(window) - 1)
+            found[rows] = window[positions] == queries
+        return found
+
+def junction_cursor(key_set):
+    """ Builds a KeyCursor over output of junction_key_set() """
+    return KeyCursor(key_set, 2 * _POSITION_BITS)
+
+def site_cursor(key_set):
+    """ Builds a KeyCursor over output of site_key_set() """
+    return KeyCursor(key_set, _SITE_BITS)
+
+def chunk_lower_bounds(chunk, codes):
+    """ Packs the chromosomes and start positions of an IntronChunk into the
+        lower bounds KeyCursor.contains() takes
+
+        chunk: IntronChunk
+        codes: dictionary mapping chromosome names to codes
+
+        Return value: tuple (lower bounds for junction keys, lower bounds for
+            splice site keys) of int64 NumPy arrays
+    """
+    chroms = chrom_codes(chunk.chrom_names, codes)[chunk.chrom]
+    return (junction_keys(chroms, chunk.start, np.zeros_like(chunk.start)),
+            site_keys(chroms, chunk.start))
@@ -4,10 +4,33 @@ number_of_samples.py
 
 Counts number of samples in which junctions appear.
 
-
+Introns may instead be read from a store written by intron_store.py by
+specifying its path as the argument of --store.
 """
 import sys
 
-for line in sys.stdin:
-	tokens = line.strip().split('\t')
-	print '\t'.join(tokens[:3] + [str(tokens[-2].count(',') + 1)])
\ No newline at end of file
+if __name__ == '__main__':
+	import argparse
+	# Print file's docstring if -h is invoked
+	parser = argparse.ArgumentParser(description=__doc__,
+				formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--store', type=str, required=False,
+		default=None,
+		help='path to intron store written by intron_store.py; read instead '
+			 'of stdin if specified')
+	args = parser.parse_args()
+
+	if args.store is not None:
+		import intron_store
+		store = intron_store.IntronStore(args.store)
+		for chunk in store.chunks():
+			for chrom, start, end, sample_count in zip(
+					[store.chrom_names[code] for code in chunk.chrom.tolist()],
+					chunk.start.tolist(), chunk.end.tolist(),
+					chunk.sample_counts().tolist()
+				):
+				print '\t'.join([chrom, str(start), str(end), str(sample_count)])
+	else:
+		for line in sys.stdin:
+			tokens = line.strip().split('\t')
+			print '\t'.join(tokens[:3] + [str(tokens[-2].count(',') + 1)])
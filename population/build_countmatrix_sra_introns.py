@@ -4,24 +4,41 @@
 # PURPOSE: Get count matrix for introns
 
 # PARAMETERS:
-# 1st = tsv output file from Rail RNA
+# 1st = tsv output file from Rail RNA, or directory of an intron store
+#       written by intron_store.py
 
 import sys
+import os
 import gzip
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                    os.pardir))
+import intron_store
 
 tsv = sys.argv[1] 
 reads = []
 n = 21505
 
-file = open(tsv, 'r')
+if os.path.isdir(tsv):
+    file = None
+    # Fields 7 and 8 are already lists of integers
+    records = ([record[0], str(record[1]), str(record[2])] + list(record[3:])
+                for record in intron_store.IntronStore(tsv).records())
+else:
+    file = open(tsv, 'r')
+    records = (l.strip('\n').split('\t') for l in file)
 output = gzip.open("countmatrix_introns.gz", 'w')
 #output = open("countmatrix_introns.txt", 'w')
-for l in file:
-    l = l.strip('\n').split('\t')
-    reads = map(int, l[7].split(','))
+for l in records:
+    if file is None:
+        reads = l[7]
+    else:
+        reads = map(int, l[7].split(','))
     if max(reads) >= 100 and float(sum(reads))/len(reads) > 0.95:
         all_sample_reads = ['0'] * n
-        indexes = map(int, l[6].split(','))
+        if file is None:
+            indexes = l[6]
+        else:
+            indexes = map(int, l[6].split(','))
         j = 0
         for i in indexes:
             all_sample_reads[i] = reads[j]
@@ -30,4 +47,5 @@ for l in file:
         for r in all_sample_reads:
             print >> output,"\t" + str(r),
         print >> output, ""
-file.close()
+if file is not None:
+    file.close()
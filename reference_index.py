@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+"""
+reference_index.py
+Part of SRA project
+
+Retrieves stretches of the reference from any of three representations with
+the interface of bowtie_index.BowtieIndexReference: reference names in
+refnames, reference lengths in length, and the get_motifs and get_stretch
+member functions. Characters outside the reference or that are not A, C, G,
+or T are N, and soft-masked (lowercase) characters are made uppercase.
+    1) A small (32-bit) Bowtie 1 index, specified by its basename.
+    2) An uncompressed FASTA file. Sequences are looked up in a samtools-style
+        .fai index with the tab-separated fields name, length, byte offset of
+        sequence, bases per line, and bytes per line. If the .fai file does
+        not exist, it is built on first use and written next to the FASTA if
+        the FASTA's directory is writable. Every line of a sequence except
+        its last must have the same length.
+    3) A UCSC .2bit file (version 0).
+The FASTA and .2bit files are memory-mapped, so opening a reference reads
+only its index, and each base is located in constant time.
+
+open_reference() chooses the representation from its argument: a path with
+Bowtie 1 index files at path + ".3.ebwt" etc. is a Bowtie index, a file
+starting with the .2bit signature is a .2bit file, and anything else is
+treated as a FASTA file.
+"""
+import os
+import struct
+import numpy as np
+from bowtie_index import (BowtieIndexReference, query_positions,
+                            split_stretches)
+
+_TWOBIT_SIGNATURE = 0x1A412743
+# Maps bytes of FASTA files to uppercase characters, with N for any byte that
+# is not a base
+_FASTA_CHARACTERS = np.frombuffer(b'N' * 256, dtype=np.uint8).copy()
+for _base in b'ACGT':
+    _base = ord(_base) if isinstance(_base, str) else _base
+    _FASTA_CHARACTERS[_base] = _base
+    _FASTA_CHARACTERS[_base + 32] = _base
+# Characters of 2-bit codes in .2bit files
+_TWOBIT_CHARACTERS = np.frombuffer(b'TCAG', dtype=np.uint8)
+_N = ord('N')
+
+def build_fai(fasta):
+    """ Builds a samtools-style .fai index of an uncompressed FASTA file
+
+        fasta: path to FASTA file
+
+        Return value: list of tuples (name, length, byte offset of sequence,
+            bases per line, bytes per line)
+    """
+    entries = []
+    name = None
+    offset = 0
+    with open(fasta, 'rb') as fasta_stream:
+        for line in fasta_stream:
+            offset += len(line)
+            if line.startswith(b'>'):
+                if name is not None:
+                    entries.append((name, length, start, line_bases,
+                                        line_width))
+                name = str(line[1:].split()[0].decode('ascii'))
+                length, start, line_bases, line_width = 0, offset, None, None
+                last_line = False
+                continue
+            if name is None:
+                if line.strip():
+                    raise RuntimeError(
+                            'FASTA file "{}" does not start with a '
+                            'header.'.format(fasta)
+                        )
+                continue
+            bases = len(line.rstrip(b'\r\n'))
+            if not bases:
+                last_line = True
+                continue
+            if last_line:
+                raise RuntimeError(
+                        'Sequence "{}" of FASTA file "{}" has lines of '
+                        'unequal lengths.'.format(name, fasta)
+                    )
+            if line_bases is None:
+                line_bases, line_width = bases, len(line)
+            elif bases != line_bases or len(line) != line_width:
+                if bases > line_bases:
+                    raise RuntimeError(
+                            'Sequence "{}" of FASTA file "{}" has lines of '
+                            'unequal lengths.'.format(name, fasta)
+                        )
+                last_line = True
+            length += bases
+        if name is not None:
+            entries.append((name, length, start, line_bases or 0,
+                                line_width or 0))
+    return entries
+
+class FastaReference(object):
+    """
+    Memory-maps an uncompressed FASTA file and retrieves stretches of
+    characters from it using its .fai index.
+    """
+
+    def __init__(self, fasta):
+        """
+            fasta: path to uncompressed FASTA file
+        """
+        fai = fasta + '.fai'
+        if os.path.exists(fai):
+            entries = []
+            with open(fai) as fai_stream:
+                for line in fai_stream:
+                    tokens = line.strip().split('\t')
+                    entries.append((tokens[0],) + tuple(
+                            int(token) for token in tokens[1:5]
+                        ))
+        else:
+            entries = build_fai(fasta)
+            try:
+                with open(fai, 'w') as fai_stream:
+                    for entry in entries:
+                        fai_stream.write('\t'.join(map(str, entry)) + '\n')
+            except (IOError, OSError):
+                pass
+        self.refnames = [entry[0] for entry in entries]
+        self.length = dict((entry[0], entry[1]) for entry in entries)
+        self.refcodes = dict((rname, i)
+                                for i, rname in enumerate(self.refnames))
+        (self.lengths, self.offsets,
+            self.line_bases, self.line_widths) = [
+                    np.array([entry[i] for entry in entries] or [0],
+                                dtype=np.int64)
+                    for i in xrange(1, 5)
+                ]
+        if os.path.getsize(fasta):
+            self.data = np.memmap(fasta, dtype=np.uint8, mode='r')
+        else:
+            # mmap cannot map empty files
+            self.data = np.zeros(1, dtype=np.uint8)
+        # For compatibility
+        self.rname_lengths = self.length
+
+    def get_motifs(self, ref_ids, ref_offs, count):
+        """
+        Return stretches of characters from the reference for many queries
+        at once.
+
+        @param ref_ids: sequence of names of ref seqs
+        @param ref_offs: sequence of offsets into reference, 0-based
+        @param count: # of characters in each stretch
+        @return: list of strings extracted from reference
+        """
+        if not len(ref_ids):
+            return []
+        codes, positions = query_positions(self, ref_ids, ref_offs, count)
+        valid = (positions >= 0) & (positions < self.lengths[codes])
+        positions = np.where(valid, positions, 0)
+        line_bases = np.maximum(self.line_bases[codes], 1)
+        byte_offsets = (self.offsets[codes]
+                        + (positions // line_bases) * self.line_widths[codes]
+                        + positions % line_bases)
+        return split_stretches(
+                np.where(valid, _FASTA_CHARACTERS[self.data[byte_offsets]],
+                            _N),
+                count
+            )
+
+    def get_stretch(self, ref_id, ref_off, count):
+        """
+        Return a stretch of characters from the reference.
+
+        @param ref_id: name of ref seq, up to & excluding whitespace
+        @param ref_off: offset into reference, 0-based
+        @param count: # of characters
+        @return: string extracted from reference
+        """
+        return self.get_motifs([ref_id], [ref_off], count)[0]
+
+class TwoBitReference(object):
+    """
+    Memory-maps a UCSC .2bit file and retrieves stretches of characters from
+    it.
+    """
+
+    def __init__(self, twobit):
+        """
+            twobit: path to .2bit file
+        """
+        self.data = np.memmap(twobit, dtype=np.uint8, mode='r')
+        header = self.data[:16].tobytes()
+        for byte_order in '<>':
+            if struct.unpack(byte_order + 'I', header[:4])[0] \
+                    == _TWOBIT_SIGNATURE:
+                break
+        else:
+            raise RuntimeError(
+                    '"{}" is not a .2bit file.'.format(twobit)
+                )
+        version, sequence_count = struct.unpack(byte_order + 'II',
+                                                header[4:12])
+        if version != 0:
+            raise RuntimeError(
+                    '.2bit file "{}" has version {}, but only version 0 is '
+                    'supported.'.format(twobit, version)
+                )
+        uint32 = np.dtype(byte_order + 'u4')
+        position = 16
+        self.refnames, sequence_offsets = [], []
+        for _ in xrange(sequence_count):
+            name_size = int(self.data[position])
+            self.refnames.append(str(self.data[
+                    position + 1:position + 1 + name_size
+                ].tobytes().decode('ascii')))
+            position += 1 + name_size
+            sequence_offsets.append(int(self.data[
+                    position:position + 4
+                ].view(uint32)[0]))
+            position += 4
+        lengths, dna_offsets, n_keys, n_ends = [], [], [], []
+        for i, offset in enumerate(sequence_offsets):
+            length, n_block_count = [
+                    int(value) for value in
+                    self.data[offset:offset + 8].view(uint32)
+                ]
+            offset += 8
+            n_blocks = self.data[
+                    offset:offset + 8 * n_block_count
+                ].view(uint32).astype(np.int64)
+            offset += 8 * n_block_count
+            n_keys.append((i << 32) + n_blocks[:n_block_count])
+            n_ends.append((i << 32) + n_blocks[:n_block_count]
+                            + n_blocks[n_block_count:])
+            mask_block_count = int(
+                    self.data[offset:offset + 4].view(uint32)[0]
+                )
+            # Skip mask blocks and reserved field
+            offset += 4 + 8 * mask_block_count + 4
+            lengths.append(int(length))
+            dna_offsets.append(offset)
+        self.length = dict(zip(self.refnames, lengths))
+        self.refcodes = dict((rname, i)
+                                for i, rname in enumerate(self.refnames))
+        self.lengths = np.array(lengths or [0], dtype=np.int64)
+        self.dna_offsets = np.array(dna_offsets or [0], dtype=np.int64)
+        self.n_keys = np.concatenate(n_keys or [np.zeros(0, np.int64)])
+        self.n_ends = np.concatenate(n_ends or [np.zeros(0, np.int64)])
+        # For compatibility
+        self.rname_lengths = self.length
+
+    def get_motifs(self, ref_ids, ref_offs, count):
+        """
+        Return stretches of characters from the reference for many queries
+        at once. N blocks containing requested characters are found with a
+        single binary search.
+
+        @param ref_ids: sequence of names of ref seqs
+        @param ref_offs: sequence of offsets into reference, 0-based
+        @param count: # of characters in each stretch
+        @return: list of strings extracted from reference
+        """
+        if not len(ref_ids):
+            return []
+        codes, positions = query_positions(self, ref_ids, ref_offs, count)
+        valid = (positions >= 0) & (positions < self.lengths[codes])
+        positions = np.where(valid, positions, 0)
+        keys = (codes << 32) + positions
+        if len(self.n_keys):
+            n_blocks = np.searchsorted(self.n_keys, keys, side='right') - 1
+            valid &= ~((n_blocks >= 0)
+                        & (keys < self.n_ends[np.maximum(n_blocks, 0)]))
+        bases = (self.data[self.dna_offsets[codes] + (positions >> 2)]
+                    >> (6 - ((positions & 3) << 1))) & 3
+        return split_stretches(
+                np.where(valid, _TWOBIT_CHARACTERS[bases], _N), count
+            )
+
+    def get_stretch(self, ref_id, ref_off, count):
+        """
+        Return a stretch of characters from the reference.
+
+        @param ref_id: name of ref seq, up to & excluding whitespace
+        @param ref_off: offset into reference, 0-based
+        @param count: # of characters
+        @return: string extracted from reference
+        """
+        return self.get_motifs([ref_id], [ref_off], count)[0]
+
+def open_reference(path):
+    """ Opens a Bowtie 1 index, .2bit file, or FASTA file
+
+        path: basename of Bowtie 1 index or path to .2bit or uncompressed
+            FASTA file
+
+        Return value: BowtieIndexReference, TwoBitReference, or
+            FastaReference
+    """
+    if os.path.exists(path + '.3.ebwt'):
+        return BowtieIndexReference(path)
+    if not os.path.isfile(path):
+        raise RuntimeError(
+                'No Bowtie index, .2bit file, or FASTA file at "{}".'.format(
+                        path
+                    )
+            )
+    with open(path, 'rb') as reference_stream:
+        signature = reference_stream.read(4)
+    if len(signature) == 4 and _TWOBIT_SIGNATURE in (
+            struct.unpack('<I', signature)[0],
+            struct.unpack('>I', signature)[0]
+        ):
+        return TwoBitReference(path)
+    return FastaReference(path)
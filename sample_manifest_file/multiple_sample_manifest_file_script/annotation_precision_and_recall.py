@@ -14,35 +14,145 @@ Tab-separated output fields:
 3. Recall of SRA sample's introns by annotation's introns
 4. Recall of SRA sample's spliced reads by annotation's introns
 5. Total introns found in SRA sample
+
+If the path to a store written by intron_store.py is specified as the argument
+of --store, SRA introns are read from the store, and only annotation introns
+are read from stdin.
 """
 
 import sys
+import os
 from collections import defaultdict
+import argparse
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                    os.pardir, os.pardir))
+import intron_store
+import junction_keys
 
 # Suppress output if number of introns in sample is < 1000
 _SUPPRESS = 1000
+# Number of SRA introns to compare with annotation at a time
+_CHUNK_SIZE = 100000
+
+parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('--store', type=str, required=False,
+    default=None,
+    help='path to intron store written by intron_store.py')
+args = parser.parse_args()
 
-annotation_introns = set()
+# Chromosome codes are assigned as chromosomes are encountered, and the
+# annotation introns on each chromosome are held in their own KeySet, so any
+# number of chromosomes may be encountered; keys pack only start and end
+# positions
+chrom_codes = {}
+annotation_introns = []
 overlaps, totals = defaultdict(int), defaultdict(int)
 weighted_overlaps, weighted_totals = defaultdict(int), defaultdict(int)
 
+def code(chrom):
+    """ Return value: code of chromosome, assigning one if necessary """
+    try:
+        return chrom_codes[chrom]
+    except KeyError:
+        chrom_codes[chrom] = len(chrom_codes)
+        annotation_introns.append(junction_keys.KeySet())
+        return chrom_codes[chrom]
+
+def position_keys(starts, ends):
+    """ Return value: keys from junction_keys.py of introns that all have
+            chromosome code 0
+    """
+    return junction_keys.junction_keys(np.zeros(len(starts), dtype=np.int64),
+                                        starts, ends)
+
+def add_sra_introns(chroms, starts, ends, samples, coverages):
+    """ Updates totals and overlaps with SRA introns.
+
+        Each intron is compared with the annotation introns read so far.
+
+        chroms: NumPy array of chromosome codes, -1 for chromosomes without
+            annotation introns
+        starts: NumPy array of start positions
+        ends: NumPy array of end positions
+        samples: list of lists of sample indexes, one for each intron
+        coverages: list of lists of coverages corresponding to samples
+
+        No return value.
+    """
+    chroms = np.asarray(chroms, dtype=np.int64)
+    keys = position_keys(starts, ends)
+    annotated_introns = np.zeros(len(keys), dtype=bool)
+    for chrom in np.unique(chroms[chroms >= 0]).tolist():
+        on_chrom = chroms == chrom
+        annotated_introns[on_chrom] = annotation_introns[chrom].contains(
+                                                            keys[on_chrom]
+                                                        )
+    for i, annotated in enumerate(annotated_introns.tolist()):
+        for j, sample in enumerate(samples[i]):
+            totals[sample] += 1
+            weighted_totals[sample] += coverages[i][j]
+            if annotated:
+                overlaps[sample] += 1
+                weighted_overlaps[sample] += coverages[i][j]
+
+# Introns are compared with annotation a chunk at a time; pending annotation
+# introns always precede pending SRA introns in the input
+annotation_chroms, annotation_starts, annotation_ends = [], [], []
+sra_chroms, sra_starts, sra_ends, sra_samples, sra_coverages = (
+        [] for _ in xrange(5)
+    )
+def flush():
+    """ Adds pending annotation introns, then pending SRA introns. """
+    if annotation_chroms:
+        chroms = np.array(annotation_chroms, dtype=np.int64)
+        keys = position_keys(annotation_starts, annotation_ends)
+        for chrom in np.unique(chroms).tolist():
+            annotation_introns[chrom].add(keys[chroms == chrom])
+    if sra_chroms:
+        add_sra_introns(sra_chroms, sra_starts, sra_ends, sra_samples,
+                        sra_coverages)
+    for pending in (annotation_chroms, annotation_starts, annotation_ends,
+                        sra_chroms, sra_starts, sra_ends, sra_samples,
+                        sra_coverages):
+        del pending[:]
+
 for line in sys.stdin:
     tokens = line.strip().split('\t')
     chrom, start, end = tokens[0], int(tokens[1]), int(tokens[2])
     if len(tokens) <= 5:
-        annotation_introns.add((chrom, start, end))
+        if sra_chroms:
+            flush()
+        annotation_chroms.append(code(chrom))
+        annotation_starts.append(start)
+        annotation_ends.append(end)
     else:
-        samples = [int(sample) for sample in tokens[-2].split(',')]
-        coverages = [int(coverage) for coverage in tokens[-1].split(',')]
-        for i, sample in enumerate(samples):
-            totals[sample] += 1
-            weighted_totals[sample] += coverages[i]
-        if (chrom, start, end) in annotation_introns:
-            for i, sample in enumerate(samples):
-                overlaps[sample] += 1
-                weighted_overlaps[sample] += coverages[i]
+        # A chromosome without a code has no annotation introns yet
+        sra_chroms.append(chrom_codes.get(chrom, -1))
+        sra_starts.append(start)
+        sra_ends.append(end)
+        sra_samples.append([int(sample) for sample in tokens[-2].split(',')])
+        sra_coverages.append([int(coverage)
+                                for coverage in tokens[-1].split(',')])
+        if len(sra_chroms) == _CHUNK_SIZE:
+            flush()
+flush()
+
+if args.store is not None:
+    for chunk in intron_store.IntronStore(args.store).chunks(_CHUNK_SIZE):
+        add_sra_introns(
+                junction_keys.chrom_codes(chunk.chrom_names,
+                                            chrom_codes)[chunk.chrom],
+                chunk.start, chunk.end,
+                [chunk.samples[chunk.indptr[i]:chunk.indptr[i+1]].tolist()
+                    for i in xrange(len(chunk))],
+                [chunk.coverages[chunk.indptr[i]:chunk.indptr[i+1]].tolist()
+                    for i in xrange(len(chunk))]
+            )
 
-annotation_intron_count = len(annotation_introns)
+annotation_intron_count = sum(len(chrom_introns)
+                                for chrom_introns in annotation_introns)
 
 for sample in totals:
     if totals[sample] >= _SUPPRESS:
@@ -13,219 +13,422 @@ The original introns are in a format where the start position is 1-based and
 inclusive and the end position is 1-based and exclusive. The format of each
 intron is changed so the end position is 1-based and inclusive. An extra
 field is added to indicate whether the intron is GT-AG, GC-AG, or AT-AC, so
-a Bowtie index basename must be added at the command line.
+a reference must be added at the command line: a Bowtie index basename or
+the path to a .2bit or uncompressed FASTA file. Motifs of
+--batch-size introns are looked up at a time with array operations, which
+requires NumPy.
 
 Also writes a file mapping new indexes to SRA accession numbers.
+
+If --batches is specified, introns are instead read from the collected intron
+files of batches 0, 1, 2, ..., in that order, each gzipped or uncompressed
+and sorted by chromosome, start position, end position, and strand with
+
+gzip -cd [batch file]
+    | awk -F'\t' -v OFS='\t' '{print substr($1, 1, length($1) - 1), $0}'
+    | LC_ALL=C sort -k1,1 -k3,3n -k4,4n -k2,2 | cut -f2-
+
+and merged here, so neither the batch number nor a merge with sort -m is
+needed upstream. (A file sorted on its first field, which ends with the
+strand, lists all of a chromosome's forward-strand introns before any of its
+reverse-strand introns and could not be merged without holding them in
+memory.) Each file is decompressed, split into lines, and parsed by its own
+thread, and all files are merged with a heap on (chromosome, start position,
+end position, strand), so output is written in the order of
+
+LC_ALL=C sort -k1,1 -k2,2n -k3,3n
+
+and need not be sorted again. Each thread reads 64 KB of its file at a time
+and queues at most two blocks of parsed lines, so at most four blocks per
+file are in memory: two queued, one being merged, and one being parsed.
+For gzipped batch files, which inflate about 5-fold, that is about 1.3 MB of
+text per file, a few times that as Python objects, and on the order of 200
+MB for all 43 batch files; like sort -m, the merge holds only a small window
+of each file.
+
+New batches may be added to an existing all_SRA_introns.tsv.gz written this
+way by specifying it as the argument of --append-to and the sorted collected
+intron files of the new batches as arguments of --batches, with the index of
+the first new batch as the argument of --first-batch. Only the sample indexes
+of the new batches are remapped; introns of the existing file, whose motifs
+are kept, and of the new batches are merged in one pass, and samples of the
+new batches are appended to index_to_SRA_accession.tsv. Because batch 42 has
+506 samples, the first new batch is batch 44; for example,
+
+python combine.py --bowtie-idx [index] --first-batch 44
+    --batches batch_44.sorted.tsv.gz --append-to all_SRA_introns.tsv.gz
+    | gzip >all_SRA_introns.with_batch_44.tsv.gz
+
+requires a manifest file sra_batch_44_sample_size_[size].txt in the
+directory containing combine.py. A new batch whose sample indexes could
+overlap those already in index_to_SRA_accession.tsv is refused. The new
+index_to_SRA_accession.tsv is written to a temporary file that replaces it
+only after all introns are written, so a failed run leaves it unchanged.
+
+Work is divided into blocks of about --batch-size introns. Lines from stdin
+are cut into blocks without splitting the lines of any intron across blocks,
+and merged introns from --batches are grouped into blocks as they are merged,
+each intron carrying the unremapped sample indexes and coverages of every
+batch in which it was found. If --processes is greater than 1, a pool of
+worker processes remaps and sorts sample indexes, looks up motifs, and
+formats the introns of each block, and blocks are written in order as one
+write each, so output is the same for any number of processes. At most two
+blocks per process are in flight at a time. The main process only reads,
+merges, and groups introns. If --compress-threads is greater than 0, output
+is compressed with that many pigz threads, which requires pigz.
 """
 import sys
+import os
 import itertools
 import glob
+import heapq
+import threading
+import Queue
+import zlib
+import collections
+import subprocess
+import shutil
+import multiprocessing
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                    os.pardir, os.pardir))
+from reference_index import open_reference
 
-# This code is taken from bowtie_index.py in Rail-RNA
-import os
-import struct
-import mmap
-from operator import itemgetter
-from collections import defaultdict
-from bisect import bisect_right
+_reversed_complements = {
+        ('CT', 'AC') : ('GT', 'AG'),
+        ('CT', 'GC') : ('GC', 'AG'),
+        ('GT', 'AT') : ('AT', 'AC')
+    }
 
-class BowtieIndexReference(object):
+def format_introns(introns, reference_index):
+    """ Formats introns, looking up motifs of all of them at once
+
+        introns: list of tuples (chromosome, start position, end
+            position, strand, list of (sample index, coverage) pairs[,
+            (start motif, end motif)]); motifs are looked up only for
+            introns without them
+        reference_index: object from reference_index.open_reference()
+
+        Return value: string with a line for each intron
     """
-    Given prefix of a Bowtie index, parses the reference names, parses the
-    extents of the unambiguous stretches, and memory-maps the file containing
-    the unambiguous-stretch sequences.  get_stretch member function can
-    retrieve stretches of characters from the reference, even if the stretch
-    contains ambiguous characters.
+    lookups = [intron for intron in introns if len(intron) == 5]
+    chroms = [intron[0] for intron in lookups]
+    start_motifs = reference_index.get_motifs(
+            chroms, [intron[1] - 1 for intron in lookups], 2
+        )
+    end_motifs = reference_index.get_motifs(
+            chroms, [intron[2] - 2 for intron in lookups], 2
+        )
+    looked_up_motifs = iter(zip(start_motifs, end_motifs))
+    lines = []
+    for intron in introns:
+        chrom, start, end, strand, pairs = intron[:5]
+        if len(intron) > 5:
+            start_motif, end_motif = intron[5]
+        else:
+            start_motif, end_motif = next(looked_up_motifs)
+            if strand == '-':
+                start_motif, end_motif = _reversed_complements[
+                                                (start_motif, end_motif)
+                                            ]
+        lines.append('\t'.join(
+                [chrom, str(start), str(end), strand, start_motif, end_motif,
+                    ','.join([str(pair[0]) for pair in pairs]),
+                    ','.join([str(pair[1]) for pair in pairs])]
+            ))
+    lines.append('')
+    return '\n'.join(lines)
+
+def remapped_pairs(batch_index, sample_indexes, coverages):
+    """ Remaps sample indexes of an intron from a batch
+
+        batch_index: index of batch
+        sample_indexes: comma-separated list of original sample indexes
+        coverages: comma-separated list of coverages
+
+        Return value: list of (new sample index, coverage) pairs
     """
+    return zip([500 * batch_index + int(original_index)
+                    for original_index in sample_indexes.split(',')],
+                coverages.split(','))
 
-    def __init__(self, idx_prefix):
+def remapped_introns(introns):
+    """ Remaps and sorts sample indexes of merged introns
 
-        # Open file handles
-        if os.path.exists(idx_prefix + '.3.ebwt'):
-            # Small index (32-bit offsets)
-            fh1 = open(idx_prefix + '.1.ebwt', 'rb')  # for ref names
-            fh3 = open(idx_prefix + '.3.ebwt', 'rb')  # for stretch extents
-            fh4 = open(idx_prefix + '.4.ebwt', 'rb')  # for unambiguous sequence
-            sz, struct_unsigned = 4, struct.Struct('I')
-        else:
-            raise RuntimeError('No Bowtie index files with prefix "%s"' % idx_prefix)
-
-        #
-        # Parse .1.bt2 file
-        #
-        one = struct.unpack('<i', fh1.read(4))[0]
-        assert one == 1
-
-        ln = struct_unsigned.unpack(fh1.read(sz))[0]
-        line_rate = struct.unpack('<i', fh1.read(4))[0]
-        lines_per_side = struct.unpack('<i', fh1.read(4))[0]
-        _ = struct.unpack('<i', fh1.read(4))[0]
-        ftab_chars = struct.unpack('<i', fh1.read(4))[0]
-        _ = struct.unpack('<i', fh1.read(4))[0]
-
-        nref = struct_unsigned.unpack(fh1.read(sz))[0]
-        # get ref lengths
-        reference_length_list = []
-        for i in xrange(nref):
-            reference_length_list.append(struct.unpack('<i', fh1.read(sz))[0])
-
-        nfrag = struct_unsigned.unpack(fh1.read(sz))[0]
-        # skip rstarts
-        fh1.seek(nfrag * sz * 3, 1)
-
-        # skip ebwt
-        bwt_sz = ln // 4 + 1
-        line_sz = 1 << line_rate
-        side_sz = line_sz * lines_per_side
-        side_bwt_sz = side_sz - 8
-        num_side_pairs = (bwt_sz + (2*side_bwt_sz) - 1) // (2*side_bwt_sz)
-        ebwt_tot_len = num_side_pairs * 2 * side_sz
-        fh1.seek(ebwt_tot_len, 1)
-
-        # skip zOff
-        fh1.seek(sz, 1)
-
-        # skip fchr
-        fh1.seek(5 * sz, 1)
-
-        # skip ftab
-        ftab_len = (1 << (ftab_chars * 2)) + 1
-        fh1.seek(ftab_len * sz, 1)
-
-        # skip eftab
-        eftab_len = ftab_chars * 2
-        fh1.seek(eftab_len * sz, 1)
-
-        refnames = []
-        while True:
-            refname = fh1.readline()
-            if len(refname) == 0 or ord(refname[0]) == 0:
-                break
-            refnames.append(refname.split()[0])
-        assert len(refnames) == nref
-
-        #
-        # Parse .3.bt2 file
-        #
-        one = struct.unpack('<i', fh3.read(4))[0]
-        assert one == 1
-
-        nrecs = struct_unsigned.unpack(fh3.read(sz))[0]
-
-        running_unambig, running_length = 0, 0
-        self.recs = defaultdict(list)
-        self.offset_in_ref = defaultdict(list)
-        self.unambig_preceding = defaultdict(list)
-        length = {}
-
-        ref_id, ref_namenrecs_added = 0, None
-        for i in xrange(nrecs):
-            off = struct_unsigned.unpack(fh3.read(sz))[0]
-            ln = struct_unsigned.unpack(fh3.read(sz))[0]
-            first_of_chromosome = ord(fh3.read(1)) != 0
-            if first_of_chromosome:
-                if i > 0:
-                    length[ref_name] = running_length
-                ref_name = refnames[ref_id]
-                ref_id += 1
-                running_length = 0
-            assert ref_name is not None
-            self.recs[ref_name].append((off, ln, first_of_chromosome))
-            self.offset_in_ref[ref_name].append(running_length)
-            self.unambig_preceding[ref_name].append(running_unambig)
-            running_length += (off + ln)
-            running_unambig += ln
-
-        length[ref_name] = running_length
-        assert nrecs == sum(map(len, self.recs.itervalues()))
-
-        #
-        # Memory-map the .4.bt2 file
-        #
-        ln_bytes = (running_unambig + 3) // 4
-        self.fh4mm = mmap.mmap(fh4.fileno(), ln_bytes, flags=mmap.MAP_SHARED, prot=mmap.PROT_READ)
-
-        # These are per-reference
-        self.length = length
-        self.refnames = refnames
-
-        # To facilitate sorting reference names in order of descending length
-        sorted_rnames = sorted(self.length.items(),
-                               key=lambda x: itemgetter(1)(x), reverse=True)
-        self.rname_to_string = {}
-        self.string_to_rname = {}
-        for i, (rname, _) in enumerate(sorted_rnames):
-            rname_string = ('%012d' % i)
-            self.rname_to_string[rname] = rname_string
-            self.string_to_rname[rname_string] = rname
-        # Handle unmapped reads
-        unmapped_string = ('%012d' % len(sorted_rnames))
-        self.rname_to_string['*'] = unmapped_string
-        self.string_to_rname[unmapped_string] = '*'
-
-        # For compatibility
-        self.rname_lengths = self.length
-
-    def get_stretch(self, ref_id, ref_off, count):
-        """
-        Return a stretch of characters from the reference, retrieved
-        from the Bowtie index.
-
-        @param ref_id: name of ref seq, up to & excluding whitespace
-        @param ref_off: offset into reference, 0-based
-        @param count: # of characters
-        @return: string extracted from reference
-        """
-        assert ref_id in self.recs
-        # Account for negative reference offsets by padding with Ns
-        N_count = min(abs(min(ref_off, 0)), count)
-        stretch = ['N'] * N_count
-        count -= N_count
-        if not count: return ''.join(stretch)
-        ref_off = max(ref_off, 0)
-        starting_rec = bisect_right(self.offset_in_ref[ref_id], ref_off) - 1
-        assert starting_rec >= 0
-        off = self.offset_in_ref[ref_id][starting_rec]
-        buf_off = self.unambig_preceding[ref_id][starting_rec]
-        # Naive to scan these records linearly; obvious speedup is binary search
-        for rec in self.recs[ref_id][starting_rec:]:
-            off += rec[0]
-            while ref_off < off and count > 0:
-                stretch.append('N')
-                count -= 1
-                ref_off += 1
-            if count == 0:
+        introns: list of tuples from merged_introns()
+
+        Return value: list of tuples (chromosome, start position, end
+            position, strand, list of (sample index, coverage) pairs
+            sorted by sample index[, (start motif, end motif)])
+    """
+    remapped = []
+    for intron in introns:
+        pairs, motifs = [], ()
+        for group in intron[4]:
+            if group[0] < 0:
+                # Sample indexes from combine.py were already remapped
+                pairs.extend(zip([int(sample_index) for sample_index
+                                    in group[1].split(',')],
+                                    group[2].split(',')))
+                motifs = (group[3:],)
+            else:
+                pairs.extend(remapped_pairs(*group))
+        pairs.sort(key=lambda x: x[0])
+        remapped.append(intron[:4] + (pairs,) + motifs)
+    return remapped
+
+def intron_blocks(stream, block_size):
+    """ Cuts sorted and merged lines into blocks of whole introns
+
+        Only lines at the ends of blocks are split to find where introns end.
+
+        stream: iterator over lines whose second through fourth fields
+            identify their introns
+        block_size: number of lines after which a block ends with the end of
+            its last intron
+
+        Yield value: list of lines
+    """
+    carry = []
+    while True:
+        block = carry + list(itertools.islice(stream, block_size))
+        if not block:
+            break
+        carry = []
+        intron = block[-1].split('\t', 4)[1:4]
+        for line in stream:
+            if line.split('\t', 4)[1:4] != intron:
+                carry = [line]
                 break
-            if ref_off < off + rec[1]:
-                # stretch extends through part of the unambiguous stretch
-                buf_off += (ref_off - off)
+            block.append(line)
+        yield block
+
+def line_introns(lines):
+    """ Groups sorted and merged lines by intron
+
+        lines: list of lines, each split only once
+
+        Return value: list of tuples (chromosome, start position, end
+            position, strand, list of (sample index, coverage) pairs
+            sorted by sample index)
+    """
+    introns = []
+    for intron, intron_tokens in itertools.groupby(
+                    [line.strip().split('\t') for line in lines],
+                    key=lambda x: x[1:4]
+                ):
+        pairs = []
+        for tokens in intron_tokens:
+            pairs.extend(remapped_pairs(int(tokens[0]), tokens[-2],
+                                        tokens[-1]))
+        pairs.sort(key=lambda x: x[0])
+        introns.append((intron[0][:-1], int(intron[1]), int(intron[2]) - 1,
+                        intron[0][-1], pairs))
+    return introns
+
+def write_index(output_stream, batch_indexes, fix_batch_9=False):
+    """ Writes lines mapping new sample indexes to SRA accession numbers
+
+        output_stream: where to write lines
+        batch_indexes: indexes of batches whose samples are written
+        fix_batch_9: True iff the old manifest file with 500 samples should
+            be used for batch 9
+
+        No return value.
+    """
+    containing_dir = os.path.dirname(os.path.realpath(__file__))
+    # Find all manifest files before writing so no batch is half-written
+    filenames = []
+    for i in batch_indexes:
+        if i == 9:
+            if fix_batch_9:
+                # Use old manifest file with 500 samples
+                filename = os.path.join(containing_dir,
+                                    'sra_batch_9_sample_size_500_old.txt')
             else:
-                buf_off += rec[1]
-            off += rec[1]
-            while ref_off < off and count > 0:
-                buf_elt = buf_off >> 2
-                shift_amt = (buf_off & 3) << 1
-                stretch.append(
-                    'ACGT'[(ord(self.fh4mm[buf_elt]) >> shift_amt) & 3]
+                # Use new manifest file with 499 sample
+                filename = os.path.join(containing_dir,
+                                    'sra_batch_9_sample_size_500.txt')
+        else:
+            batch_filenames = glob.glob(
+                    os.path.join(containing_dir,
+                                    'sra_batch_%d_sample_size*.txt' % i)
                 )
-                buf_off += 1
-                count -= 1
-                ref_off += 1
-            if count == 0:
-                break
-        # If the requested stretch went past the last unambiguous
-        # character in the chromosome, pad with Ns
-        while count > 0:
-            count -= 1
-            stretch.append('N')
-        return ''.join(stretch)
+            if not batch_filenames:
+                raise RuntimeError(
+                        'No manifest file for batch {} in "{}".'.format(
+                                i, containing_dir
+                            )
+                    )
+            filename = batch_filenames[0]
+        filenames.append((i, filename))
+    for i, filename in filenames:
+        with open(filename) as input_stream:
+            for j, line in enumerate(input_stream):
+                tokens = line.strip().split('\t')
+                if fix_batch_9 \
+                    and 'SRP000941_SRS306616_SRX190128_SRR651690-1-1' \
+                    in tokens:
+                    # ignore sample because it wasn't found
+                    continue
+                print >>output_stream, (str(i * 500 + j) + '\t'
+                        + '\t'.join(tokens[-1][:-4].split('_')))
+
+def _read_blocks(path, parse, block_queue, block_size=65536):
+    """ Decompresses a file, queueing lists of its parsed lines
+
+        Run by a thread for each input. An exception is put on the queue
+        for the merging thread to raise; None is put on the queue after the
+        last lines.
+
+        path: path to gzipped or uncompressed file
+        parse: function that takes a line without its newline and returns
+            its parsed form
+        block_queue: Queue.Queue on which to put lists of parsed lines
+        block_size: number of bytes read from the file at a time
+
+        No return value.
+    """
+    try:
+        with open(path, 'rb') as input_stream:
+            gzipped = input_stream.read(2) == '\x1f\x8b'
+            input_stream.seek(0)
+            decompressor = zlib.decompressobj(31)
+            remainder = ''
+            while True:
+                data = input_stream.read(block_size)
+                if not data:
+                    break
+                if gzipped:
+                    inflated = [decompressor.decompress(data)]
+                    # Files may be concatenated gzip members
+                    while decompressor.unused_data:
+                        data = decompressor.unused_data
+                        decompressor = zlib.decompressobj(31)
+                        inflated.append(decompressor.decompress(data))
+                    data = ''.join(inflated)
+                lines = (remainder + data).split('\n')
+                remainder = lines.pop()
+                block_queue.put([parse(line) for line in lines])
+            if remainder:
+                block_queue.put([parse(remainder)])
+        block_queue.put(None)
+    except Exception as e:
+        block_queue.put(e)
+
+def _queued_lines(path, parse):
+    """ Yields parsed lines of a file decompressed by its own thread
+
+        path: path to gzipped or uncompressed file
+        parse: function that takes a line without its newline and returns
+            its parsed form; called by the thread
+    """
+    # Memory is bounded by the size of the queue; see docstring
+    block_queue = Queue.Queue(2)
+    reader = threading.Thread(target=_read_blocks,
+                                args=(path, parse, block_queue))
+    reader.daemon = True
+    reader.start()
+    while True:
+        lines = block_queue.get()
+        if lines is None:
+            break
+        if isinstance(lines, Exception):
+            raise lines
+        for line in lines:
+            yield line
+    reader.join()
+
+def _in_order(path, introns):
+    """ Yields introns read from a file, checking that they are sorted
+
+        path: path to file, for error messages
+        introns: iterable of tuples whose first four elements are
+            chromosome, start position, end position, and strand
+    """
+    last_intron = None
+    for intron in introns:
+        if last_intron is not None and intron[:4] <= last_intron:
+            raise RuntimeError(
+                    '"{}" is not sorted by chromosome, start position, '
+                    'end position, and strand as described in combine.py, '
+                    'or it has repeated introns; '
+                    'intron {}:{}-{}{} is out of order.'.format(
+                            path, *intron[:4]
+                        )
+                )
+        last_intron = intron[:4]
+        yield intron
+
+def _batch_introns(path, batch_index):
+    """ Yields introns of a sorted collected intron file
+
+        path: path to gzipped or uncompressed collected intron file
+        batch_index: index of batch
+
+        Yield value: tuple (chromosome, start position, end position,
+            strand, batch index, comma-separated list of sample indexes,
+            comma-separated list of coverages); end position is inclusive
+    """
+    def parse(line):
+        tokens = line.rstrip().split('\t')
+        return (tokens[0][:-1], int(tokens[1]), int(tokens[2]) - 1,
+                    tokens[0][-1], batch_index, tokens[-2], tokens[-1])
+    return _queued_lines(path, parse)
+
+def _combined_introns(path):
+    """ Yields introns of a sorted file written by combine.py
+
+        path: path to gzipped or uncompressed file
+
+        Yield value: tuple (chromosome, start position, end position,
+            strand, -1, comma-separated list of sample indexes,
+            comma-separated list of coverages, start motif, end motif)
+    """
+    def parse(line):
+        tokens = line.rstrip().split('\t')
+        return (tokens[0], int(tokens[1]), int(tokens[2]), tokens[3], -1,
+                    tokens[-2], tokens[-1], tokens[4], tokens[5])
+    return _queued_lines(path, parse)
+
+def merged_introns(paths, first_batch_index=0, combined_path=None):
+    """ Merges sorted collected intron files from batches
+
+        paths: paths to gzipped or uncompressed collected intron files of
+            consecutive batches, in order
+        first_batch_index: index of batch of first path
+        combined_path: path to gzipped or uncompressed file written by
+            combine.py and sorted as its output is sorted when --batches is
+            specified, whose introns are merged with those of the batches,
+            or None
+
+        Yield value: tuple (chromosome, start position, end position,
+            strand, list of tuples (batch index, comma-separated list of
+            sample indexes, comma-separated list of coverages[, start motif,
+            end motif]), one for each file in which the intron was found) in
+            order of chromosome, start position, end position, and strand;
+            end position is inclusive, and the batch index is -1 and motifs
+            are included for the file at combined_path, whose sample indexes
+            are already remapped. Pass lists of these tuples to
+            remapped_introns() to remap and sort sample indexes.
+    """
+    inputs = [_in_order(path, _batch_introns(path, batch_index))
+                for batch_index, path in enumerate(paths, first_batch_index)]
+    if combined_path is not None:
+        inputs.append(
+                _in_order(combined_path, _combined_introns(combined_path))
+            )
+    for intron, batch_introns in itertools.groupby(
+            heapq.merge(*inputs), key=lambda x: x[:4]
+        ):
+        yield intron + ([batch_intron[4:]
+                            for batch_intron in batch_introns],)
 
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser(description=__doc__, 
             formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument('--bowtie-idx', type=str, required=True,
-        help='Path to Bowtie index basename')
+        help='Path to Bowtie index basename or .2bit or FASTA file')
     parser.add_argument('--fix-batch-9', action='store_const',
         const=True, default=False,
         help='Uses old manifest file for sample indexes from '
@@ -235,64 +438,124 @@ if __name__ == '__main__':
              'a different manifest file with that sample '
              'included to search for introns. See NOTES '
              'for more information.')
+    parser.add_argument('--batch-size', type=int, required=False,
+        default=100000,
+        help='number of introns, or of lines from stdin, in each block; '
+             'motifs of a block are looked up at a time')
+    parser.add_argument('-p', '--processes', type=int, required=False,
+        default=1,
+        help='number of processes among which to divide blocks of introns')
+    parser.add_argument('--compress-threads', type=int, required=False,
+        default=0,
+        help='number of pigz threads with which to compress output; '
+             'output is uncompressed if 0')
+    parser.add_argument('--batches', type=str, required=False, nargs='+',
+        default=None,
+        help='sorted collected intron files of consecutive batches, in '
+             'order; read instead of stdin if specified')
+    parser.add_argument('--first-batch', type=int, required=False,
+        default=0,
+        help='index of batch of first file from --batches')
+    parser.add_argument('--append-to', type=str, required=False,
+        default=None,
+        help='sorted file written by combine.py with --batches whose '
+             'introns are merged with those from --batches; samples from '
+             '--batches are appended to index_to_SRA_accession.tsv rather '
+             'than writing it from scratch')
     args = parser.parse_args()
     # Write index-to-accession file
-    containing_dir = os.path.dirname(os.path.realpath(__file__))
-    reversed_complements = {
-            ('CT', 'AC') : ('GT', 'AG'),
-            ('CT', 'GC') : ('GC', 'AG'),
-            ('GT', 'AT') : ('AT', 'AC')
-        }
-    filenames = [glob.glob(
-                            os.path.join(
-                                containing_dir,
-                                'sra_batch_%d_sample_size*.txt' % i
-                            )
-                        )[0] for i in xrange(43)]
-    if args.fix_batch_9:
-        # Use old manifest file with 500 samples
-        filenames[9] = os.path.join(containing_dir,
-                            'sra_batch_9_sample_size_500_old.txt')
+    temp_index_path = None
+    if args.append_to is not None:
+        if args.batches is None:
+            raise RuntimeError('--append-to requires --batches.')
+        with open('index_to_SRA_accession.tsv') as input_stream:
+            sample_indexes = [int(line.partition('\t')[0])
+                                for line in input_stream if line.strip()]
+        if sample_indexes and max(sample_indexes) >= 500 * args.first_batch:
+            raise RuntimeError(
+                    'index_to_SRA_accession.tsv already has sample index {}, '
+                    'which is not from a batch before {}.'.format(
+                            max(sample_indexes), args.first_batch
+                        )
+                )
+        # New samples are added to a copy that replaces the original only
+        # after all introns are written, so a failed run can be rerun
+        temp_index_path = 'index_to_SRA_accession.tsv.{}.tmp'.format(
+                                                                os.getpid()
+                                                            )
     else:
-        # Use new manifest file with 499 sample
-        filenames[9] = os.path.join(containing_dir,
-                            'sra_batch_9_sample_size_500.txt')
-    with open('index_to_SRA_accession.tsv', 'w') as output_stream:
-        for i, filename in enumerate(filenames):
-            with open(filename) as input_stream:
-                for j, line in enumerate(input_stream):
-                    tokens = line.strip().split('\t')
-                    if args.fix_batch_9 \
-                        and 'SRP000941_SRS306616_SRX190128_SRR651690-1-1' \
-                        in tokens:
-                        # ignore sample because it wasn't found
-                        continue
-                    print >>output_stream, (str(i * 500 + j) + '\t'
-                            + '\t'.join(tokens[-1][:-4].split('_')))
-
-    reference_index = BowtieIndexReference(args.bowtie_idx)
-    for intron, lines in itertools.groupby(
-                            sys.stdin, key=lambda x: x.split('\t')[1:4]
-                        ):
-        chrom = intron[0][:-1]
-        start = int(intron[1])
-        end = int(intron[2]) - 1
-        start_motif = reference_index.get_stretch(chrom, start - 1, 2)
-        end_motif = reference_index.get_stretch(chrom, end - 2, 2)
-        if intron[0][-1] == '-':
-            start_motif, end_motif = reversed_complements[
-                                            (start_motif, end_motif)
-                                        ]
-        pairs = []
-        for line in lines:
-            tokens = line.strip().split('\t')
-            batch_index = int(tokens[0])
-            coverages = tokens[-1].split(',')
-            sample_indexes = [500 * batch_index + int(original_index)
-                                for original_index in tokens[-2].split(',')]
-            pairs.extend(zip(sample_indexes, coverages))
-        pairs.sort(key=lambda x: x[0])
-        print '\t'.join([chrom, str(start), str(end), intron[0][-1],
-                            start_motif, end_motif,
-                            ','.join([str(pair[0]) for pair in pairs]),
-                            ','.join([str(pair[1]) for pair in pairs])])
\ No newline at end of file
+        with open('index_to_SRA_accession.tsv', 'w') as output_stream:
+            write_index(output_stream, xrange(43), args.fix_batch_9)
+
+    try:
+        if temp_index_path is not None:
+            shutil.copyfile('index_to_SRA_accession.tsv', temp_index_path)
+            with open(temp_index_path, 'a') as output_stream:
+                write_index(output_stream,
+                            xrange(args.first_batch,
+                                    args.first_batch + len(args.batches)),
+                            args.fix_batch_9)
+
+        reference_index = open_reference(args.bowtie_idx)
+
+        def combined_lines(lines):
+            """ Return value: string with introns of a block of lines from
+                    intron_blocks()
+            """
+            return format_introns(line_introns(lines), reference_index)
+
+        def combined_introns(introns):
+            """ Return value: string with a block of introns from
+                    merged_introns()
+            """
+            return format_introns(remapped_introns(introns), reference_index)
+
+        if args.batches is not None:
+            combine_block = combined_introns
+            introns = merged_introns(args.batches, args.first_batch,
+                                        args.append_to)
+            blocks = iter(lambda: list(itertools.islice(introns,
+                                                        args.batch_size)), [])
+        else:
+            combine_block = combined_lines
+            blocks = intron_blocks(sys.stdin, args.batch_size)
+        if args.compress_threads > 0:
+            try:
+                compressor = subprocess.Popen(
+                        ['pigz', '-p', str(args.compress_threads), '-c'],
+                        stdin=subprocess.PIPE, bufsize=-1
+                    )
+            except OSError:
+                raise RuntimeError('--compress-threads requires pigz, which '
+                                   'was not found.')
+            output_stream = compressor.stdin
+        else:
+            output_stream = sys.stdout
+        if args.processes > 1:
+            pool = multiprocessing.Pool(args.processes)
+            try:
+                # Results are written in the order blocks were submitted
+                pending = collections.deque()
+                for block in blocks:
+                    pending.append(pool.apply_async(combine_block, (block,)))
+                    if len(pending) >= 2 * args.processes:
+                        output_stream.write(pending.popleft().get())
+                while pending:
+                    output_stream.write(pending.popleft().get())
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            for block in blocks:
+                output_stream.write(combine_block(block))
+        if args.compress_threads > 0:
+            output_stream.close()
+            if compressor.wait():
+                raise RuntimeError('pigz exited with nonzero status.')
+        sys.stdout.flush()
+    except:
+        if temp_index_path is not None and os.path.exists(temp_index_path):
+            os.remove(temp_index_path)
+        raise
+    if temp_index_path is not None:
+        os.rename(temp_index_path, 'index_to_SRA_accession.tsv')
@@ -1,27 +1,30 @@
 #!/usr/bin/env bash
 # Downloads all files with collected_introns results from all-of-SRA runs and merges them into one file
-# This script requires the AWS CLI, PyPy
-# Used PyPy v2.4.0
+# This script requires the AWS CLI, pigz, and Python 2 with NumPy, which combine.py uses to look up motifs in batches
 # $1: path to destination directory
 # $2: path to Bowtie index for hg19
+# $3: number of processes combine.py runs and of threads with which pigz compresses its output (default: number of cores)
 MANIFESTS=/scratch0/langmead-fs1/SRAmetadata/sample_manifest_file/multiple_sample_manifest_file_script # Path to batch manifest files
 BUCKET=s3://rail-eu-west-1 # Where batch results ended up
 OUTPUTDIR=$1
 BOWTIEIDX=$2
+PROCESSES=${3:-$(getconf _NPROCESSORS_ONLN)}
 mkdir -p ${OUTPUTDIR}
 cd $1
 # Download
 for i in {0..41}; do aws s3 cp ${BUCKET}/sra_batch_${i}_sample_size_500_itn/collected_introns/collected_introns.tsv.gz ./batch_${i}.tsv.gz; done
 # Exception: last batch has sample size 506
 aws s3 cp ${BUCKET}/sra_batch_42_sample_size_506_itn/collected_introns/collected_introns.tsv.gz ./batch_42.tsv.gz
-# Sort files, prepending batch number to each line
-for i in {0..42}; do (gzip -cd batch_${i}.tsv.gz | sort -k1,1 -k2,2n -k3,3n | awk -v r=${i} '{print r "\t" $0}' | gzip >batch_${i}.sorted.tsv.gz) & done
-# Merge sorted files, adjusting sample indexes so they're (batch number * 500 + original sample index).
+# Sort files by chromosome, start position, end position, and strand, the byte order combine.py merges them in. The chromosome
+# without its strand is prepended to each line as the first sort key and removed after sorting.
+for i in {0..42}; do (gzip -cd batch_${i}.tsv.gz | awk -F'\t' -v OFS='\t' '{print substr($1, 1, length($1) - 1), $0}' | LC_ALL=C sort -k1,1 -k3,3n -k4,4n -k2,2 | cut -f2- | gzip >batch_${i}.sorted.tsv.gz) & done
+wait
+# combine.py merges sorted files, adjusting sample indexes so they're (batch number * 500 + original sample index), and writes
+# introns sorted by chromosome, start position, and end position.
 # Note that two sample indexes will be missing because they were removed from batch manifest files. See NOTES for more information.
-cmd="sort -m -k2,2 -k3,3n -k4,4n"; for i in {0..42}; do cmd="$cmd <(gzip -cd batch_${i}.sorted.tsv.gz) "; done
-eval "$cmd" | gzip >unmerged_intron_lines.tsv.gz
 # Note the --fix-batch-9 command-line parameter below! Batch 9 was preprocessed with the manifest file sra_batch_9_sample_size_500.txt
 # but aligned with the manifest file sra_batch_9_sample_size_500_old.txt, which has an extra sample that wasn't found on the server.
 # (See NOTES for which sample it was and how it was removed.) The --fix-batch-9 command-line parameter uses the old manifest file
-# to extract the proper sample indexes.
-gzip -cd unmerged_intron_lines.tsv.gz | pypy ${MANIFESTS}/combine.py --bowtie-idx ${BOWTIEIDX} --fix-batch-9 | sort -k1,1 -k2,2n -k3,3n | gzip >all_SRA_introns.tsv.gz
\ No newline at end of file
+# to extract the proper sample indexes. combine.py remaps sample indexes and looks up motifs with ${PROCESSES} worker processes
+# and compresses its output with ${PROCESSES} pigz threads.
+python ${MANIFESTS}/combine.py --bowtie-idx ${BOWTIEIDX} --fix-batch-9 -p ${PROCESSES} --compress-threads ${PROCESSES} --batches batch_{0..42}.sorted.tsv.gz >all_SRA_introns.tsv.gz
\ No newline at end of file
@@ -58,11 +58,47 @@ We first unzipped all gtf.gz files above and then executed:
     4) gzip -cd all_SRA_introns.tsv.gz | pypy sra_vs_ann.py
         --annotations refGene.gtf gencode.v19.annotation.gtf
         Homo_sapiens.GRCh37.75.gtf --basename union
+
+The same outputs may instead be written from a single pass over introns by
+naming sets of annotated junctions, each specified as an argument of
+--annotation of the form [name]=[GTF file]; a name given more than once
+refers to the union of its GTFs. Each junction is assigned a bitmask of its
+membership in the sets, and counts are accumulated for each bitmask. Outputs
+are written for every named set and for every union and intersection of
+named sets specified as an argument of --union or --intersection of the
+form [name]=[set name],[set name],...; the outputs for the name [name] are
+[basename].[name].coverage.tsv and [basename].[name].ann.tsv. The four runs
+above are thus equivalent to
+    gzip -cd all_SRA_introns.tsv.gz | python sra_vs_ann.py
+        --annotation gencode_v19=gencode.v19.annotation.gtf
+        ensembl_v75=Homo_sapiens.GRCh37.75.gtf refseq=refGene.gtf
+        --union union=refseq,gencode_v19,ensembl_v75 --basename sra
+
+Introns may instead be read from a store written by intron_store.py by
+specifying its path as the argument of --store.
+
+Introns may also be read from a file specified as the argument of --input
+that is either uncompressed or compressed with bgzip. If --processes is
+greater than 1, the input is divided into ranges as described in
+intron_tasks.py, counts for each range are accumulated by a pool of worker
+processes, and the counts are summed, so output is the same for any number
+of processes.
+
+Junctions extracted from GTFs are cached by annotation_cache.py in the
+directory specified as the argument of --annotation-cache, so a GTF is parsed
+only the first time it is encountered. Outputs are accumulated by
+annotation_report.CoverageReducer; annotation_report.py writes them in the
+same pass over introns as the outputs of ann.py and add_ann.py. Requires
+NumPy.
 """
 import sys
-from collections import defaultdict
 import os
-import subprocess
+import multiprocessing
+import numpy as np
+import annotation_cache
+import annotation_report
+import junction_keys
+import intron_tasks
 
 if __name__ == '__main__':
     import argparse
@@ -74,9 +110,27 @@ if __name__ == '__main__':
         default=os.path.join(os.path.dirname(__file__),
                                 'extract_splice_sites.py'),
         help=('path to extract_splice_sites.py from HISAT v0.1.6-beta.'))
-    parser.add_argument('--annotations', type=str, required=True, nargs='+',
+    annotation_group = parser.add_mutually_exclusive_group(required=True)
+    annotation_group.add_argument('--annotations', type=str, nargs='+',
             help='space-separated paths to GTF files encoding known junctions'
         )
+    annotation_group.add_argument('--annotation', type=str, nargs='+',
+            help=('space-separated named GTF files encoding known junctions, '
+                  'each of the form [name]=[GTF file]')
+        )
+    parser.add_argument('--union', type=str, nargs='+', default=[],
+            help=('space-separated unions of named sets for which to write '
+                  'outputs, each of the form [name]=[set name],[set name],...')
+        )
+    parser.add_argument('--intersection', type=str, nargs='+', default=[],
+            help=('space-separated intersections of named sets for which to '
+                  'write outputs, each of the form '
+                  '[name]=[set name],[set name],...')
+        )
+    parser.add_argument('--annotation-cache', type=str, required=False,
+            default=annotation_cache.DEFAULT_CACHE,
+            help='directory in which junctions extracted from GTFs are cached'
+        )
     parser.add_argument('--basename', type=str, required=True,
             help='basename for output files'
         )
@@ -85,90 +139,117 @@ if __name__ == '__main__':
             help='subtracts 1 from end coordinates of junctions input to '
                  'stdin'
         )
+    parser.add_argument('--store', type=str, required=False,
+            default=None,
+            help='path to intron store written by intron_store.py; read '
+                 'instead of stdin if specified'
+        )
+    parser.add_argument('--input', type=str, required=False,
+            default=None,
+            help='path to uncompressed or bgzipped introns; read instead of '
+                 'stdin if specified'
+        )
+    parser.add_argument('-p', '--processes', type=int, required=False,
+            default=1,
+            help='number of processes among which to divide input'
+        )
     args = parser.parse_args()
 
-    annotated_junctions = set()
-    refs = ['chr' + str(i) for i in xrange(1, 23)] + ['chrM', 'chrX', 'chrY']
-    for annotation in args.annotations:
-        extract_process = subprocess.Popen([sys.executable,
-                                                args.extract_splice_sites_path,
-                                                annotation],
-                                                stdout=subprocess.PIPE)
-        for line in extract_process.stdout:
-            tokens = line.strip().split('\t')
-            tokens[1] = int(tokens[1]) + 2
-            tokens[2] = int(tokens[2])
-            if not tokens[0].startswith('chr'):
-                tokens[0] = 'chr' + tokens[0]
-            if tokens[0] in refs:
-                annotated_junctions.add(tuple(tokens[:-1]))
-        extract_process.stdout.close()
-        exit_code = extract_process.wait()
-        if exit_code != 0:
-            raise RuntimeError(
-                'extract_splice_sites.py had nonzero exit code {}.'.format(
-                                                                    exit_code
-                                                                )
+    if args.annotations is not None:
+        if args.union or args.intersection:
+            raise RuntimeError('--union and --intersection require named '
+                               'sets specified with --annotation.')
+        annotated_junctions, _ = annotation_report.load_annotation(
+                args.annotations, args.extract_splice_sites_path,
+                args.annotation_cache
+            )
+        classifier = annotation_report.JunctionClassifier(
+                annotated_junctions, end_offset=(-1 if args.minus_one else 0)
             )
+        reducer_outputs = [(args.basename, [1], len(annotated_junctions))]
+        set_count = 1
+    else:
+        set_names, set_gtfs = [], {}
+        for argument in args.annotation:
+            name, _, gtf = argument.partition('=')
+            if not name or not gtf:
+                raise RuntimeError(
+                        'Argument "{}" of --annotation is not of the form '
+                        '[name]=[GTF file].'.format(argument)
+                    )
+            if name not in set_gtfs:
+                set_names.append(name)
+                set_gtfs[name] = []
+            set_gtfs[name].append(gtf)
+        if len(set_names) > 8:
+            raise RuntimeError('At most 8 named sets are supported.')
+        junction_sets = [
+                annotation_report.load_annotation(
+                        set_gtfs[name], args.extract_splice_sites_path,
+                        args.annotation_cache
+                    )[0] for name in set_names
+            ]
+        masks = np.arange(1 << len(set_names), dtype=np.int64)
+        # Masks of all annotated junctions, to count junctions in each output
+        annotated_keys = reduce(np.union1d,
+                                [key_set.keys for key_set in junction_sets])
+        annotated_masks = np.bincount(
+                junction_keys.membership_masks(junction_sets,
+                                                annotated_keys),
+                minlength=len(masks)
+            )
+        outputs = [(name, masks[(masks >> i) & 1 == 1])
+                    for i, name in enumerate(set_names)]
+        for combinations, combine in [(args.union, np.any),
+                                        (args.intersection, np.all)]:
+            for argument in combinations:
+                name, _, members = argument.partition('=')
+                members = members.split(',')
+                for member in members:
+                    if member not in set_gtfs:
+                        raise RuntimeError(
+                                'Set "{}" in argument "{}" was not named '
+                                'with --annotation.'.format(member, argument)
+                            )
+                bits = np.array([set_names.index(member)
+                                    for member in members])
+                outputs.append((name, masks[combine(
+                        (masks[:, None] >> bits) & 1 == 1, axis=1
+                    )]))
+        classifier = annotation_report.JunctionClassifier(
+                junction_keys.KeySet(annotated_keys),
+                end_offset=(-1 if args.minus_one else 0),
+                junction_sets=junction_sets
+            )
+        reducer_outputs = [('.'.join([args.basename, name]), selected,
+                            int(annotated_masks[selected].sum()))
+                            for name, selected in outputs]
+        set_count = len(set_names)
+
+    def task_reducer(task):
+        """ Return value: CoverageReducer with counts for a task from
+                intron_tasks.tasks()
+        """
+        reducer = annotation_report.CoverageReducer(reducer_outputs,
+                                                    set_count)
+        # Strands are never read, so lines need not have them
+        for chunk in intron_tasks.task_chunks(task, strand_required=False):
+            reducer.add(chunk, classifier.classify(chunk))
+        return reducer
 
-    annotated_coverage = defaultdict(int)
-    unannotated_coverage = defaultdict(int)
-    sample_read_annotated = defaultdict(int)
-    sample_junction_annotated = defaultdict(int)
-    sample_read_unannotated = defaultdict(int)
-    sample_junction_unannotated = defaultdict(int)
-    for line in sys.stdin:
-        tokens = line.strip().split('\t')
-        if tokens[0].endswith('-') or tokens[0].endswith('+'):
-            tokens[0] = tokens[0][:-1]
-        tokens[1] = int(tokens[1])
-        if args.minus_one:
-            tokens[2] = int(tokens[2]) - 1
-        else:
-            tokens[2] = int(tokens[2])
-        coverages = [int(el) for el in tokens[-1].split(',')]
-        sample_count = len(coverages)
-        if tuple(tokens[:3]) in annotated_junctions:
-            annotated_coverage[sample_count] += 1
-            for index, sample_index in enumerate(
-                    [int(el) for el in tokens[-2].split(',')]
-                ):
-                sample_read_annotated[sample_index] += coverages[index]
-                sample_junction_annotated[sample_index] += 1
-        else:
-            unannotated_coverage[sample_count] += 1
-            for index, sample_index in enumerate(
-                    [int(el) for el in tokens[-2].split(',')]
-                ):
-                sample_read_unannotated[sample_index] += coverages[index]
-                sample_junction_unannotated[sample_index] += 1
-    sample_indexes = sorted(list(set(sample_read_unannotated.keys()
-                                + sample_read_annotated.keys()
-                                + sample_junction_annotated.keys()
-                                + sample_junction_unannotated.keys())))
-    with open(args.basename + '.coverage.tsv', 'w') as coverage_stream:
-        for sample_index in sample_indexes:
-            print >>coverage_stream, '%d\t%d\t%d\t%d\t%d\t%d\t%d' % (
-                    sample_index, sample_read_annotated[sample_index],
-                    sample_read_unannotated[sample_index],
-                    sample_read_annotated[sample_index]
-                    + sample_read_unannotated[sample_index],
-                    sample_junction_annotated[sample_index],
-                    sample_junction_unannotated[sample_index],
-                    sample_junction_annotated[sample_index]
-                    + sample_junction_unannotated[sample_index]
-                )
-    max_coverage = max(annotated_coverage.keys()
-                        + unannotated_coverage.keys())
-    annotated_junction_total, unannotated_junction_total = 0, 0
-    total_annotated_junctions = len(annotated_junctions)
-    with open(args.basename + '.ann.tsv', 'w') as ann_stream:
-        for coverage in xrange(max_coverage, 0, -1):
-            annotated_junction_total += annotated_coverage[coverage]
-            unannotated_junction_total += unannotated_coverage[coverage]
-            print >>ann_stream, '%d\t%d\t%d\t%d\t%d' % (
-                    coverage, annotated_junction_total,
-                    unannotated_junction_total,
-                    annotated_junction_total + unannotated_junction_total,
-                    total_annotated_junctions
-                )
+    # Strand is stripped from chromosome of "itn" lines
+    tasks = intron_tasks.tasks(args.store, args.input, sys.stdin,
+                                args.processes * 4)
+    reducer = annotation_report.CoverageReducer(reducer_outputs, set_count)
+    if args.processes > 1:
+        pool = multiprocessing.Pool(args.processes)
+        try:
+            for task_result in pool.imap_unordered(task_reducer, tasks):
+                reducer.merge(task_result)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for task in tasks:
+            reducer.merge(task_reducer(task))
+    reducer.finish()